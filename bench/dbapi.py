@@ -0,0 +1,85 @@
+# encoding=utf-8
+"""
+sqlite3-backed stand-in for mysql.connector, so the db/orm benchmarks can run without a MySQL server.
+
+必须在import transwarp.db之前调用install()。
+"""
+import os
+import sys
+import types
+import atexit
+import sqlite3
+import tempfile
+
+
+class _Cursor(object):
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, args=()):
+        # transwarp.db把?替换成了%s，这里再换回sqlite的paramstyle；MySQL的upsert改成sqlite(3.35+)的写法
+        sql = sql.replace('%s', '?').replace('on duplicate key update', 'on conflict do update set')
+        return self._cursor.execute(sql, args)
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+class _Connection(object):
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self):
+        return _Cursor(self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+_path = None
+
+
+def install(path=None):
+    """
+    Register a fake mysql.connector module backed by a sqlite file (a temp file by default).
+    """
+    global _path
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix='transwarp-bench-', suffix='.db')
+        os.close(fd)
+        atexit.register(uninstall)
+    _path = path
+    mysql = types.ModuleType('mysql')
+    connector = types.ModuleType('mysql.connector')
+    connector.connect = lambda **kw: _Connection(_path)
+    mysql.connector = connector
+    sys.modules['mysql'] = mysql
+    sys.modules['mysql.connector'] = connector
+    return path
+
+
+def uninstall():
+    if _path and os.path.exists(_path):
+        os.remove(_path)
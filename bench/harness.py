@@ -0,0 +1,150 @@
+# encoding=utf-8
+"""
+Timing harness shared by the benchmark scenarios.
+
+每个样本连续执行batch次操作，p50/p99是这些批次平均耗时的百分位数，不是单次操作的百分位数：
+这样time.time()本身的开销不会淹没微基准，但单次操作的长尾会被平均掉。
+"""
+import os
+import gc
+import sys
+import time
+import json
+import platform
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.path.join(ROOT, 'src') not in sys.path:
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_scenarios = []
+
+
+def scenario(name, batch=100, samples=50, warmup=3):
+    """
+    Register a scenario. The decorated function is a setup function returning the operation to time.
+    """
+    def _decorator(setup):
+        _scenarios.append((name, setup, batch, samples, warmup))
+        return setup
+    return _decorator
+
+
+def scenarios():
+    return list(_scenarios)
+
+
+class _NullWriter(object):
+
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = int(round((len(sorted_values) - 1) * p))
+    return sorted_values[k]
+
+
+def _allocations(fn, batch):
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for i in xrange(batch):
+            fn()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        blocks = sum(s.count_diff for s in after.compare_to(before, 'filename') if s.count_diff > 0)
+        return 'tracemalloc_blocks', float(blocks) / batch
+    # python2没有tracemalloc，只能测gc追踪的容器对象数量的净变化：
+    # 不含str/int等非容器对象，被释放的对象会抵消新建的，结果可能为负
+    gc.collect()
+    before = len(gc.get_objects())
+    for i in xrange(batch):
+        fn()
+    after = len(gc.get_objects())
+    return 'gc_objects_delta', float(after - before) / batch
+
+
+def measure(fn, batch=100, samples=50, warmup=3):
+    """
+    Run fn batch*samples times, return dict with ops_per_sec, p50_us and p99_us (percentiles of the
+    batch mean latency, latency='batch_mean'), and mem_per_op measured as mem_method.
+    fn may return a list of per-op latencies (seconds) instead, used by load generators; the
+    percentiles are then per operation (latency='per_op').
+    """
+    stdout = sys.stdout
+    # 被测代码里的print不能影响计时
+    sys.stdout = _NullWriter()
+    try:
+        for i in xrange(warmup):
+            fn()
+        latencies = []
+        total_ops = 0
+        per_op = False
+        start_all = time.time()
+        for i in xrange(samples):
+            start = time.time()
+            for j in xrange(batch):
+                r = fn()
+            t = time.time() - start
+            if isinstance(r, list) and batch == 1:
+                latencies.extend(r)
+                total_ops += len(r)
+                per_op = True
+            else:
+                latencies.append(t / batch)
+                total_ops += batch
+        elapsed = time.time() - start_all
+        mem_method, mem = _allocations(fn, min(batch, 100))
+    finally:
+        sys.stdout = stdout
+    latencies.sort()
+    return dict(
+        ops=total_ops,
+        ops_per_sec=total_ops / elapsed if elapsed else 0.0,
+        p50_us=_percentile(latencies, 0.5) * 1e6,
+        p99_us=_percentile(latencies, 0.99) * 1e6,
+        latency='per_op' if per_op else 'batch_mean',
+        mem_per_op=mem,
+        mem_method=mem_method,
+    )
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).strip()
+    except Exception:
+        return None
+
+
+def metadata():
+    return dict(
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        platform=platform.platform(),
+        revision=_git_revision(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+    )
+
+
+def save(path, results):
+    d = os.path.dirname(path)
+    if d and not os.path.isdir(d):
+        os.makedirs(d)
+    with open(path, 'w') as f:
+        json.dump(dict(meta=metadata(), results=results), f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
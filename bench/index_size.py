@@ -0,0 +1,49 @@
+# encoding=utf-8
+"""
+Compare primary key index size of the id formats.
+
+    python bench/index_size.py [rows]
+
+每种格式建一张只有varchar主键的表插入rows行，比较平均key长度和sqlite里主键索引占用的页数(db pages是累计值)。
+InnoDB的二级索引都会带上主键，所以主键越短、越有序，所有索引都越小。
+"""
+import os
+import sys
+import sqlite3
+import tempfile
+
+import harness  # noqa, sets up sys.path
+from transwarp import idgen
+
+
+def _index_pages(conn, table):
+    name = conn.execute("select name from sqlite_master where type='index' and tbl_name=?", (table,)).fetchone()[0]
+    try:
+        return conn.execute('select count(*) from dbstat where name=?', (name,)).fetchone()[0]
+    except sqlite3.OperationalError:
+        # sqlite没有编译dbstat时只能给出整个库的页数
+        return None
+
+
+def main(rows=100000):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    conn = sqlite3.connect(path)
+    try:
+        print('%-12s %10s %12s %12s' % ('format', 'key bytes', 'index pages', 'db pages'))
+        for name, gen in (('uuid', idgen.UuidIdGenerator()), ('snowflake', idgen.SnowflakeIdGenerator(worker_id=1))):
+            table = 'ids_%s' % name
+            conn.execute('create table %s (id varchar(50) primary key)' % table)
+            ids = gen.next_ids(rows)
+            conn.executemany('insert into %s (id) values (?)' % table, [(x,) for x in ids])
+            conn.commit()
+            pages = conn.execute('pragma page_count').fetchone()[0]
+            index_pages = _index_pages(conn, table)
+            print('%-12s %10.1f %12s %12d' % (name, float(sum(len(x) for x in ids)) / rows, index_pages if index_pages is not None else '-', pages))
+    finally:
+        conn.close()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
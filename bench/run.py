@@ -0,0 +1,79 @@
+# encoding=utf-8
+"""
+Run the benchmark suite.
+
+    python bench/run.py                           # run everything, save to bench/results/<time>.json
+    python bench/run.py -k orm -o orm.json        # run scenarios whose name contains "orm"
+    python bench/run.py --compare bench/results/base.json
+
+With --compare, scenarios whose throughput dropped by more than --threshold percent are reported
+as regressions and the exit status is 1.
+
+p50/p99 are percentiles of the mean latency of each batch of operations, marked * where the
+scenario reports per-operation latencies. mem/op is tracemalloc blocks allocated per operation,
+or on Python 2 the net change in gc-tracked objects per operation (can be negative).
+"""
+import os
+import sys
+import time
+import argparse
+
+import harness
+import scenarios  # noqa, registers scenarios
+
+
+def compare(base, results, threshold):
+    regressions = []
+    print('')
+    print('%-36s %14s %14s %9s' % ('scenario', 'base ops/s', 'ops/s', 'change'))
+    for name, r in sorted(results.iteritems()):
+        b = base.get('results', {}).get(name)
+        if not b or not b['ops_per_sec']:
+            continue
+        change = (r['ops_per_sec'] - b['ops_per_sec']) * 100.0 / b['ops_per_sec']
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-36s %14.1f %14.1f %+8.1f%%%s' % (name, b['ops_per_sec'], r['ops_per_sec'], change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='transwarp benchmarks')
+    parser.add_argument('-k', dest='keyword', default=None, help='only run scenarios whose name contains keyword')
+    parser.add_argument('-o', dest='output', default=None, help='result json file')
+    parser.add_argument('--compare', default=None, help='baseline result json file')
+    parser.add_argument('--threshold', type=float, default=10.0, help='regression threshold in percent')
+    args = parser.parse_args(argv)
+
+    results = {}
+    print('%-36s %12s %11s %11s %12s' % ('scenario', 'ops/s', 'batch p50us', 'batch p99us', 'mem/op'))
+    mem_method = None
+    per_op = False
+    for name, setup, batch, samples, warmup in harness.scenarios():
+        if args.keyword and args.keyword not in name:
+            continue
+        r = harness.measure(setup(), batch=batch, samples=samples, warmup=warmup)
+        results[name] = r
+        mark = '*' if r['latency'] == 'per_op' else ' '
+        print('%-36s %12.1f %10.1f%s %10.1f%s %12.1f' % (name, r['ops_per_sec'], r['p50_us'], mark, r['p99_us'], mark, r['mem_per_op']))
+        mem_method = r['mem_method']
+        per_op = per_op or r['latency'] == 'per_op'
+    if per_op:
+        print('* per-op percentiles')
+    if mem_method:
+        print('mem/op is %s' % mem_method)
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', '%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+    harness.save(output, results)
+    print('results saved to %s' % output)
+
+    if args.compare:
+        if compare(harness.load(args.compare), results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,397 @@
+# encoding=utf-8
+"""
+Benchmark scenarios over the real request pipeline and DB layer.
+"""
+import os
+import time
+import logging
+import socket
+import tempfile
+import threading
+import httplib
+from StringIO import StringIO
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from wsgiref.util import setup_testing_defaults
+
+import dbapi
+dbapi.install()
+
+from harness import scenario
+from transwarp import db, web, idgen, counter, log, server, cache
+from transwarp.web import ctx
+import models
+
+
+def _environ(path, method='GET', **kw):
+    env = dict(PATH_INFO=path, REQUEST_METHOD=method)
+    env.update(kw)
+    setup_testing_defaults(env)
+    return env
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def _make_routes(n):
+    L = []
+    for i in xrange(n):
+        def _handler(*args):
+            return 'ok'
+        _handler.__web_route__ = '/r%d/:id/items/:item' % i
+        _handler.__web_method__ = 'GET'
+        L.append(_handler)
+    return L
+
+
+def _app(routes):
+    app = web.WSGIApplication()
+    for fn in routes:
+        app.add_url(fn)
+    return app.get_wsgi_application()
+
+
+@scenario('routing.static', batch=1000)
+def bench_routing_static():
+    @web.get('/about')
+    def about():
+        return 'ok'
+    wsgi = _app(_make_routes(500) + [about])
+    env = _environ('/about')
+    return lambda: wsgi(dict(env), _start_response)
+
+
+@scenario('routing.dynamic_first_of_500', batch=1000)
+def bench_routing_dynamic_first():
+    wsgi = _app(_make_routes(500))
+    env = _environ('/r0/123/items/456')
+    return lambda: wsgi(dict(env), _start_response)
+
+
+@scenario('routing.dynamic_last_of_500', batch=100)
+def bench_routing_dynamic_last():
+    wsgi = _app(_make_routes(500))
+    env = _environ('/r499/123/items/456')
+    return lambda: wsgi(dict(env), _start_response)
+
+
+def _interceptor_chain(depth):
+    def target():
+        return 'ok'
+    L = []
+    for i in xrange(depth):
+        def _f(next):
+            return next()
+        _f.__interceptor__ = lambda path: path.startswith('/api/')
+        L.append(_f)
+    return web._build_interceptor_chain(target, *L)
+
+
+def _bench_interceptors(depth):
+    chain = _interceptor_chain(depth)
+    ctx.request = db.Dict(path_info='/api/blogs')
+    return chain
+
+for _depth in (1, 10, 50):
+    scenario('interceptors.depth_%d' % _depth, batch=1000)(lambda depth=_depth: _bench_interceptors(depth))
+
+
+@scenario('request.form', batch=200)
+def bench_request_form():
+    body = 'name=%s&summary=%s&content=%s&tag=a&tag=b&tag=c' % ('x' * 50, 'y' * 200, 'z' * 2000)
+    env = _environ('/api/blogs', 'POST', CONTENT_TYPE='application/x-www-form-urlencoded', CONTENT_LENGTH=str(len(body)))
+
+    def _parse():
+        e = dict(env)
+        e['wsgi.input'] = StringIO(body)
+        r = web.Request(e)
+        return r.input(), r.get_list('tag')
+    return _parse
+
+
+@scenario('request.cookies_headers', batch=1000)
+def bench_request_cookies_headers():
+    env = _environ('/', HTTP_COOKIE='; '.join(['c%d=v%d' % (i, i) for i in xrange(10)]),
+                   HTTP_USER_AGENT='Mozilla/5.0', HTTP_ACCEPT='text/html', HTTP_ACCEPT_LANGUAGE='en-US', HTTP_X_FORWARDED_FOR='10.0.0.1')
+
+    def _parse():
+        r = web.Request(env)
+        return r.cookie('c5'), r.header('User-Agent'), r.headers
+    return _parse
+
+
+@scenario('response.headers', batch=1000)
+def bench_response_headers():
+    def _build():
+        resp = web.Response()
+        resp.content_type = 'application/json'
+        resp.content_length = 1024
+        resp.set_header('Cache-Control', 'no-cache')
+        resp.set_header('X-Request-Id', 'abc123')
+        resp.set_cookie('session', 'abcdef0123456789', max_age=3600)
+        resp.status = 201
+        return resp.headers
+    return _build
+
+
+_db_ready = []
+
+
+def _sqlite_ddl(sql):
+    # sqlite不支持create table里的key定义，索引对这些场景的结果影响不大，直接去掉
+    return '\n'.join([line for line in sql.split('\n') if not line.strip().startswith(('key ', 'unique key '))])
+
+
+def _setup_db():
+    if not _db_ready:
+        db.create_engine('bench', 'bench', 'bench')
+        for m in (models.User, models.Blog, models.Comment, counter.CounterValue):
+            db.update('drop table if exists `%s`' % m.__table__)
+            db.update(_sqlite_ddl(m.__sql__))
+        for i in xrange(1000):
+            models.Blog(user_id='u%d' % (i % 10), user_name='user', user_image='about:blank', name='blog %d' % i,
+                        summary='summary ' * 10, content='content ' * 100).insert()
+        _db_ready.append(True)
+
+
+@scenario('db.select_1000_rows', batch=5, samples=20)
+def bench_db_select():
+    _setup_db()
+    return lambda: db.select('select * from blogs')
+
+
+@scenario('db.select_one', batch=500)
+def bench_db_select_one():
+    _setup_db()
+    pk = db.select_one('select id from blogs limit 1').id
+    return lambda: db.select_one('select * from blogs where id=?', pk)
+
+
+@scenario('orm.get', batch=500)
+def bench_orm_get():
+    _setup_db()
+    pk = db.select_one('select id from blogs limit 1').id
+    return lambda: models.Blog.get(pk)
+
+
+@scenario('orm.insert', batch=200, samples=20)
+def bench_orm_insert():
+    _setup_db()
+
+    @db.with_connection
+    def _insert():
+        models.Comment(blog_id='b', user_id='u', user_name='user', user_image='about:blank', content='hello').insert()
+    return _insert
+
+
+@scenario('orm.find_by_1000_rows', batch=5, samples=20)
+def bench_orm_find_by():
+    _setup_db()
+    return lambda: models.Blog.find_by('')
+
+
+@scenario('db.insert_raw', batch=200, samples=20)
+def bench_db_insert_raw():
+    # 和orm.insert插入同样的数据，两者之差就是ORM的开销
+    _setup_db()
+
+    @db.with_connection
+    def _insert():
+        db.insert('comments', id=db.next_id(), blog_id='b', user_id='u', user_name='user', user_image='about:blank',
+                  content='hello', created_at=time.time())
+    return _insert
+
+
+@scenario('orm.hydrate', batch=1000)
+def bench_orm_hydrate():
+    row = ('0' * 22, 'u1', 'user', 'about:blank', 'blog', 'summary', 'content', time.time())
+    return lambda: models.Blog.__hydrate__(row)
+
+
+@scenario('orm.dehydrate', batch=1000)
+def bench_orm_dehydrate():
+    def _dehydrate():
+        return models.Blog(user_id='u1', user_name='user', name='blog', content='content').__dehydrate__()
+    return _dehydrate
+
+
+@scenario('ids.uuid_next_id', batch=1000)
+def bench_ids_uuid():
+    return idgen.UuidIdGenerator().next_id
+
+
+@scenario('ids.snowflake_next_id', batch=1000)
+def bench_ids_snowflake():
+    return idgen.SnowflakeIdGenerator(worker_id=1).next_id
+
+
+@scenario('ids.snowflake_next_ids_1000', batch=10)
+def bench_ids_snowflake_batch():
+    g = idgen.SnowflakeIdGenerator(worker_id=1)
+    return lambda: g.next_ids(1000)
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+@scenario('wsgi.round_trip', batch=1, samples=5, warmup=1)
+def bench_wsgi_round_trip():
+    @web.get('/api/blogs/:id')
+    @web.api
+    def api_blog(blog_id):
+        return dict(id=blog_id, name='blog', summary='summary ' * 10)
+
+    app = web.WSGIApplication()
+    app.add_url(api_blog)
+    server = make_server('127.0.0.1', 0, app.get_wsgi_application(), handler_class=_QuietHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    port = server.server_address[1]
+
+    def _client(n, latencies):
+        for i in xrange(n):
+            start = time.time()
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/api/blogs/%d' % i)
+            conn.getresponse().read()
+            conn.close()
+            latencies.append(time.time() - start)
+
+    def _load(clients=4, requests=50):
+        # 简单的负载生成器：clients个线程并发，每个线程发requests个请求
+        latencies = []
+        threads = [threading.Thread(target=_client, args=(requests, latencies)) for i in xrange(clients)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        return latencies
+    return _load
+
+
+def _bench_http_server(keep_alive):
+    @web.get('/api/blogs/:id')
+    @web.api
+    def api_blog(blog_id):
+        return dict(id=blog_id, name='blog', summary='summary ' * 10)
+
+    app = web.WSGIApplication()
+    app.add_url(api_blog)
+    httpd = server.HttpServer(app.get_wsgi_application(), '127.0.0.1', 0, workers=4, max_requests=1000)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    port = httpd.server_address[1]
+
+    # httplib在python2里逐字节读响应头，客户端的开销会盖过服务器的差别，这里直接用socket
+    def _get(sock, path, close):
+        sock.sendall('GET %s HTTP/1.1\r\nHost: localhost\r\n%s\r\n' % (path, 'Connection: close\r\n' if close else ''))
+        data = ''
+        while '\r\n\r\n' not in data:
+            data += sock.recv(65536)
+        head, body = data.split('\r\n\r\n', 1)
+        length = int(head.lower().split('content-length:', 1)[1].split('\r\n', 1)[0])
+        while len(body) < length:
+            body += sock.recv(65536)
+        return body
+
+    def _connect():
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _client(n, latencies):
+        sock = _connect()
+        for i in xrange(n):
+            start = time.time()
+            if not keep_alive:
+                sock = _connect()
+            _get(sock, '/api/blogs/%d' % i, not keep_alive)
+            if not keep_alive:
+                sock.close()
+            latencies.append(time.time() - start)
+        sock.close()
+
+    def _load(clients=4, requests=50):
+        latencies = []
+        threads = [threading.Thread(target=_client, args=(requests, latencies)) for i in xrange(clients)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        return latencies
+    return _load
+
+
+@scenario('server.new_connection_round_trip', batch=1, samples=5, warmup=1)
+def bench_server_new_connection():
+    return _bench_http_server(False)
+
+
+@scenario('server.keepalive_round_trip', batch=1, samples=5, warmup=1)
+def bench_server_keepalive():
+    return _bench_http_server(True)
+
+
+@scenario('cache.memoize_hit', batch=1000)
+def bench_cache_memoize_hit():
+    _setup_db()
+    pk = db.select_one('select id from blogs limit 1').id
+
+    @cache.memoize(ttl=60, tags=('blog:{0}',), cache=cache.Cache('bench'))
+    def blog_name(blog_id):
+        return models.Blog.get(blog_id).name
+    blog_name(pk)
+    return lambda: blog_name(pk)
+
+
+def _logged_request(handler, level):
+    # 一个查一次数据库的请求；只在请求期间换上root logger的handler和级别，不影响其他场景
+    _setup_db()
+    pk = db.select_one('select id from blogs limit 1').id
+
+    @web.get('/blogs/:id')
+    def blog(blog_id):
+        return models.Blog.get(blog_id).name
+    wsgi = _app([blog])
+    env = _environ('/blogs/%s' % pk)
+    root = logging.getLogger()
+
+    def _request():
+        saved = root.handlers, root.level
+        root.handlers = [handler] if handler else saved[0]
+        root.level = level
+        try:
+            return wsgi(dict(env), _start_response)
+        finally:
+            root.handlers, root.level = saved
+    return _request
+
+
+def _file_handler():
+    fd, path = tempfile.mkstemp(prefix='transwarp-bench-', suffix='.log')
+    os.close(fd)
+    h = logging.FileHandler(path)
+    h.setFormatter(logging.Formatter(log.FORMAT))
+    return h
+
+
+@scenario('logging.request_off', batch=500)
+def bench_logging_off():
+    return _logged_request(None, logging.WARNING)
+
+
+@scenario('logging.request_info_sync', batch=500)
+def bench_logging_sync():
+    h = _file_handler()
+    h.addFilter(log.RequestIdFilter())
+    return _logged_request(h, logging.INFO)
+
+
+@scenario('logging.request_info_queued', batch=500)
+def bench_logging_queued():
+    return _logged_request(log.QueueHandler([_file_handler()], capacity=1000000), logging.INFO)
@@ -0,0 +1,103 @@
+# encoding=utf-8
+"""
+Full-text search index vs LIKE scans over synthetic blog posts.
+
+    python bench/search.py [posts]
+
+生成posts篇(默认1M)随机文章写入sqlite，词频服从Zipf分布，然后对比search.SearchIndex和
+LIKE '%word%'在高频、中频、低频词和多词查询上的耗时，并报告建索引时间和倒排表大小。
+排序需要全部匹配的行，所以LIKE取出所有匹配行(like all)；like 20是找到20行就停止、不排序的下限。
+"""
+import sys
+import time
+import random
+import bisect
+
+import harness  # noqa, sets up sys.path
+import dbapi
+dbapi.install()
+
+from transwarp import db, search
+from scenarios import _sqlite_ddl
+import models
+
+_VOCAB = 20000
+_SYLLABLES = ['ka', 'to', 'mi', 're', 'su', 'no', 'ha', 'li', 'po', 'an', 'el', 'zu', 'qi', 'ra', 've', 'do']
+
+
+def _vocabulary(rnd):
+    words = set()
+    while len(words) < _VOCAB:
+        words.add(''.join(rnd.choice(_SYLLABLES) for i in xrange(rnd.randint(2, 4))))
+    words = sorted(words)
+    rnd.shuffle(words)
+    # Zipf: 第i个词的权重是1/(i+1)
+    acc = []
+    total = 0.0
+    for i in xrange(len(words)):
+        total += 1.0 / (i + 1)
+        acc.append(total)
+    return words, acc
+
+
+def _text(rnd, words, acc, n):
+    total = acc[-1]
+    return ' '.join(words[bisect.bisect_left(acc, rnd.random() * total)] for i in xrange(n))
+
+
+def _populate(posts, words, acc):
+    rnd = random.Random(42)
+    sql = models.Blog.__insert_sql__
+    t = time.time()
+    for start in xrange(0, posts, 10000):
+        with db.transaction():
+            for i in xrange(start, min(posts, start + 10000)):
+                blog = models.Blog(user_id='u%d' % (i % 1000), user_name='user', user_image='', name=_text(rnd, words, acc, 4),
+                                   summary=_text(rnd, words, acc, 12), content=_text(rnd, words, acc, 60))
+                db.update(sql, *blog.__dehydrate__())
+    return time.time() - t
+
+
+def _like(word, limit=None):
+    pattern = '%%%s%%' % word
+    sql = 'select `id` from `blogs` where `name` like ? or `summary` like ? or `content` like ?'
+    if limit is None:
+        return db.select_rows(sql, pattern, pattern, pattern)
+    return db.select_rows(sql + ' limit ?', pattern, pattern, pattern, limit)
+
+
+def _timeit(fn, repeat):
+    best = None
+    for i in xrange(repeat):
+        t = time.time()
+        fn()
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def main(posts=1000000):
+    db.create_engine('bench', 'bench', 'bench')
+    db.update(_sqlite_ddl(models.Blog.__sql__))
+    words, acc = _vocabulary(random.Random(7))
+    print('populate %d posts: %.1fs' % (posts, _populate(posts, words, acc)))
+    idx = models.Blog.__search__
+    t = time.time()
+    idx.rebuild()
+    st = idx.stats()
+    print('build index: %.1fs, %d terms, %.1f MB postings (%.1f bytes/post)' % (
+        time.time() - t, st['terms'], st['posting_bytes'] / 1048576.0, float(st['posting_bytes']) / posts))
+    queries = [('common', words[0]), ('mid', words[200]), ('rare', words[15000]), ('two words', '%s %s' % (words[50], words[3000]))]
+    print('%-10s %-20s %10s %10s %12s %8s' % ('query', 'words', 'matches', 'search ms', 'like all ms', 'like 20 ms'))
+    for label, q in queries:
+        ts = _timeit(lambda: models.Blog.search(q, limit=20), 3)
+        # LIKE只能匹配一个子串，多词查询用第一个词
+        word = q.split()[0]
+        matches = []
+        tl = _timeit(lambda: matches.append(len(_like(word))), 1)
+        t20 = _timeit(lambda: _like(word, 20), 1)
+        print('%-10s %-20s %10d %10.1f %12.1f %10.1f' % (label, q, matches[0], ts * 1000, tl * 1000, t20 * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,81 @@
+# encoding=utf-8
+"""
+Memory and attribute access speed of Model vs SlotModel.
+
+    python bench/slot_model.py [count]
+
+每种模型在单独的子进程里创建count个(默认1M)8个字段的Blog实例，报告每个实例的内存占用、
+hydrate耗时和读取一个属性的耗时。
+"""
+import os
+import sys
+import gc
+import json
+import time
+import resource
+import subprocess
+
+import harness  # noqa, sets up sys.path
+import dbapi
+dbapi.install()
+
+from transwarp.orm import SlotModel, StringField, FloatField, TextField
+import models
+
+
+class SlotBlog(SlotModel):
+    __table__ = 'blogs'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    user_id = StringField(updatable=False, ddl='varchar(50)')
+    user_name = StringField(ddl='varchar(50)')
+    user_image = StringField(ddl='varchar(500)')
+    name = StringField(ddl='varchar(50)')
+    summary = StringField(ddl='varchar(200)')
+    content = TextField()
+    created_at = FloatField(updatable=False)
+
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # 没有/proc时退回到峰值RSS(Linux上单位是KB)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run(variant, count):
+    cls = models.Blog if variant == 'model' else SlotBlog
+    hydrate = cls.__hydrate__
+    # 字段值共享同一批对象，只测实例本身的开销
+    row = ('0' * 22, 'u1', 'user', 'about:blank', 'blog', 'summary', 'content', 0.0)
+    gc.collect()
+    gc.disable()
+    before = _rss()
+    start = time.time()
+    L = [hydrate(row) for i in xrange(count)]
+    build = time.time() - start
+    mem = _rss() - before
+    start = time.time()
+    for b in L:
+        b.name
+    access = time.time() - start
+    return dict(variant=variant, count=count, bytes_per_instance=float(mem) / count,
+                hydrate_ns=build * 1e9 / count, attr_access_ns=access * 1e9 / count)
+
+
+def main(count):
+    print('%-10s %12s %14s %16s' % ('variant', 'bytes/inst', 'hydrate ns', 'attr access ns'))
+    for variant in ('model', 'slot'):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--variant', variant, str(count)])
+        r = json.loads(out.strip().splitlines()[-1])
+        print('%-10s %12.1f %14.1f %16.1f' % (variant, r['bytes_per_instance'], r['hydrate_ns'], r['attr_access_ns']))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == '--variant':
+        print(json.dumps(_run(args[1], int(args[2]))))
+    else:
+        main(int(args[0]) if args else 1000000)
@@ -0,0 +1,100 @@
+# encoding=utf-8
+"""
+Application startup time with and without the route manifest.
+
+    python bench/startup.py [modules] [routes_per_module]
+
+在临时目录生成modules个路由模块(默认50个，每个10个路由，一半带参数)，每种方式在新的进程里
+计时add_module()全部模块加get_wsgi_application()：
+eager是不用manifest，cold是第一次启动(导入模块并写manifest)，warm是manifest有效时的启动
+(不导入模块、不编译路由正则)；first hit是warm启动后第一次访问某个模块的路由的耗时。
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+import harness
+
+_MODULE = '''# encoding=utf-8
+import re
+import json
+import hashlib
+from transwarp.web import get, post, ctx
+
+_TABLE = dict((hashlib.md5(str(i)).hexdigest(), i) for i in xrange(2000))
+%s
+'''
+
+_ROUTE = '''
+@%s('%s')
+def handler_%d(%s):
+    return 'ok'
+'''
+
+_CHILD = '''
+import sys, time, json
+sys.path[0:0] = [%r, %r, %r]
+import dbapi
+dbapi.install()
+t0 = time.time()
+from transwarp import web
+app = web.WSGIApplication(document_root=%r, route_manifest=%s)
+for i in xrange(%d):
+    app.add_module('benchapp.m%%d' %% i)
+fn = app.get_wsgi_application()
+t1 = time.time()
+env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/m%d/r1/abc', 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+       'QUERY_STRING': '', 'wsgi.input': None}
+status = []
+body = fn(env, lambda s, headers: status.append(s))
+t2 = time.time()
+assert status == ['200 OK'], status
+print json.dumps(dict(startup=t1 - t0, first_hit=t2 - t1, modules=len([m for m, v in sys.modules.items() if v and m.startswith('benchapp.')])))
+'''
+
+
+def _generate(root, modules, routes):
+    pkg = os.path.join(root, 'benchapp')
+    os.mkdir(pkg)
+    open(os.path.join(pkg, '__init__.py'), 'w').close()
+    for i in xrange(modules):
+        L = []
+        for j in xrange(routes):
+            if j % 2:
+                L.append(_ROUTE % ('get', '/m%d/r%d/:name' % (i, j), j, 'name'))
+            else:
+                L.append(_ROUTE % ('post' if j % 4 else 'get', '/m%d/r%d' % (i, j), j, ''))
+        with open(os.path.join(pkg, 'm%d.py' % i), 'w') as f:
+            f.write(_MODULE % ''.join(L))
+
+
+def _run(root, manifest, modules):
+    src = os.path.join(harness.ROOT, 'src')
+    code = _CHILD % (root, src, os.path.dirname(os.path.abspath(__file__)), root, repr(manifest), modules, modules - 1)
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    modules = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    routes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    root = tempfile.mkdtemp(prefix='transwarp-startup-')
+    try:
+        _generate(root, modules, routes)
+        # 先跑一次生成.pyc，各方式都从字节码导入
+        _run(root, None, modules)
+        manifest = os.path.join(root, 'routes.json')
+        print '%d modules x %d routes' % (modules, routes)
+        print '%-8s %12s %12s %10s' % ('mode', 'startup ms', 'first hit ms', 'imported')
+        for mode, path in (('eager', None), ('cold', manifest), ('warm', manifest), ('warm', manifest)):
+            r = _run(root, path, modules)
+            print '%-8s %12.1f %12.2f %10d' % (mode, r['startup'] * 1000, r['first_hit'] * 1000, r['modules'])
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,16 @@
 import time
 
 from transwarp.db import next_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField, ForeignKey
+from transwarp.counter import Counter
+from transwarp import search
 
 
 class User(Model):
     __table__ = 'users'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(updatable=False, ddl='varchar(50)')
+    email = StringField(updatable=False, unique=True, ddl='varchar(50)')
     password = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
@@ -20,9 +22,9 @@ class Blog(Model):
     __table__ = 'blogs'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(updatable=False, ddl='varchar(50)')
-    user_name = StringField(ddl='varchar(50)')
-    user_image = StringField(ddl='varchar(500)')
+    user_id = ForeignKey(User, reverse='blogs', updatable=False, ddl='varchar(50)')
+    user_name = StringField(copy_from='User.name', via='user_id', ddl='varchar(50)')
+    user_image = StringField(copy_from='User.image', via='user_id', ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
@@ -31,16 +33,24 @@ class Blog(Model):
 
 class Comment(Model):
     __table__ = 'comments'
+    # shard by blog_id once Comment.__shards__ is set to a ShardMap
+    __shard_key__ = 'blog_id'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(updatable=False, ddl='varchar(50)')
-    user_id = StringField(updatable=False, ddl='varchar(50)')
-    user_name = StringField(ddl='varchar(50)')
-    user_image = StringField(ddl='varchar(500)')
+    blog_id = ForeignKey(Blog, reverse='comments', updatable=False, ddl='varchar(50)')
+    user_id = ForeignKey(User, updatable=False, ddl='varchar(50)')
+    user_name = StringField(copy_from='User.name', via='user_id', ddl='varchar(50)')
+    user_image = StringField(copy_from='User.image', via='user_id', ddl='varchar(500)')
     content = TextField()
     created_at = FloatField(updatable=False, default=time.time)
 
 
+User.blog_count = Counter(Blog, 'user_id')
+Blog.comment_count = Counter(Comment, 'blog_id')
+
+search.index(Blog, name=3, summary=2, content=1)
+
+
 if __name__ == '__main__':
     print(User().__sql__)
     print(Blog().__sql__)
@@ -0,0 +1,468 @@
+# encoding=utf-8
+"""
+Two-tier cache: a bounded in-process LRU in front of an optional shared backend.
+
+    @cache.memoize(ttl=300, tags=('blog:{0}',))
+    def blog_summary(blog_id):
+        ...
+
+    cache.invalidate_on(Blog, 'blog:{id}')      # Blog写入提交后，blog:<id>标签下的缓存失效
+
+    @cache.request_memo
+    def current_permissions(user_id):          # 同一个请求内只算一次
+        ...
+
+    cache.configure(shared=cache.FileBackend('/var/cache/app'))
+
+本进程的缓存命中时不访问共享层；未命中时查共享层，再调用函数计算。同一个key在本进程内只有一个线程在计算，
+其他线程等待它的结果；有共享层时还会在共享层上加一个短期的锁，多个进程之间也只计算一次。
+每个值记录写入时各个标签的版本，invalidate_tags()改变标签版本，旧的值在读取时被丢弃。
+标签版本保存在共享层里，其他进程的本地层最多在local_ttl秒后看到失效。
+
+本地层返回的是缓存的对象本身，调用者不应修改它。
+"""
+import os
+import time
+import random
+import base64
+import hashlib
+import functools
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+import db
+import orm
+import metrics
+from orm import Model, StringField, TextField, FloatField
+from web import ctx
+
+
+_MISS = object()
+_ER_DUP_ENTRY = 1062
+
+
+def _dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(blob):
+    return pickle.loads(blob)
+
+
+class LocalCache(object):
+
+    """
+    Thread-safe LRU holding at most max_size entries.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        # key -> (expires, value)，按最近访问排序
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return _MISS
+            if item[0] < time.time():
+                return _MISS
+            self._data[key] = item
+            return item[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SharedBackend(object):
+
+    """
+    Base class of the shared tier. Values are byte strings.
+    """
+
+    def get(self, key):
+        ' Return the value of key, or None if it does not exist or has expired. '
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl):
+        ' Set key only if it does not exist; return True if it was set. '
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class FileBackend(SharedBackend):
+
+    """
+    One file per key under directory, shared by the processes of one host.
+    Each file starts with its expiry time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        expires, sep, value = data.partition('\n')
+        if not sep or float(expires) < time.time():
+            return None
+        return value
+
+    def _data(self, value, ttl):
+        return '%r\n%s' % (time.time() + ttl, value)
+
+    def set(self, key, value, ttl):
+        path = self._path(key)
+        tmp = '%s.%d.%d' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(self._data(value, ttl))
+        os.rename(tmp, path)
+
+    def add(self, key, value, ttl):
+        path = self._path(key)
+        for i in xrange(2):
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except OSError:
+                # 已存在：过期了就删掉再试一次
+                if i or self.get(key) is not None:
+                    return False
+                self.delete(key)
+                continue
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._data(value, ttl))
+            return True
+        return False
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class CachedValue(Model):
+
+    """
+    Row of DbBackend, create the table with schema.migrate(CachedValue).
+    """
+
+    __table__ = 'cache_entries'
+
+    id = StringField(primary_key=True, ddl='varchar(40)')
+    value = TextField()
+    expires = FloatField()
+
+
+class DbBackend(SharedBackend):
+
+    """
+    Entries in the cache_entries table, shared by all processes. Expired rows are replaced on write.
+    """
+
+    def __init__(self):
+        self._table = CachedValue.__table__
+
+    def get(self, key):
+        row = db.select_row('select `value`, `expires` from `%s` where `id`=?' % self._table, hashlib.sha1(key).hexdigest())
+        if row is None or row[1] < time.time():
+            return None
+        return base64.b64decode(row[0])
+
+    def set(self, key, value, ttl):
+        blob = base64.b64encode(value)
+        expires = time.time() + ttl
+        db.update('insert into `%s` (`id`, `value`, `expires`) values (?, ?, ?) on duplicate key update `value`=?, `expires`=?' % self._table,
+                  hashlib.sha1(key).hexdigest(), blob, expires, blob, expires)
+
+    def add(self, key, value, ttl):
+        cid = hashlib.sha1(key).hexdigest()
+        now = time.time()
+        db.update('delete from `%s` where `id`=? and `expires`<?' % self._table, cid, now)
+        try:
+            CachedValue(id=cid, value=base64.b64encode(value), expires=now + ttl).insert()
+            return True
+        except Exception as e:
+            if getattr(e, 'errno', None) != _ER_DUP_ENTRY:
+                raise
+            return False
+
+    def delete(self, key):
+        db.update('delete from `%s` where `id`=?' % self._table, hashlib.sha1(key).hexdigest())
+
+
+class Cache(object):
+
+    # 有共享层时本地层的默认local_ttl，其他进程的失效最多这么久之后被看到
+    SHARED_LOCAL_TTL = 5
+
+    def __init__(self, name='default', max_size=10000, shared=None, local_ttl=None, lock_timeout=10):
+        """
+        local_ttl limits how long values stay in the local tier (default: their ttl, or
+        SHARED_LOCAL_TTL seconds with a shared tier), lock_timeout is how long other processes
+        wait for one process to compute a value.
+        """
+        self.name = name
+        self.local = LocalCache(max_size)
+        self.shared = shared
+        if local_ttl is None and shared is not None:
+            local_ttl = self.SHARED_LOCAL_TTL
+        self.local_ttl = local_ttl
+        self.lock_timeout = lock_timeout
+        # tag -> version，没有失效过的标签版本是None。只由invalidate_tags()和从共享层读到的最新版本修改，
+        # 不能用计算之前读到的版本覆盖，否则会撤销计算期间发生的失效
+        self._tags = {}
+        # key -> Event，正在计算的key
+        self._computing = {}
+        self._lock = threading.Lock()
+        self.stats = dict(local_hits=0, shared_hits=0, misses=0, waits=0, invalidations=0)
+
+    def _tag_versions(self, tags):
+        if self.shared is None:
+            return tuple(self._tags.get(t) for t in tags)
+        return tuple(self.shared.get('tag:%s' % t) for t in tags)
+
+    def _local_ttl(self, ttl):
+        return min(ttl, self.local_ttl) if self.local_ttl else ttl
+
+    def _lookup(self, key):
+        item = self.local.get(key)
+        if item is not _MISS:
+            value, tags, versions = item
+            # 本地层只和本进程知道的标签版本比较，不访问共享层
+            if not tags or tuple(self._tags.get(t) for t in tags) == versions:
+                self.stats['local_hits'] += 1
+                return value
+            self.local.delete(key)
+        if self.shared is not None:
+            blob = self.shared.get('value:%s' % key)
+            if blob is not None:
+                expires, value, tags, versions = _loads(blob)
+                current = self._tag_versions(tags) if tags else ()
+                if current == versions:
+                    self.stats['shared_hits'] += 1
+                    for t, v in zip(tags, current):
+                        self._tags[t] = v
+                    self.local.set(key, (value, tags, versions), self._local_ttl(expires - time.time()))
+                    return value
+        return _MISS
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISS:
+            self.stats['misses'] += 1
+            return default
+        return value
+
+    def set(self, key, value, ttl=300, tags=()):
+        """
+        Store value for ttl seconds. The value is dropped when any of tags is invalidated.
+        """
+        tags = tuple(tags)
+        self._store(key, value, ttl, tags, self._tag_versions(tags))
+
+    def _store(self, key, value, ttl, tags, versions):
+        self.local.set(key, (value, tags, versions), self._local_ttl(ttl))
+        if self.shared is not None:
+            self.shared.set('value:%s' % key, _dumps((time.time() + ttl, value, tags, versions)), ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete('value:%s' % key)
+
+    def invalidate_tags(self, *tags):
+        for t in tags:
+            version = '%x' % random.getrandbits(64)
+            self._tags[t] = version
+            if self.shared is not None:
+                # 标签版本比缓存的值保留得久即可
+                self.shared.set('tag:%s' % t, version, 86400 * 7)
+        self.stats['invalidations'] += len(tags)
+
+    def get_or_compute(self, key, fn, ttl=300, tags=()):
+        """
+        Return the cached value of key, or call fn() once and cache its result.
+        Concurrent callers of the same key wait for the first one instead of calling fn() too.
+        """
+        value = self._lookup(key)
+        if value is not _MISS:
+            return value
+        with self._lock:
+            event = self._computing.get(key)
+            owner = event is None
+            if owner:
+                event = self._computing[key] = threading.Event()
+        if not owner:
+            self.stats['waits'] += 1
+            event.wait(self.lock_timeout)
+            value = self._lookup(key)
+            if value is not _MISS:
+                return value
+            return fn()
+        try:
+            self.stats['misses'] += 1
+            return self._compute(key, fn, ttl, tags)
+        finally:
+            with self._lock:
+                del self._computing[key]
+            event.set()
+
+    def _compute(self, key, fn, ttl, tags):
+        tags = tuple(tags)
+        if self.shared is None:
+            # 标签版本在计算之前读取；_store()不修改self._tags，计算期间发生的失效使版本不一致，
+            # 这个结果在下次读取时被丢弃
+            versions = self._tag_versions(tags)
+            value = fn()
+            self._store(key, value, ttl, tags, versions)
+            return value
+        lock = 'lock:%s' % key
+        deadline = time.time() + self.lock_timeout
+        # 其他进程正在计算时等它写入共享层，超时后自己计算
+        while not self.shared.add(lock, '1', self.lock_timeout) and time.time() < deadline:
+            time.sleep(0.05)
+            value = self._lookup(key)
+            if value is not _MISS:
+                return value
+        try:
+            versions = self._tag_versions(tags)
+            value = fn()
+            self._store(key, value, ttl, tags, versions)
+            return value
+        finally:
+            self.shared.delete(lock)
+
+    def clear_local(self):
+        self.local.clear()
+
+    def prometheus_lines(self):
+        st = self.stats
+        name = self.name.replace('"', '\\"')
+        L = ['# TYPE transwarp_cache_requests_total counter']
+        for result in ('local_hits', 'shared_hits', 'misses'):
+            L.append('transwarp_cache_requests_total{cache="%s",result="%s"} %d' % (name, result[:-1] if result != 'misses' else 'miss', st[result]))
+        L.extend(['# TYPE transwarp_cache_waits_total counter',
+                  'transwarp_cache_waits_total{cache="%s"} %d' % (name, st['waits']),
+                  '# TYPE transwarp_cache_invalidations_total counter',
+                  'transwarp_cache_invalidations_total{cache="%s"} %d' % (name, st['invalidations']),
+                  '# TYPE transwarp_cache_local_entries gauge',
+                  'transwarp_cache_local_entries{cache="%s"} %d' % (name, len(self.local))])
+        return L
+
+
+_cache = Cache()
+# 其他Cache实例需要自己调用metrics.add_collector(c.prometheus_lines)
+metrics.add_collector(lambda: _cache.prometheus_lines())
+
+
+def configure(**kw):
+    """
+    Replace the default cache, kw are the arguments of Cache().
+    """
+    global _cache
+    _cache = Cache(**kw)
+    return _cache
+
+
+def get_cache():
+    return _cache
+
+
+def _make_key(func, args, kw):
+    return '%s.%s:%r' % (func.__module__, func.__name__, args + tuple(sorted(kw.iteritems())))
+
+
+def memoize(ttl=300, key=None, tags=(), cache=None):
+    """
+    Cache the results of the decorated function for ttl seconds.
+    key(*args, **kw) returns the cache key (default: function name and repr of the arguments);
+    tags are format strings over the arguments, e.g. 'user:{0}' or 'user:{user_id}'.
+    The function gets invalidate(*args, **kw) to drop one cached result.
+    """
+    def _decorator(func):
+        def _key(args, kw):
+            return key(*args, **kw) if key else _make_key(func, args, kw)
+
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            c = cache or _cache
+            t = [tag.format(*args, **kw) for tag in tags]
+            return c.get_or_compute(_key(args, kw), lambda: func(*args, **kw), ttl, t)
+
+        _wrapper.invalidate = lambda *args, **kw: (cache or _cache).delete(_key(args, kw))
+        return _wrapper
+    return _decorator
+
+
+def request_memo(func):
+    """
+    Cache the results of func for the current request only; outside a request func is called directly.
+    """
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        request = getattr(ctx, 'request', None)
+        if request is None:
+            return func(*args, **kw)
+        try:
+            memo = request._memo
+        except AttributeError:
+            memo = request._memo = {}
+        k = (func, args, tuple(sorted(kw.iteritems())))
+        try:
+            return memo[k]
+        except KeyError:
+            value = memo[k] = func(*args, **kw)
+            return value
+    return _wrapper
+
+
+def invalidate_tags(*tags):
+    _cache.invalidate_tags(*tags)
+
+
+def invalidate_on(model, *tags):
+    """
+    Invalidate tags after a transaction that inserted, updated or deleted a model object commits.
+    Tags are format strings over the object's fields, e.g. invalidate_on(Comment, 'blog:{blog_id}').
+    """
+    def _on_write(event, obj, rowcount):
+        if type(obj) is not model:
+            return
+        fields = dict((k, getattr(obj, k, None)) for k in model.__mappings__)
+        names = [t.format(**fields) for t in tags]
+        cache = _cache
+        db.after_commit(lambda: cache.invalidate_tags(*names))
+    orm.add_write_hook(_on_write)
+    return _on_write
@@ -0,0 +1,191 @@
+# encoding=utf-8
+"""
+Materialized counters maintained by ORM write hooks.
+
+    Blog.comment_count = Counter(Comment, 'blog_id')
+
+    blog.comment_count                      # 一次主键查询，不再count(*)
+    Blog.comment_count.load(blogs)          # 一个IN查询加载一组对象的计数
+
+Comment.insert()/delete()在同一个事务里更新counters表中对应的行(没有插入或删除行时不变)。
+计数不会缓存在对象上，每次读取属性都查询一次；需要批量读取时用load()。通过db.update()直接修改的行，
+以及可以被update()修改的计数字段不会被跟踪，由reconcile()定期按实际数据修正。
+"""
+import time
+import logging
+import threading
+
+import db
+import orm
+from orm import Model, StringField, IntegerField
+
+
+class CounterValue(Model):
+
+    """
+    Row of the counters table, create the table with schema.migrate(CounterValue).
+    id is '<source table>.<column>:<key>'.
+    """
+
+    __table__ = 'counters'
+
+    id = StringField(primary_key=True, ddl='varchar(200)')
+    value = IntegerField()
+
+
+_UPSERT_ADD = 'insert into `counters` (`id`, `value`) values (?, ?) on duplicate key update `value`=`value`+?'
+_UPSERT_SET = 'insert into `counters` (`id`, `value`) values (?, ?) on duplicate key update `value`=?'
+_CHUNK = 1000
+
+# source model name -> [Counter]
+_counters = {}
+
+
+def _on_write(event, obj, rowcount):
+    if event == 'update' or not rowcount:
+        return
+    for c in _counters.get(type(obj).__name__, ()):
+        key = getattr(obj, c.attr, None)
+        if key is not None:
+            c.add(key, 1 if event == 'insert' else -1)
+
+
+class Counter(object):
+
+    """
+    Number of source rows per value of source.attr, read as an attribute of the owner model.
+    source is a model class or its name.
+    """
+
+    def __init__(self, source, attr):
+        self._source = source
+        self.attr = attr
+        self.name = None
+        source_name = source if isinstance(source, basestring) else source.__name__
+        _counters.setdefault(source_name, []).append(self)
+        orm.add_write_hook(_on_write)
+
+    @property
+    def source(self):
+        if isinstance(self._source, basestring):
+            self._source = orm._models[self._source]
+        return self._source
+
+    @property
+    def prefix(self):
+        return '%s.%s:' % (self.source.__table__, self.source.__mappings__[self.attr].name)
+
+    def add(self, key, delta):
+        db.update(_UPSERT_ADD, '%s%s' % (self.prefix, key), delta, delta)
+
+    def get(self, key):
+        return self.get_many([key]).get(key, 0)
+
+    def get_many(self, keys):
+        """
+        Return {key: count} for keys, with one query per _CHUNK keys.
+        """
+        prefix = self.prefix
+        ids = dict(('%s%s' % (prefix, k), k) for k in keys)
+        d = dict.fromkeys(ids.itervalues(), 0)
+        L = ids.keys()
+        for i in xrange(0, len(L), _CHUNK):
+            chunk = L[i:i + _CHUNK]
+            sql = 'select `id`, `value` from `counters` where `id` in (%s)' % ','.join('?' * len(chunk))
+            for cid, value in db.select_rows(sql, *chunk):
+                d[ids[cid]] = value
+        return d
+
+    def _find_name(self, cls):
+        for klass in cls.__mro__:
+            for k, v in klass.__dict__.iteritems():
+                if v is self:
+                    return k
+        raise AttributeError('Counter is not an attribute of %s' % cls.__name__)
+
+    def load(self, objs):
+        """
+        Load the counts of objs (instances of the owner model) with batched queries and attach them.
+        """
+        if not objs:
+            return objs
+        cls = type(objs[0])
+        name = self.name or self._find_name(cls)
+        self.name = name
+        pk = cls.__primary_key__.name
+        counts = self.get_many([getattr(o, pk) for o in objs])
+        for o in objs:
+            orm._set_related(o, name, counts[getattr(o, pk)])
+        return objs
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        name = self.name or self._find_name(cls)
+        self.name = name
+        try:
+            if isinstance(obj, dict):
+                return obj[name]
+            return obj._related[name]
+        except (KeyError, AttributeError):
+            pass
+        # 不缓存在obj上，否则之后的写操作不会反映到这个对象的计数
+        return self.get(getattr(obj, cls.__primary_key__.name))
+
+    def reconcile(self):
+        """
+        Recount from the source table and fix counters that drifted. Returns the number of rows fixed.
+        Increments that happen while counting may be overwritten; the next run corrects them.
+        """
+        source = self.source
+        column = source.__mappings__[self.attr].name
+        sql = 'select `%s`, count(*) from `%s` where `%s` is not null group by `%s`' % (column, source.__table__, column, column)
+        actual = {}
+        for rows in source._on_shards(lambda: db.select_rows(sql)):
+            for key, n in rows:
+                cid = '%s%s' % (self.prefix, key)
+                actual[cid] = actual.get(cid, 0) + n
+        prefix = self.prefix
+        # prefix范围查询，走主键索引
+        stored = dict(db.select_rows('select `id`, `value` from `counters` where `id`>=? and `id`<?',
+                                     prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+        fixes = [(cid, n) for cid, n in actual.iteritems() if stored.get(cid) != n]
+        fixes.extend((cid, 0) for cid, v in stored.iteritems() if v and cid not in actual)
+        for i in xrange(0, len(fixes), _CHUNK):
+            with db.transaction():
+                for cid, n in fixes[i:i + _CHUNK]:
+                    db.update(_UPSERT_SET, cid, n, n)
+        if fixes:
+            logging.info('counter %s: fixed %d rows.', prefix, len(fixes))
+        return len(fixes)
+
+
+def reconcile_all():
+    n = 0
+    for L in _counters.values():
+        for c in L:
+            n += c.reconcile()
+    return n
+
+
+_reconciler = None
+
+
+def start_reconcile(interval=3600):
+    """
+    Run reconcile_all() every interval seconds in a daemon thread.
+    """
+    global _reconciler
+    if _reconciler is not None:
+        return
+
+    def _loop():
+        while True:
+            time.sleep(interval)
+            try:
+                reconcile_all()
+            except Exception:
+                logging.exception('counter reconcile failed.')
+    _reconciler = threading.Thread(target=_loop, name='counter-reconcile')
+    _reconciler.daemon = True
+    _reconciler.start()
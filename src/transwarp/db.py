@@ -1,15 +1,22 @@
 # encoding=utf-8
+import re
 import time
-import uuid
+import random
 import functools
+import itertools
 import threading
 import logging
 import mysql.connector
 import doctest
 
+import idgen
+
 
 engine = None
 
+# 每条SQL执行完后调用 hook(sql, args, seconds)，供metrics、query trace等模块统计
+_query_hooks = []
+
 
 class Dict(dict):
 
@@ -32,72 +39,449 @@ class DBError(Exception):
     pass
 
 
+class DeadlineExceeded(DBError):
+    pass
+
+
 class MultiColumnsError(DBError):
     pass
 
 
+_id_generator = idgen.default_generator()
+
+
+def set_id_generator(generator):
+    """
+    Replace the generator used by next_id()/next_ids(), e.g. idgen.SnowflakeIdGenerator(worker_id=3).
+    The default is idgen.default_generator().
+    """
+    global _id_generator
+    _id_generator = generator
+
+
 def next_id(t=None):
-    if t is None:
-        t = time.time()
-    return "%015d%s000" % (int(t * 1000), uuid.uuid4().hex)
+    return _id_generator.next_id(t)
+
+
+def next_ids(n):
+    """
+    Reserve n ids at once for bulk inserts.
+    """
+    return _id_generator.next_ids(n)
 
 
 def _profiling(start, sql=''):
     t = time.time() - start
     if t > 0.1:
-        logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
+        logging.warning('[PROFILING] [DB] %s: %s', t, sql)
     else:
-        logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
-
+        logging.info('[PROFILING] [DB] %s: %s', t, sql)
+
+
+def _fire_query_hooks(sql, args, start):
+    if _query_hooks:
+        t = time.time() - start
+        for hook in _query_hooks:
+            hook(sql, args, t)
+
+
+_RE_FP_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_FP_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_FP_IN = re.compile(r'\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)
+_RE_FP_SPACE = re.compile(r'\s+')
+_fingerprints = {}
+
+
+def fingerprint(sql):
+    """
+    Normalize parameters and literals out of a statement.
+    >>> fingerprint("select * from `blogs` where id=%s and n in (1, 2,3)  limit 10")
+    'select * from `blogs` where id=? and n in (?+) limit ?'
+    """
+    fp = _fingerprints.get(sql)
+    if fp is None:
+        fp = _RE_FP_STRING.sub('?', sql.replace('%s', '?'))
+        fp = _RE_FP_NUMBER.sub('?', fp)
+        fp = _RE_FP_IN.sub('in (?+)', fp)
+        fp = _RE_FP_SPACE.sub(' ', fp).strip().lower()
+        if len(_fingerprints) < 2000:
+            _fingerprints[sql] = fp
+    return fp
+
+
+class _QueryTrace(threading.local):
+
+    # 当前请求内每个fingerprint执行的次数，只在begin_request()之后统计
+    counts = None
+
+
+class _QueryTracer(object):
+
+    def __init__(self, slow_threshold=None, n_plus_one=10):
+        self.slow_threshold = slow_threshold
+        self.n_plus_one = n_plus_one
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._local = _QueryTrace()
+
+    def __call__(self, sql, args, t):
+        fp = fingerprint(sql)
+        with self._lock:
+            st = self._stats.get(fp)
+            if st is None:
+                st = self._stats[fp] = [0, 0.0, 0.0, 0]
+            st[0] += 1
+            st[1] += t
+            if t > st[2]:
+                st[2] = t
+        counts = self._local.counts
+        if counts is not None:
+            n = counts.get(fp, 0) + 1
+            counts[fp] = n
+            if n == self.n_plus_one + 1:
+                with self._lock:
+                    st[3] += 1
+                logging.warning('[N+1] statement executed more than %d times in one request: %s', self.n_plus_one, fp)
+        if self.slow_threshold is not None and t > self.slow_threshold:
+            logging.warning('[SLOW] [DB] %.3fs: %s, ARGS: %s', t, sql, args)
+            if sql.lstrip()[:6].lower() == 'select':
+                _explain(sql, args)
+
+    def stats(self):
+        with self._lock:
+            L = [Dict(fingerprint=fp, count=v[0], total=v[1], max=v[2], avg=v[1] / v[0], n_plus_one=v[3]) for fp, v in self._stats.iteritems()]
+        L.sort(key=lambda d: d.total, reverse=True)
+        return L
+
+
+def _explain(sql, args):
+    cursor = None
+    try:
+        # 在执行这条select的连接上EXPLAIN，走replica的查询不会给primary增加负担
+        cursor = (_db_ctx.last_read or _db_ctx.connection).cursor()
+        cursor.execute('explain ' + sql, args)
+        names = [x[0] for x in cursor.description]
+        for row in cursor.fetchall():
+            logging.warning('[EXPLAIN] %s', Dict(names, row))
+    except Exception:
+        logging.exception('[EXPLAIN] failed: %s', sql)
+    finally:
+        if cursor:
+            cursor.close()
 
-def create_engine(user, password, database, host='127.0.0.1', port=3306, **kwargs):
-    global engine
-    if engine is not None:
-        raise DBError('Engine already initialized.')
+_tracer = None
+
+
+def enable_query_trace(slow_threshold=None, n_plus_one=10):
+    """
+    Record per-fingerprint counts and timings. Selects slower than slow_threshold seconds are logged
+    with their EXPLAIN output, and a fingerprint running more than n_plus_one times in one request is flagged.
+    """
+    global _tracer
+    if _tracer is not None:
+        _query_hooks.remove(_tracer)
+    _tracer = _QueryTracer(slow_threshold, n_plus_one)
+    _query_hooks.append(_tracer)
+
+
+def query_stats():
+    return _tracer.stats() if _tracer else []
+
+
+def begin_request(deadline=None):
+    """
+    Called by the web layer when a request starts: resets read-your-writes stickiness and the per-request query trace.
+    """
+    _rw_ctx.in_request = True
+    _rw_ctx.wrote = False
+    _rw_ctx.deadline = deadline
+    if _tracer:
+        _tracer._local.counts = {}
+
+
+def end_request():
+    _rw_ctx.in_request = False
+    _rw_ctx.wrote = False
+    _rw_ctx.deadline = None
+    if _tracer:
+        _tracer._local.counts = None
+
+
+def set_deadline(deadline):
+    """
+    Set the time (as time.time()) after which queries of the current thread raise DeadlineExceeded; None clears it.
+    """
+    _rw_ctx.deadline = deadline
+
+
+def get_deadline():
+    return _rw_ctx.deadline
+
+
+# MySQL 5.7.8+: ER_QUERY_TIMEOUT, SELECT超过MAX_EXECUTION_TIME被中断
+_ER_QUERY_TIMEOUT = 3024
+_RE_SELECT = re.compile(r'^\s*select\b', re.IGNORECASE)
+
+
+def _with_budget(sql):
+    """
+    Check the deadline and give a SELECT the remaining budget as an optimizer hint.
+
+    >>> _rw_ctx.deadline = time.time() + 1.5
+    >>> _with_budget('select * from user where id=%s')[:30]
+    'select /*+ MAX_EXECUTION_TIME('
+    >>> _with_budget('update user set name=%s')
+    'update user set name=%s'
+    >>> _rw_ctx.deadline = time.time() - 1
+    >>> _with_budget('select 1')
+    Traceback (most recent call last):
+      ...
+    DeadlineExceeded: request deadline exceeded
+    >>> _rw_ctx.deadline = None
+    """
+    deadline = _rw_ctx.deadline
+    if deadline is None:
+        return sql
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded('request deadline exceeded')
+    m = _RE_SELECT.match(sql)
+    if m is None:
+        # 写操作没有对应的hint，只在执行前检查；锁等待由innodb_lock_wait_timeout限制
+        return sql
+    return '%s /*+ MAX_EXECUTION_TIME(%d) */%s' % (sql[:m.end()], max(1, int(remaining * 1000)), sql[m.end():])
+
+
+def _execute(cursor, sql, args):
+    try:
+        cursor.execute(_with_budget(sql), args)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        if getattr(e, 'errno', None) == _ER_QUERY_TIMEOUT:
+            raise DeadlineExceeded(str(e))
+        raise
+
+
+def make_engine(user, password, database, host='127.0.0.1', port=3306, replicas=None, replica_policy='round_robin',
+                pool_size=10, **kwargs):
+    """
+    Build an engine without installing it as the global one, e.g. for shards used through db.using().
+    replicas is a list of 'host:port' strings or dicts overriding the primary's connect params;
+    selects outside a transaction go to a replica chosen by replica_policy ('round_robin' or 'least_connections').
+    """
     params = dict(user=user, password=password, database=database, host=host, port=port)
     defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
     for k, v in defaults.items():
         params[k] = kwargs.pop(k, v)
     params.update(kwargs)
     params['buffered'] = True
-    engine = _Engine(lambda: mysql.connector.connect(**params))
+    primary = _Endpoint('primary', params, pool_size)
+    L = []
+    for i, r in enumerate(replicas or ()):
+        p = dict(params)
+        if isinstance(r, basestring):
+            h, _, pt = r.partition(':')
+            p['host'] = h
+            if pt:
+                p['port'] = int(pt)
+        else:
+            p.update(r)
+        L.append(_Endpoint('replica-%d' % i, p, pool_size))
+    return _Engine(primary, L, replica_policy)
 
-    logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+
+def create_engine(user, password, database, host='127.0.0.1', port=3306, **kwargs):
+    """
+    Init the global engine, see make_engine() for the arguments.
+    """
+    global engine
+    if engine is not None:
+        raise DBError('Engine already initialized.')
+    engine = make_engine(user, password, database, host, port, **kwargs)
+
+    logging.info('Init mysql engine <%s> ok.', hex(id(engine)))
+
+
+def close_engine():
+    """
+    Close pooled connections and reset the global engine so create_engine() can be called again.
+    """
+    global engine
+    if engine is not None:
+        engine.close()
+        engine = None
+
+
+def _is_alive(connection):
+    fn = getattr(connection, 'is_connected', None)
+    if fn is None:
+        return True
+    try:
+        return fn()
+    except Exception:
+        return False
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class _Endpoint(object):
+
+    """
+    一个MySQL实例，自带连接池和健康检查：连接失败后在retry_interval秒内视为不可用，
+    空闲超过check_interval秒的连接取出时先检查是否还活着。
+    """
+
+    def __init__(self, name, params, pool_size=10, check_interval=30, retry_interval=5):
+        self.name = name
+        self.pool_size = pool_size
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.active = 0
+        self._params = params
+        self._pool = []
+        self._lock = threading.Lock()
+        self._down_until = 0
+
+    @property
+    def healthy(self):
+        return time.time() >= self._down_until
+
+    def _connect(self):
+        try:
+            connection = mysql.connector.connect(**self._params)
+        except Exception:
+            self._down_until = time.time() + self.retry_interval
+            logging.warning('connect to %s (%s:%s) failed, mark down for %ss.', self.name, self._params.get('host'), self._params.get('port'), self.retry_interval)
+            raise
+        self._down_until = 0
+        logging.info('open connection <%s> to %s...', hex(id(connection)), self.name)
+        return connection
+
+    def acquire(self):
+        connection, last_used = None, 0
+        with self._lock:
+            if self._pool:
+                connection, last_used = self._pool.pop()
+            self.active += 1
+        try:
+            if connection is not None and time.time() - last_used > self.check_interval and not _is_alive(connection):
+                _close_quietly(connection)
+                connection = None
+            if connection is None:
+                connection = self._connect()
+        except Exception:
+            with self._lock:
+                self.active -= 1
+            raise
+        return connection
+
+    def release(self, connection):
+        try:
+            # 结束连接上可能残留的事务和一致性读快照，再放回池中
+            connection.rollback()
+            reuse = True
+        except Exception:
+            reuse = False
+        with self._lock:
+            self.active -= 1
+            if reuse and len(self._pool) < self.pool_size:
+                self._pool.append((connection, time.time()))
+                return
+        logging.info('close connection <%s>...', hex(id(connection)))
+        _close_quietly(connection)
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, []
+        for connection, last_used in pool:
+            _close_quietly(connection)
 
 
 class _Engine(object):
 
-    def __init__(self, connect):
-        self._connect = connect
+    def __init__(self, primary, replicas=(), policy='round_robin'):
+        if policy not in ('round_robin', 'least_connections'):
+            raise DBError('Bad replica policy: %s' % policy)
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.policy = policy
+        self._counter = itertools.count()
+
+    def pick_replica(self):
+        L = [r for r in self.replicas if r.healthy]
+        if not L:
+            return self.primary
+        if self.policy == 'least_connections':
+            return min(L, key=lambda r: r.active)
+        return L[next(self._counter) % len(L)]
 
-    def connect(self):
-        return self._connect()
+    def close(self):
+        self.primary.close()
+        for r in self.replicas:
+            r.close()
 
 
 class _LasyConnection(object):
 
-    def __init__(self):
+    def __init__(self, replica=False):
         self.connection = None
+        self.endpoint = None
+        self.replica = replica
 
     def cursor(self):
         if self.connection is None:
-            connection = engine.connect()
-            logging.info('open connection <%s>...' % (hex(id(connection))))
+            e = _db_ctx.get_engine()
+            endpoint = e.pick_replica() if self.replica else e.primary
+            try:
+                connection = endpoint.acquire()
+            except Exception:
+                if endpoint is e.primary:
+                    raise
+                logging.warning('replica %s unavailable, read from primary.', endpoint.name)
+                endpoint = e.primary
+                connection = endpoint.acquire()
+            self.endpoint = endpoint
             self.connection = connection
         return self.connection.cursor()
 
     def commit(self):
-        self.connection.commit()
+        if self.connection:
+            self.connection.commit()
+
+    def rollback(self):
+        if self.connection:
+            self.connection.rollback()
 
-    def roolback(self):
-        self.connection.roolback()
+    def execute(self, sql):
+        cursor = self.cursor()
+        try:
+            cursor.execute(sql)
+        finally:
+            cursor.close()
 
     def cleanup(self):
         if self.connection:
             _connection = self.connection
-            logging.info('close connection <%s>...' % hex(id(_connection)))
-            _connection.close()
             self.connection = None
+            self.endpoint.release(_connection)
+
+
+class _RwCtx(threading.local):
+
+    # in_request由web在每个请求开始时设置；wrote表示当前请求(或最外层连接)里已经写过primary，
+    # 之后的读都留在primary上，保证read-your-writes
+    in_request = False
+    wrote = False
+    # 请求的截止时间(time.time())，超过后查询抛出DeadlineExceeded
+    deadline = None
+
+_rw_ctx = _RwCtx()
 
 
 # _db_ctx是threadlocal对象，所以，它持有的数据库连接对于每个线程看到的都是不一样的
@@ -106,22 +490,50 @@ class _DbCtx(threading.local):
 
     def __init__(self):
         self.connection = None
+        self.replica = None
         self.transactions = 0
+        # after_commit()登记的回调，最外层事务提交后执行，回滚时丢弃
+        self.pending = []
+        # db.using()设置的engine，为None时使用全局engine
+        self.engine = None
+        # 最近一次select使用的连接(primary或replica)，慢查询的EXPLAIN在同一个连接上执行
+        self.last_read = None
+
+    def get_engine(self):
+        e = self.engine or engine
+        if e is None:
+            raise DBError('Engine is not initialized.')
+        return e
 
     def is_init(self):
         return self.connection is not None
 
     def init(self):
         self.connection = _LasyConnection()
+        self.replica = None
         self.transactions = 0
+        self.pending = []
+        if not _rw_ctx.in_request:
+            _rw_ctx.wrote = False
 
     def cleanup(self):
         self.connection.cleanup()
         self.connection = None
+        self.last_read = None
+        if self.replica is not None:
+            self.replica.cleanup()
+            self.replica = None
 
     def cursor(self):
         return self.connection.cursor()
 
+    def read_connection(self):
+        if self.transactions or _rw_ctx.wrote or not self.get_engine().replicas:
+            return self.connection
+        if self.replica is None:
+            self.replica = _LasyConnection(replica=True)
+        return self.replica
+
 _db_ctx = _DbCtx()
 
 
@@ -145,6 +557,41 @@ def connection():
     return _ConnectionCtx()
 
 
+class _UsingCtx(object):
+
+    """
+    在当前线程里临时切换到另一个engine，外层的连接和事务状态在退出时恢复。
+    """
+
+    def __init__(self, e):
+        self._engine = e
+
+    def __enter__(self):
+        if self._engine is not None:
+            self._saved = (_db_ctx.connection, _db_ctx.replica, _db_ctx.transactions, _db_ctx.pending, _db_ctx.engine)
+            _db_ctx.connection = None
+            _db_ctx.replica = None
+            _db_ctx.transactions = 0
+            _db_ctx.pending = []
+            _db_ctx.engine = self._engine
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_traceback):
+        if self._engine is not None:
+            try:
+                if _db_ctx.is_init():
+                    _db_ctx.cleanup()
+            finally:
+                _db_ctx.connection, _db_ctx.replica, _db_ctx.transactions, _db_ctx.pending, _db_ctx.engine = self._saved
+
+
+def using(e):
+    """
+    Run the enclosed queries against engine e (made by make_engine()); None means the global engine.
+    """
+    return _UsingCtx(e)
+
+
 def with_connection(func):
 
     @functools.wraps(func)
@@ -154,14 +601,38 @@ def with_connection(func):
     return _wrapper
 
 
+# MySQL的死锁和锁等待超时错误码，遇到这两种错误整个事务可以安全地重试
+_RETRYABLE_ERRORS = frozenset([1205, 1213])
+
+
 class _TransactionCtx(object):
 
+    """
+    最外层开启真正的事务，嵌套的transaction()使用SAVEPOINT，内层可以单独回滚。
+    """
+
+    def __init__(self, read_only=False):
+        self.read_only = read_only
+
     def __enter__(self):
         global _db_ctx
         self.should_close_conn = False
         if not _db_ctx.is_init():
             _db_ctx.init()
             self.should_close_conn = True
+        self.savepoint = None
+        self.pending_mark = len(_db_ctx.pending)
+        try:
+            if _db_ctx.transactions == 0:
+                if self.read_only:
+                    _db_ctx.connection.execute('start transaction read only')
+            else:
+                self.savepoint = 'sp_%d' % _db_ctx.transactions
+                _db_ctx.connection.execute('savepoint %s' % self.savepoint)
+        except Exception:
+            if self.should_close_conn:
+                _db_ctx.cleanup()
+            raise
         _db_ctx.transactions += 1
         return self
 
@@ -169,11 +640,25 @@ class _TransactionCtx(object):
         global _db_ctx
         _db_ctx.transactions -= 1
         try:
-            if _db_ctx.transactions == 0:
+            if self.savepoint is not None:
+                if exc_type is None:
+                    _db_ctx.connection.execute('release savepoint %s' % self.savepoint)
+                else:
+                    del _db_ctx.pending[self.pending_mark:]
+                    # 死锁(以及innodb_rollback_on_timeout时的锁等待超时)时服务器已经回滚了整个事务，
+                    # savepoint也不存在了；回滚失败时同样保留原来的异常，让外层的with_transaction()能重试
+                    if not _is_retryable(exc_val):
+                        try:
+                            _db_ctx.connection.execute('rollback to savepoint %s' % self.savepoint)
+                        except Exception:
+                            logging.warning('rollback to savepoint %s failed.', self.savepoint, exc_info=True)
+            elif _db_ctx.transactions == 0:
+                pending, _db_ctx.pending = _db_ctx.pending, []
                 if exc_type is None:
                     self.commit()
+                    _run_pending(pending)
                 else:
-                    self.roolback()
+                    self.rollback()
         finally:
             if self.should_close_conn:
                 _db_ctx.cleanup()
@@ -183,49 +668,117 @@ class _TransactionCtx(object):
         try:
             _db_ctx.connection.commit()
         except Exception as e:
-            _db_ctx.connection.roolback()
+            _db_ctx.connection.rollback()
             raise e
 
-    def roolback(self):
+    def rollback(self):
         global _db_ctx
-        _db_ctx.connection.roolback()
+        _db_ctx.connection.rollback()
+
+
+def _run_pending(callbacks):
+    for fn in callbacks:
+        try:
+            fn()
+        except Exception:
+            logging.exception('after_commit callback %r failed.', fn)
+
+
+def after_commit(fn):
+    """
+    Call fn() once the current transaction commits; it is dropped if the transaction
+    (or the savepoint it was registered in) rolls back. Outside a transaction the
+    statements are already committed and fn() is called immediately.
+    """
+    if _db_ctx.is_init() and _db_ctx.transactions:
+        _db_ctx.pending.append(fn)
+    else:
+        _run_pending([fn])
 
 
-def transaction():
-    return _TransactionCtx()
+def in_transaction():
+    return _db_ctx.is_init() and _db_ctx.transactions > 0
 
 
-def with_transaction(func):
+def transaction(read_only=False):
+    """
+    Transaction context. Nested transactions use savepoints. read_only=True issues
+    START TRANSACTION READ ONLY (ignored when nested in an outer transaction).
+    """
+    return _TransactionCtx(read_only)
+
+
+def _is_retryable(e):
+    return getattr(e, 'errno', None) in _RETRYABLE_ERRORS
+
+
+def with_transaction(func=None, retries=0, backoff=0.05, read_only=False):
+    """
+    Run func in a transaction. Used as @with_transaction or @with_transaction(retries=3):
+    the outermost transaction is retried with exponential backoff on deadlock or lock wait timeout.
+    """
+    if func is None:
+        return functools.partial(with_transaction, retries=retries, backoff=backoff, read_only=read_only)
 
     @functools.wraps(func)
     def _wrapper(*args, **kwargs):
-        start = time.time()
-        with _TransactionCtx():
-            func(*args, **kwargs)
-        _profiling(start)
+        # 嵌套在外层事务中时，死锁已经回滚了整个外层事务，只能交给外层处理
+        attempts = retries if _db_ctx.transactions == 0 else 0
+        n = 0
+        while True:
+            start = time.time()
+            try:
+                with _TransactionCtx(read_only):
+                    r = func(*args, **kwargs)
+            except Exception as e:
+                if n >= attempts or not _is_retryable(e):
+                    raise
+                n += 1
+                delay = backoff * (2 ** (n - 1)) * (0.5 + random.random())
+                logging.warning('transaction %s failed (%s), retry %d/%d in %.3fs.', func.__name__, e, n, attempts, delay)
+                time.sleep(delay)
+                continue
+            _profiling(start)
+            return r
     return _wrapper
 
 
-@with_connection
-def _select(sql, first, *args):
+def _do_select(sql, first, args, row_type):
     global _db_ctx
     cursor = None
     sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    start = time.time()
+    conn = _db_ctx.read_connection()
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
-        if cursor.description:
+        cursor = conn.cursor()
+        _execute(cursor, sql, args)
+        names = None
+        if row_type is not None and cursor.description:
             names = [x[0] for x in cursor.description]
         if first:
             values = cursor.fetchone()
             if not values:
                 return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+            return values if row_type is None else row_type(names, values)
+        if row_type is None:
+            return cursor.fetchall()
+        return [row_type(names, x) for x in cursor.fetchall()]
     finally:
         if cursor:
             cursor.close()
+        _db_ctx.last_read = conn
+        _fire_query_hooks(sql, args, start)
+
+
+@with_connection
+def _select(sql, first, *args):
+    return _do_select(sql, first, args, Dict)
+
+
+@with_connection
+def _select_raw(sql, first, *args):
+    return _do_select(sql, first, args, None)
 
 
 def select_one(sql, *args):
@@ -243,23 +796,40 @@ def select(sql, *args):
     return _select(sql, False, *args)
 
 
+def select_row(sql, *args):
+    """
+    Like select_one() but returns the raw tuple, in the order of the selected columns.
+    """
+    return _select_raw(sql, True, *args)
+
+
+def select_rows(sql, *args):
+    """
+    Like select() but returns raw tuples, for callers that hydrate rows themselves.
+    """
+    return _select_raw(sql, False, *args)
+
+
 @with_connection
 def _update(sql, *args):
     global _db_ctx
     cursor = None
     sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    start = time.time()
     try:
+        _rw_ctx.wrote = True
         cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
+        _execute(cursor, sql, args)
         r = cursor.rowcount
         if _db_ctx.transactions == 0:
-            logging.info('auto commit')
+            logging.debug('auto commit')
             _db_ctx.connection.commit()
         return r
     finally:
         if cursor:
             cursor.close()
+        _fire_query_hooks(sql, args, start)
 
 
 def update(sql, *args):
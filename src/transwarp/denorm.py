@@ -0,0 +1,276 @@
+# encoding=utf-8
+"""
+Keep denormalized copies in sync with their source, e.g. Blog.user_name copied from User.name:
+
+    class Blog(Model):
+        user_id = ForeignKey(User)
+        user_name = StringField(copy_from='User.name', via='user_id')
+
+    sync = denorm.DenormSync(chunk_size=500, pause=0.05)
+    sync.start()
+
+User.update()时先检查有没有副本和新值不一致(只看每个分片上的一行)，没有就什么也不做；
+否则提交后不在请求里同步改写所有副本，而是记录一个任务(denorm_jobs表)，
+由后台线程按主键顺序分块更新，每块一个短事务，块之间sleep，不会长时间锁住大量行。
+每块只改写值不一致的行，所以任务可以重复执行；进程重启后start()会继续未完成的任务。
+"""
+import time
+import Queue
+import logging
+import threading
+
+import db
+import orm
+from orm import Model, StringField, IntegerField, FloatField
+
+
+class DenormJob(Model):
+
+    """
+    One propagation job: copy the fields of source(source_pk) into the rows of target
+    ('Model.via_column', on one shard, -1 if not sharded). last_pk is the resume point.
+    """
+
+    __table__ = 'denorm_jobs'
+    __indexes__ = (('status', 'created_at'),)
+
+    id = StringField(primary_key=True, default=db.next_id, ddl='varchar(50)')
+    source = StringField(updatable=False, ddl='varchar(50)')
+    source_pk = StringField(updatable=False, ddl='varchar(50)')
+    target = StringField(updatable=False, ddl='varchar(100)')
+    shard = IntegerField(updatable=False, default=-1)
+    last_pk = StringField(ddl='varchar(50)')
+    rows = IntegerField()
+    status = StringField(default='pending', ddl='varchar(10)')
+    created_at = FloatField(updatable=False, default=time.time)
+    updated_at = FloatField(default=time.time)
+
+
+class _CopySpec(object):
+
+    def __init__(self, target, via):
+        self.target = target
+        self.via = target.__mappings__[via].name
+        self.key = '%s.%s' % (target.__name__, self.via)
+        # [(target column, source attr)]
+        self.columns = []
+
+
+_specs = {}
+_specs_version = 0
+
+
+def _stale_where(spec, source_pk, values):
+    """
+    Where clauses and args matching the rows of spec.target copied from source_pk whose values differ.
+    """
+    where = ['`%s`=?' % spec.via, '(%s)' % ' or '.join('`%s`<>? or `%s` is null' % (c, c) for c, attr in spec.columns)]
+    return where, [source_pk] + values
+
+
+def _stale_shards(spec, source_pk, values):
+    """
+    Shards (-1 if not sharded) holding at least one stale copy.
+    """
+    where, args = _stale_where(spec, source_pk, values)
+    sql = 'select 1 from `%s` where %s limit 1' % (spec.target.__table__, ' and '.join(where))
+    found = spec.target._on_shards(lambda: db.select_rows(sql, *args))
+    if spec.target.__shards__ is None:
+        return [-1] if found[0] else []
+    return [i for i, rows in enumerate(found) if rows]
+
+
+def copies():
+    """
+    Return {source model name: [_CopySpec]} for every field declared with copy_from.
+    """
+    global _specs, _specs_version
+    if _specs_version != len(orm._models):
+        specs = {}
+        for name, model in orm._models.items():
+            by_via = {}
+            for k, f in model.__mappings__.iteritems():
+                if not f.copy_from:
+                    continue
+                source, attr = f.copy_from.split('.', 1)
+                spec = by_via.get((source, f.via))
+                if spec is None:
+                    spec = by_via[(source, f.via)] = _CopySpec(model, f.via)
+                    specs.setdefault(source, []).append(spec)
+                spec.columns.append((f.name, attr))
+        _specs, _specs_version = specs, len(orm._models)
+    return _specs
+
+
+class DenormSync(object):
+
+    """
+    Background propagation of copy_from fields.
+    durable=False keeps jobs in memory only (no denorm_jobs table, nothing to resume).
+    """
+
+    def __init__(self, chunk_size=500, pause=0.05, durable=True):
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.durable = durable
+        self._queue = Queue.Queue()
+        # 还没开始执行的任务，同一个源对象多次更新只保留一个
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._current = None
+        self.stats = dict(jobs=0, chunks=0, rows=0, errors=0)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        orm.add_write_hook(self._on_write)
+        if self.durable:
+            self.resume()
+        self._thread = threading.Thread(target=self._loop, name='denorm-sync')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop after the current chunk. Unfinished jobs stay pending and are resumed by the next start().
+        """
+        orm.remove_write_hook(self._on_write)
+        self._running = False
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def resume(self):
+        n = 0
+        for job in DenormJob.find_by('where `status`=? order by `created_at`', 'pending'):
+            self._put(job)
+            n += 1
+        if n:
+            logging.info('denorm: resuming %d pending jobs.', n)
+        return n
+
+    def progress(self):
+        """
+        Dict(queued, current, jobs, chunks, rows, errors) where current is the running DenormJob.
+        """
+        return db.Dict(queued=self._queue.qsize(), current=self._current, **self.stats)
+
+    def wait(self, timeout=None):
+        """
+        Block until the queue is drained (mainly for tests and scripts).
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def schedule(self, obj):
+        """
+        Create the jobs propagating obj's fields to the copies that differ from them, one per
+        target and shard. Called from the ORM write hook.
+        """
+        source = type(obj).__name__
+        pk = getattr(obj, obj.__primary_key__.name)
+        jobs = []
+        for spec in copies().get(source, ()):
+            values = [getattr(obj, attr) for col, attr in spec.columns]
+            for shard in _stale_shards(spec, pk, values):
+                job = DenormJob(source=source, source_pk=pk, target=spec.key, shard=shard)
+                if self.durable:
+                    job.insert()
+                jobs.append(job)
+        if jobs:
+            # 在源对象的事务提交之后才入队，否则后台线程可能读到提交前的旧值
+            db.after_commit(lambda: [self._put(job) for job in jobs])
+        return jobs
+
+    def _on_write(self, event, obj, rowcount):
+        if event == 'update' and type(obj).__name__ in copies():
+            self.schedule(obj)
+
+    def _put(self, job):
+        key = (job.source, job.source_pk, job.target, job.shard)
+        with self._lock:
+            if key in self._queued:
+                if self.durable:
+                    job.status = 'merged'
+                    job.update()
+                return
+            self._queued.add(key)
+        self._queue.put(job)
+
+    def _loop(self):
+        while self._running:
+            job = self._queue.get()
+            try:
+                if job is not None:
+                    with self._lock:
+                        self._queued.discard((job.source, job.source_pk, job.target, job.shard))
+                    self._current = job
+                    self.run(job)
+            except Exception:
+                self.stats['errors'] += 1
+                logging.exception('denorm: job %s failed, it stays pending.', job.id)
+            finally:
+                self._current = None
+                self._queue.task_done()
+
+    def run(self, job):
+        """
+        Run job to completion, one chunk per transaction.
+        """
+        spec = [sp for sp in copies().get(job.source, ()) if sp.key == job.target]
+        if spec:
+            spec = spec[0]
+            engine = spec.target.__shards__.engines[job.shard] if job.shard >= 0 else None
+            # 任务在源对象提交后立即入队，replica可能还是旧值，在事务里读走primary
+            with db.transaction():
+                obj = orm._models[job.source].get(job.source_pk)
+            values = [getattr(obj, attr) for col, attr in spec.columns] if obj else None
+            while self._running and values is not None:
+                with db.using(engine):
+                    n, last = self._run_chunk(spec, job.source_pk, values, job.last_pk)
+                self.stats['chunks'] += 1
+                self.stats['rows'] += n
+                if last is None:
+                    break
+                job.last_pk = last
+                job.rows += n
+                job.updated_at = time.time()
+                if self.durable:
+                    job.update()
+                if self.pause:
+                    time.sleep(self.pause)
+        if not self._running:
+            return
+        job.status = 'done'
+        job.updated_at = time.time()
+        if self.durable:
+            job.update()
+        self.stats['jobs'] += 1
+
+    def _run_chunk(self, spec, source_pk, values, last_pk):
+        """
+        Update the next chunk of stale rows after last_pk; returns (rows updated, last pk or None when finished).
+        """
+        pk = spec.target.__primary_key__.name
+        table = spec.target.__table__
+        cols = [c for c, attr in spec.columns]
+        where, args = _stale_where(spec, source_pk, values)
+        if last_pk:
+            where.append('`%s`>?' % pk)
+            args.append(last_pk)
+        args.append(self.chunk_size)
+        with db.transaction():
+            pks = [r[0] for r in db.select_rows('select `%s` from `%s` where %s order by `%s` limit ?' % (pk, table, ' and '.join(where), pk), *args)]
+            if not pks:
+                return 0, None
+            sql = 'update `%s` set %s where `%s` in (%s)' % (table, ','.join('`%s`=?' % c for c in cols), pk, ','.join('?' * len(pks)))
+            db.update(sql, *(values + pks))
+        return len(pks), pks[-1]
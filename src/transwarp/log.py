@@ -0,0 +1,196 @@
+# encoding=utf-8
+"""
+Non-blocking log output with per-request correlation ids.
+
+    log.setup(logging.INFO)                        # 默认写stderr
+    log.setup(logging.INFO, logging.FileHandler('app.log'))
+
+请求线程只把LogRecord放进有界队列，消息格式化和I/O都在后台线程里完成；队列满时丢弃记录并计数，
+不会阻塞请求。WSGIApplication为每个请求分配request id(或沿用X-Request-Id请求头)，
+记录里的%(request_id)s就是它，响应也会带上X-Request-Id。
+
+消息在后台线程里才用args格式化，传给logging的参数在调用之后不应再被修改。
+"""
+import sys
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+import metrics
+
+
+FORMAT = '%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'
+
+_local = threading.local()
+_handler = None
+
+
+def _write_line(stream, msg):
+    # 和logging.StreamHandler.emit()一样处理unicode，只是不在每条记录后flush
+    if isinstance(msg, unicode) and getattr(stream, 'encoding', None):
+        line = u'%s\n' % msg
+        try:
+            stream.write(line)
+        except UnicodeEncodeError:
+            stream.write(line.encode(stream.encoding))
+    else:
+        try:
+            stream.write('%s\n' % msg)
+        except UnicodeError:
+            stream.write('%s\n' % msg.encode('utf-8'))
+
+
+def new_request_id():
+    return '%016x' % random.getrandbits(64)
+
+
+def set_request_id(request_id):
+    _local.request_id = request_id
+
+
+def get_request_id():
+    return getattr(_local, 'request_id', None)
+
+
+class RequestIdFilter(logging.Filter):
+
+    """
+    Set record.request_id to the id of the current request, or '-' outside requests.
+    """
+
+    def filter(self, record):
+        record.request_id = getattr(_local, 'request_id', None) or '-'
+        return True
+
+
+class QueueHandler(logging.Handler):
+
+    """
+    Pass records to handlers in a background thread. emit() never blocks: records are dropped
+    when capacity records are already waiting.
+    """
+
+    def __init__(self, handlers, capacity=10000, interval=0.05):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.capacity = capacity
+        self.interval = interval
+        self.dropped = 0
+        # deque的append/popleft本身是线程安全的，请求线程上不需要加锁，也不用唤醒后台线程
+        self._records = deque()
+        self._stopped = False
+        self._idle = threading.Event()
+        # filter在调用logging的线程里执行，request id要在这里取
+        self.addFilter(RequestIdFilter())
+        self._thread = threading.Thread(target=self._loop, name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle(self, record):
+        # 不需要Handler.handle()里的锁
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        if len(self._records) >= self.capacity:
+            self.dropped += 1
+            return
+        if record.exc_info:
+            # traceback在这里格式化，不让后台线程持有请求线程的frame
+            record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+            record.exc_info = None
+        self._records.append(record)
+
+    def _loop(self):
+        while not self._stopped:
+            if not self._write():
+                self._idle.set()
+                time.sleep(self.interval)
+        self._write()
+        self._idle.set()
+
+    def _write(self):
+        records = self._records
+        if not records:
+            return 0
+        self._idle.clear()
+        batch = []
+        try:
+            while True:
+                batch.append(records.popleft())
+        except IndexError:
+            pass
+        for h in self.handlers:
+            if isinstance(h, logging.StreamHandler) and h.stream is not None:
+                # 整批写完再flush一次；每条记录单独处理错误，一条写失败不影响同一批的其他记录
+                h.acquire()
+                try:
+                    for record in batch:
+                        if record.levelno >= h.level and h.filter(record):
+                            try:
+                                _write_line(h.stream, h.format(record))
+                            except Exception:
+                                h.handleError(record)
+                    try:
+                        h.flush()
+                    except Exception:
+                        h.handleError(batch[-1])
+                finally:
+                    h.release()
+            else:
+                for record in batch:
+                    if record.levelno >= h.level:
+                        try:
+                            h.handle(record)
+                        except Exception:
+                            h.handleError(record)
+        return len(batch)
+
+    def flush(self):
+        """
+        Wait until the queued records are written.
+        """
+        while self._records and self._thread.is_alive():
+            self._idle.clear()
+            self._idle.wait(1)
+        for h in self.handlers:
+            h.flush()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._stopped = True
+            self._thread.join(5)
+        for h in self.handlers:
+            h.close()
+        logging.Handler.close(self)
+
+    def prometheus_lines(self):
+        return ['# TYPE transwarp_log_queued gauge',
+                'transwarp_log_queued %d' % len(self._records),
+                '# TYPE transwarp_log_dropped_total counter',
+                'transwarp_log_dropped_total %d' % self.dropped]
+
+
+def setup(level=logging.INFO, handler=None, fmt=FORMAT, capacity=10000):
+    """
+    Send the root logger's records through a QueueHandler to handler (stderr by default).
+    Calling it again replaces the previous handler.
+    """
+    global _handler
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+        _handler.close()
+    else:
+        metrics.add_collector(lambda: _handler.prometheus_lines() if _handler else [])
+    if handler is None:
+        handler = logging.StreamHandler(sys.stderr)
+    if handler.formatter is None:
+        handler.setFormatter(logging.Formatter(fmt))
+    _handler = QueueHandler([handler], capacity)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    return _handler
@@ -0,0 +1,224 @@
+# encoding=utf-8
+"""
+Per-route request metrics.
+
+每个线程累加到自己的_Accumulator里，它的锁只有本线程和snapshot()使用，请求路径上不需要竞争全局锁；
+snapshot()把所有线程的数据合并到全局，空闲的线程的数据也不会漏掉。
+"""
+import time
+import bisect
+import threading
+
+import db
+
+
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_UNMATCHED = '<unmatched>'
+
+_lock = threading.Lock()
+_global = {}
+_local = threading.local()
+# 所有线程的_Accumulator，snapshot()时逐个合并
+_accumulators = []
+# 其他模块的指标，fn()返回Prometheus文本格式的行列表
+_collectors = []
+
+
+class _RouteStats(object):
+
+    __slots__ = ('count', 'latency', 'buckets', 'db_count', 'db_time', 'bytes_out', 'statuses')
+
+    def __init__(self):
+        self.count = 0
+        self.latency = 0.0
+        # 最后一个桶对应+Inf
+        self.buckets = [0] * (len(_BUCKETS) + 1)
+        self.db_count = 0
+        self.db_time = 0.0
+        self.bytes_out = 0
+        self.statuses = {}
+
+    def merge(self, other):
+        self.count += other.count
+        self.latency += other.latency
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.db_count += other.db_count
+        self.db_time += other.db_time
+        self.bytes_out += other.bytes_out
+        for code, n in other.statuses.iteritems():
+            self.statuses[code] = self.statuses.get(code, 0) + n
+
+
+def _on_query(sql, args, t):
+    _local.db_count = getattr(_local, 'db_count', 0) + 1
+    _local.db_time = getattr(_local, 'db_time', 0.0) + t
+
+
+def _begin():
+    _local.db_count = 0
+    _local.db_time = 0.0
+
+
+class _Accumulator(object):
+
+    __slots__ = ('stats', 'lock', 'thread')
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.thread = threading.current_thread()
+
+
+def _accumulator():
+    acc = getattr(_local, 'acc', None)
+    if acc is None:
+        acc = _local.acc = _Accumulator()
+        with _lock:
+            _accumulators.append(acc)
+    return acc
+
+
+def _merge_all():
+    with _lock:
+        for acc in _accumulators[:]:
+            with acc.lock:
+                stats, acc.stats = acc.stats, {}
+            for key, st in stats.iteritems():
+                g = _global.get(key)
+                if g is None:
+                    _global[key] = st
+                else:
+                    g.merge(st)
+            if not acc.thread.is_alive():
+                _accumulators.remove(acc)
+
+
+def _finish(env, status, start, bytes_out):
+    now = time.time()
+    t = now - start
+    route = env.get('transwarp.route')
+    key = (route.method, route.path) if route is not None else (env.get('REQUEST_METHOD'), _UNMATCHED)
+    acc = _accumulator()
+    with acc.lock:
+        st = acc.stats.get(key)
+        if st is None:
+            st = acc.stats[key] = _RouteStats()
+        st.count += 1
+        st.latency += t
+        st.buckets[bisect.bisect_left(_BUCKETS, t)] += 1
+        st.db_count += _local.db_count
+        st.db_time += _local.db_time
+        st.bytes_out += bytes_out
+        st.statuses[status] = st.statuses.get(status, 0) + 1
+
+
+def _counting(body, env, status, start):
+    n = 0
+    try:
+        for chunk in body:
+            n += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        _finish(env, status[0], start, n)
+
+
+def middleware(app):
+    """
+    Wrap a WSGI application to collect per-route metrics.
+    """
+    if _on_query not in db._query_hooks:
+        db._query_hooks.append(_on_query)
+
+    def _wsgi(env, start_response):
+        _begin()
+        start = time.time()
+        status = ['500']
+
+        def _start_response(s, headers, exc_info=None):
+            status[0] = s[:3]
+            if exc_info is None:
+                return start_response(s, headers)
+            return start_response(s, headers, exc_info)
+
+        body = app(env, _start_response)
+        if isinstance(body, list):
+            _finish(env, status[0], start, sum(len(x) for x in body))
+            return body
+        return _counting(body, env, status, start)
+    return _wsgi
+
+
+def snapshot():
+    """
+    Return metrics merged so far: {(method, path): Dict(...)}.
+    """
+    _merge_all()
+    with _lock:
+        L = {}
+        for key, st in _global.iteritems():
+            L[key] = db.Dict(count=st.count, latency=st.latency, buckets=zip(_BUCKETS + (float('inf'),), st.buckets),
+                             db_count=st.db_count, db_time=st.db_time, bytes_out=st.bytes_out, statuses=dict(st.statuses))
+        return L
+
+
+def reset():
+    global _global
+    with _lock:
+        _global = {}
+        for acc in _accumulators:
+            with acc.lock:
+                acc.stats = {}
+
+
+def add_collector(fn):
+    """
+    Add fn() -> list of lines to the Prometheus output.
+    """
+    if fn not in _collectors:
+        _collectors.append(fn)
+
+
+def _labels(method, path, **kw):
+    L = ['method="%s"' % method, 'route="%s"' % path.replace('\\', '\\\\').replace('"', '\\"')]
+    for k, v in sorted(kw.iteritems()):
+        L.append('%s="%s"' % (k, v))
+    return '{%s}' % ','.join(L)
+
+
+def prometheus_text():
+    """
+    Render metrics in Prometheus text exposition format.
+    """
+    snap = sorted(snapshot().iteritems())
+    L = []
+    L.append('# TYPE transwarp_requests_total counter')
+    for (method, path), st in snap:
+        L.append('transwarp_requests_total%s %d' % (_labels(method, path), st.count))
+    L.append('# TYPE transwarp_request_duration_seconds histogram')
+    for (method, path), st in snap:
+        acc = 0
+        for le, n in st.buckets:
+            acc += n
+            L.append('transwarp_request_duration_seconds_bucket%s %d' % (_labels(method, path, le='+Inf' if le == float('inf') else repr(le)), acc))
+        L.append('transwarp_request_duration_seconds_sum%s %r' % (_labels(method, path), st.latency))
+        L.append('transwarp_request_duration_seconds_count%s %d' % (_labels(method, path), st.count))
+    L.append('# TYPE transwarp_db_queries_total counter')
+    for (method, path), st in snap:
+        L.append('transwarp_db_queries_total%s %d' % (_labels(method, path), st.db_count))
+    L.append('# TYPE transwarp_db_seconds_total counter')
+    for (method, path), st in snap:
+        L.append('transwarp_db_seconds_total%s %r' % (_labels(method, path), st.db_time))
+    L.append('# TYPE transwarp_response_bytes_total counter')
+    for (method, path), st in snap:
+        L.append('transwarp_response_bytes_total%s %d' % (_labels(method, path), st.bytes_out))
+    L.append('# TYPE transwarp_responses_total counter')
+    for (method, path), st in snap:
+        for code, n in sorted(st.statuses.iteritems()):
+            L.append('transwarp_responses_total%s %d' % (_labels(method, path, code=code), n))
+    for fn in _collectors:
+        L.extend(fn())
+    L.append('')
+    return '\n'.join(L)
@@ -1,12 +1,68 @@
+# encoding=utf-8
+import re
 import time
+import hashlib
 import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
 import db
+import log
+import utils
 
 
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
 
-def _gen_sql(table_name, mappings):
+class Index(object):
+
+    """
+    A (composite) index declared in Model.__indexes__, e.g. Index('user_id', 'created_at').
+    Plain tuples of field names are accepted there too.
+    """
+
+    def __init__(self, *columns, **kw):
+        if not columns:
+            raise ValueError('Index needs at least one column.')
+        self.columns = tuple(columns)
+        self.unique = kw.get('unique', False)
+        self.name = kw.get('name', None)
+
+    def ddl(self):
+        return '%s `%s` (%s)' % ('unique key' if self.unique else 'key', self.name, ','.join('`%s`' % c for c in self.columns))
+
+    def __repr__(self):
+        return 'Index(%s%s)' % (', '.join(self.columns), ', unique' if self.unique else '')
+
+
+def _gen_indexes(table_name, mappings, declared):
+    L = []
+    for f in sorted(mappings.values(), key=lambda f: f._order):
+        if f.primary_key:
+            continue
+        if f.unique:
+            L.append(Index(f.name, unique=True))
+        elif f.index:
+            L.append(Index(f.name))
+    for idx in declared:
+        if not isinstance(idx, Index):
+            idx = Index(*idx)
+        for c in idx.columns:
+            if c not in mappings and c not in [f.name for f in mappings.itervalues()]:
+                raise TypeError('Index column "%s" is not a field of table: %s' % (c, table_name))
+        L.append(idx)
+    indexes, seen = [], set()
+    for idx in L:
+        if (idx.unique, idx.columns) in seen:
+            continue
+        seen.add((idx.unique, idx.columns))
+        if not idx.name:
+            idx.name = '%s_%s_%s' % ('uk' if idx.unique else 'idx', table_name, '_'.join(idx.columns))
+        indexes.append(idx)
+    return indexes
+
+
+def _gen_sql(table_name, mappings, indexes=()):
     pk = None
     sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
     for f in sorted(mappings.values(), lambda x, y: cmp(x._order, y._order)):
@@ -17,11 +73,82 @@ def _gen_sql(table_name, mappings):
         if f.primary_key:
             pk = f.name
         sql.append('  `%s` %s,' % (f.name, ddl) if nullable else '  `%s` %s not null,' % (f.name, ddl))
+    for idx in indexes:
+        sql.append('  %s,' % idx.ddl())
     sql.append('  primary key(`%s`)' % pk)
     sql.append(');')
     return '\n'.join(sql)
 
 
+def _gen_statements(table_name, fields, primary_key):
+    """
+    Precompute the SQL used by Model. fields is a list of (attr, Field) in declaration order.
+    """
+    columns = tuple(f.name for k, f in fields)
+    insert_columns = tuple(f.name for k, f in fields if f.insertable)
+    update_fields = tuple((k, f.name) for k, f in fields if f.updatable and not f.primary_key)
+    select_sql = 'select %s from `%s`' % (','.join('`%s`' % c for c in columns), table_name)
+    return dict(
+        __columns__=columns,
+        __insert_columns__=insert_columns,
+        __update_fields__=tuple(k for k, c in update_fields),
+        __update_sql__='update `%s` set %s where `%s`=?' % (table_name, ','.join('`%s`=?' % c for k, c in update_fields), primary_key.name) if update_fields else None,
+        __select_sql__=select_sql,
+        __get_sql__='%s where `%s`=?' % (select_sql, primary_key.name),
+        __insert_sql__='insert into `%s` (%s) values (%s)' % (table_name, ','.join('`%s`' % c for c in insert_columns), ','.join('?' * len(insert_columns))),
+        __delete_sql__='delete from `%s` where `%s`=?' % (table_name, primary_key.name),
+    )
+
+
+def _compile(name, source, namespace):
+    code = compile(source, '<orm %s>' % name, 'exec')
+    exec code in namespace
+    return namespace[name]
+
+
+def _gen_hydrate(cls, fields, slotted=False):
+    """
+    Generate __hydrate__(row): build a model from a row tuple in __columns__ order without calling __init__.
+    """
+    n = len(fields)
+    L = ['def __hydrate__(row):']
+    L.append('    %s, = row' % ', '.join('_%d' % i for i in xrange(n)))
+    L.append('    m = _new(_cls)')
+    for i, (k, f) in enumerate(fields):
+        if slotted:
+            L.append('    m.%s = _%d' % (k, i))
+        else:
+            L.append('    m[%r] = _%d' % (f.name, i))
+    L.append('    return m')
+    return _compile('__hydrate__', '\n'.join(L), dict(_new=object.__new__ if slotted else dict.__new__, _cls=cls))
+
+
+def _gen_dehydrate(fields, slotted=False):
+    """
+    Generate __dehydrate__(self): the tuple of insertable values in __insert_columns__ order,
+    filling missing attributes with the field default.
+    """
+    namespace = dict(_set=dict.setdefault)
+    L = ['def __dehydrate__(self):']
+    R = []
+    for i, (k, f) in enumerate(fields):
+        if not f.insertable:
+            continue
+        d = f._default
+        namespace['_d%d' % i] = d
+        default = '_d%d()' % i if callable(d) else '_d%d' % i
+        if slotted:
+            L.append('    try:')
+            L.append('        _%d = self.%s' % (i, k))
+            L.append('    except AttributeError:')
+            L.append('        _%d = self.%s = %s' % (i, k, default))
+            R.append('_%d' % i)
+        else:
+            R.append('self[%r] if %r in self else _set(self, %r, %s)' % (k, k, k, default))
+    L.append('    return (%s,)' % ', '.join(R))
+    return _compile('__dehydrate__', '\n'.join(L), namespace)
+
+
 class Field(object):
 
     _count = 0
@@ -34,6 +161,11 @@ class Field(object):
         self.updatable = kwargs.get('updatable', True)
         self.insertable = kwargs.get('insertable', True)
         self.ddl = kwargs.get('ddl', '')
+        self.index = kwargs.get('index', False)
+        self.unique = kwargs.get('unique', False)
+        # 冗余字段：copy_from='User.name', via='user_id'，由denorm模块在User更新后同步
+        self.copy_from = kwargs.get('copy_from', None)
+        self.via = kwargs.get('via', None)
         self._order = Field._count
         Field._count += 1
 
@@ -98,10 +230,192 @@ class TextField(Field):
         super(TextField, self).__init__(**kwargs)
 
 
+class ShardMap(object):
+
+    """
+    Map a shard key value to one of engines (made by db.make_engine()).
+    engines can be assigned after the model class is defined.
+    """
+
+    def __init__(self, engines=(), hash_fn=None):
+        self.engines = list(engines)
+        # crc32是线性的，末位相邻的key(b0, b1, ...)会落在同一个分片上，所以用md5
+        self._hash = hash_fn or (lambda key: int(hashlib.md5(utils._to_str(key)).hexdigest()[:8], 16))
+
+    def engine_for(self, key):
+        if not self.engines:
+            raise db.DBError('ShardMap has no engines.')
+        return self.engines[self._hash(key) % len(self.engines)]
+
+
+_shard_pool = None
+_shard_pool_lock = threading.Lock()
+_SHARD_POOL_SIZE = 8
+
+
+def _get_shard_pool():
+    global _shard_pool
+    if _shard_pool is None:
+        with _shard_pool_lock:
+            if _shard_pool is None:
+                _shard_pool = ThreadPool(_SHARD_POOL_SIZE)
+    return _shard_pool
+
+
+def _fan_out(calls):
+    """
+    calls: list of (engine, fn). 在线程池里并行执行，每个fn在自己engine的连接上运行。
+    """
+    deadline = db.get_deadline()
+    request_id = log.get_request_id()
+
+    def _run(call):
+        e, fn = call
+        # 线程池里的线程继承调用者的请求截止时间和日志里的request id
+        saved = db.get_deadline()
+        saved_id = log.get_request_id()
+        db.set_deadline(deadline)
+        log.set_request_id(request_id)
+        try:
+            with db.using(e):
+                return fn()
+        finally:
+            # 只有一个分片时_run在调用者的线程上执行，要恢复原来的值而不是清空
+            db.set_deadline(saved)
+            log.set_request_id(saved_id)
+    if len(calls) == 1:
+        return [_run(calls[0])]
+    return _get_shard_pool().map(_run, calls)
+
+
+# 所有Model子类，按类名注册，ForeignKey('User')这样的前向引用用它来解析
+_models = {}
+# 目标类还没定义时先记下反向关系，等目标类创建时再加上
+_pending_reverse = {}
+
+
+def _resolve(target):
+    if isinstance(target, basestring):
+        try:
+            return _models[target]
+        except KeyError:
+            raise TypeError('Unknown model: %s' % target)
+    return target
+
+
+class ForeignKey(Field):
+
+    """
+    A column referencing another model's primary key, e.g. Comment.blog_id = ForeignKey(Blog, reverse='comments').
+    Defines a relation named after the attribute without "_id" (or relation=...), and optionally a
+    one-to-many relation called reverse on the target. target may be a class or a class name.
+    """
+
+    def __init__(self, target, **kwargs):
+        self._target = target
+        self.relation = kwargs.pop('relation', None)
+        self.reverse = kwargs.pop('reverse', None)
+        if 'default' not in kwargs:
+            kwargs['default'] = ''
+        if 'ddl' not in kwargs:
+            kwargs['ddl'] = target.__primary_key__.ddl if isinstance(target, type) else 'varchar(50)'
+        if 'index' not in kwargs:
+            kwargs['index'] = True
+        super(ForeignKey, self).__init__(**kwargs)
+
+    @property
+    def target(self):
+        return _resolve(self._target)
+
+
+class _Relation(object):
+
+    """
+    many=False: local attr holds the target's primary key (many-to-one).
+    many=True: target's remote attr holds our primary key (one-to-many).
+    """
+
+    def __init__(self, name, target, attr, many):
+        self.name = name
+        self._target = target
+        self.attr = attr
+        self.many = many
+
+    @property
+    def target(self):
+        return _resolve(self._target)
+
+    def __repr__(self):
+        target = getattr(self._target, '__name__', self._target)
+        if self.many:
+            return '_Relation(%s: %s.%s)' % (self.name, target, self.attr)
+        return '_Relation(%s: %s -> %s)' % (self.name, self.attr, target)
+
+
+def _set_related(obj, name, value):
+    if isinstance(obj, dict):
+        obj[name] = value
+        return
+    try:
+        related = obj._related
+    except AttributeError:
+        related = obj._related = {}
+    related[name] = value
+
+
+# IN列表过长时分批查询
+_PREFETCH_CHUNK = 1000
+
+
+def _load_relation(rel, objs):
+    """
+    Load rel for all objs with batched IN queries, attach the results and return the loaded objects.
+    """
+    target = rel.target
+    if not rel.many:
+        keys = []
+        seen = set()
+        for o in objs:
+            k = getattr(o, rel.attr, None)
+            if k and k not in seen:
+                seen.add(k)
+                keys.append(k)
+        loaded = []
+        for i in xrange(0, len(keys), _PREFETCH_CHUNK):
+            loaded.extend(target.get_many(keys[i:i + _PREFETCH_CHUNK]))
+        pk = target.__primary_key__.name
+        found = dict((getattr(t, pk), t) for t in loaded)
+        for o in objs:
+            _set_related(o, rel.name, found.get(getattr(o, rel.attr, None)))
+        return loaded
+    pk = objs[0].__primary_key__.name
+    keys = list(set(getattr(o, pk) for o in objs))
+    loaded = []
+    for i in xrange(0, len(keys), _PREFETCH_CHUNK):
+        chunk = keys[i:i + _PREFETCH_CHUNK]
+        loaded.extend(target.find_by('where `%s` in (%s)' % (target.__mappings__[rel.attr].name, ','.join(['?'] * len(chunk))), *chunk))
+    groups = {}
+    for t in loaded:
+        groups.setdefault(getattr(t, rel.attr), []).append(t)
+    for o in objs:
+        _set_related(o, rel.name, groups.get(getattr(o, pk), []))
+    return loaded
+
+
+def _prefetch(cls, objs, tree):
+    for name, sub in tree.iteritems():
+        rel = cls.__relations__.get(name)
+        if rel is None:
+            raise AttributeError('%s has no relation "%s"' % (cls.__name__, name))
+        loaded = _load_relation(rel, objs)
+        if sub and loaded:
+            _prefetch(rel.target, loaded, sub)
+
+
 class ModelMetaClass(type):
 
     def __new__(cls, name, bases, attrs):
-        if name == 'Model':
+        if name in ('Model', 'SlotModel'):
             return type.__new__(cls, name, bases, attrs)
 
         if not hasattr(cls, 'subclasses'):
@@ -109,9 +423,9 @@ class ModelMetaClass(type):
         if name not in cls.subclasses:
             cls.subclasses[name] = name
         else:
-            logging.warning('Redefine class: %s' % name)
+            logging.warning('Redefine class: %s', name)
 
-        logging.info('Scan ORMapping %s...' % name)
+        logging.info('Scan ORMapping %s...', name)
 
         mappings = dict()
         primary_key = None
@@ -119,7 +433,7 @@ class ModelMetaClass(type):
             if isinstance(v, Field):
                 if not v.name:
                     v.name = k
-                logging.info('[MAPPING] Found mapping: %s => %s' % (k, v))
+                logging.debug('[MAPPING] Found mapping: %s => %s', k, v)
                 # check duplicate primary key:
                 if v.primary_key:
                     if primary_key:
@@ -143,17 +457,264 @@ class ModelMetaClass(type):
         if '__table__' not in attrs:
             attrs['__table__'] = name.lower()
 
+        relations = {}
+        for k, v in mappings.iteritems():
+            if isinstance(v, ForeignKey):
+                rel_name = v.relation or (k[:-3] if k.endswith('_id') else '%s_obj' % k)
+                relations[rel_name] = _Relation(rel_name, v._target, k, False)
+                if v.reverse:
+                    reverse = _Relation(v.reverse, name, k, True)
+                    target = v._target if isinstance(v._target, type) else _models.get(v._target)
+                    if target is None:
+                        _pending_reverse.setdefault(v._target, []).append(reverse)
+                    else:
+                        target.__relations__[v.reverse] = reverse
+        for reverse in _pending_reverse.pop(name, []):
+            relations[reverse.name] = reverse
+        attrs['__relations__'] = relations
+
+        for k, v in mappings.iteritems():
+            if v.copy_from:
+                if '.' not in v.copy_from or not v.via:
+                    raise TypeError('%s.%s: copy_from must be "Model.field" and via must be set.' % (name, k))
+                if v.via not in mappings:
+                    raise TypeError('%s.%s: via "%s" is not a field.' % (name, k, v.via))
+
+        shard_key = attrs.get('__shard_key__')
+        if shard_key is not None and shard_key not in mappings:
+            raise TypeError('Shard key "%s" is not a field of class: %s' % (shard_key, name))
+
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
-        attrs['__sql__'] = _gen_sql(attrs['__table__'], mappings)
+        attrs['__index_list__'] = _gen_indexes(attrs['__table__'], mappings, attrs.get('__indexes__', ()))
+        attrs['__sql__'] = _gen_sql(attrs['__table__'], mappings, attrs['__index_list__'])
+
+        # 类创建时就生成好SQL和行<->对象的转换函数，每行的ORM开销只剩几个tuple操作
+        fields = sorted(mappings.iteritems(), key=lambda kv: kv[1]._order)
+        attrs.update(_gen_statements(attrs['__table__'], fields, primary_key))
+        slotted = any(getattr(b, '__slotted__', False) for b in bases)
+        attrs['__fields__'] = tuple(k for k, f in fields)
+        if slotted:
+            # _related存放prefetch加载的关联对象
+            attrs['__slots__'] = attrs['__fields__'] + ('_related',)
+        attrs['__dehydrate__'] = _gen_dehydrate(fields, slotted)
 
         for trigger in _triggers:
             if trigger not in attrs:
                 attrs[trigger] = None
-        return type.__new__(cls, name, bases, attrs)
+        new_cls = type.__new__(cls, name, bases, attrs)
+        new_cls.__hydrate__ = staticmethod(_gen_hydrate(new_cls, fields, slotted))
+        _models[name] = new_cls
+        return new_cls
+
+
+# 写操作完成后调用 hook(event, model, rowcount)，event是'insert'、'update'或'delete'，
+# rowcount是受影响的行数(0表示行不存在或者值没有变化)，和写操作在同一个事务里
+# (分片的Model除外：分片上的写操作在分片自己的连接上)
+_write_hooks = []
+
+
+def add_write_hook(fn):
+    if fn not in _write_hooks:
+        _write_hooks.append(fn)
+
+
+def remove_write_hook(fn):
+    if fn in _write_hooks:
+        _write_hooks.remove(fn)
+
+
+def _fire_write_hooks(event, obj, rowcount):
+    for hook in _write_hooks:
+        hook(event, obj, rowcount)
+
+
+_check_indexes = False
+_checked_wheres = set()
+_RE_WHERE = re.compile(r'\bwhere\b(.*?)(?:\border\s+by\b|\bgroup\s+by\b|\blimit\b|$)', re.I | re.S)
+_RE_WHERE_COLUMN = re.compile(r'`?(\w+)`?\s*(?:=|<>|!=|<=|>=|<|>|\bin\b|\blike\b|\bbetween\b|\bis\b)', re.I)
+
+
+def enable_index_check(enabled=True):
+    """
+    Warn once per query pattern when find_by/count_by filter only on columns no index starts with.
+    """
+    global _check_indexes
+    _check_indexes = enabled
+
 
+def _check_where(cls, where):
+    key = (cls, where)
+    if key in _checked_wheres:
+        return
+    _checked_wheres.add(key)
+    m = _RE_WHERE.search(where)
+    if not m:
+        return
+    columns = [c for c in _RE_WHERE_COLUMN.findall(m.group(1)) if c in cls.__columns__]
+    # MySQL只能用索引的最左列来过滤
+    indexed = set([cls.__primary_key__.name] + [idx.columns[0] for idx in cls.__index_list__])
+    if columns and not [c for c in columns if c in indexed]:
+        logging.warning('[INDEX] %s filters on unindexed column(s) %s: %s', cls.__name__, ', '.join(columns), where)
 
-class Model(dict):
+
+class _ModelBase(object):
+
+    """
+    ORM methods shared by Model and SlotModel, working on the precomputed SQL and __hydrate__/__dehydrate__.
+    """
+
+    __slots__ = ()
+
+    # 分片：__shard_key__是字段名，__shards__是ShardMap。没有设置__shards__时使用全局engine
+    __shard_key__ = None
+    __shards__ = None
+
+    @classmethod
+    def _on_shards(cls, fn, shard_key=None):
+        """
+        Run fn on the shard owning shard_key, or on every shard when shard_key is None.
+        Returns a list with one result per shard queried.
+        """
+        if cls.__shards__ is None:
+            return [fn()]
+        if shard_key is not None:
+            with db.using(cls.__shards__.engine_for(shard_key)):
+                return [fn()]
+        return _fan_out([(e, fn) for e in cls.__shards__.engines])
+
+    @classmethod
+    def _sharded_by_pk(cls):
+        return cls.__shard_key__ == cls.__primary_key__.name
+
+    @classmethod
+    def get(cls, pk):
+        sql = cls.__get_sql__
+        shard_key = pk if cls._sharded_by_pk() else None
+        for row in cls._on_shards(lambda: db.select_row(sql, pk), shard_key):
+            if row:
+                return cls.__hydrate__(row)
+        return None
+
+    @classmethod
+    def get_many(cls, pks, **kw):
+        """
+        Get models by a list of primary keys, in the order of pks; missing rows are skipped.
+        Sharded models query the owning shards in parallel. prefetch=(...) is passed to prefetch().
+        """
+        pks = list(pks)
+        if not pks:
+            return []
+        pk_index = cls.__columns__.index(cls.__primary_key__.name)
+
+        def _query(keys):
+            sql = '%s where `%s` in (%s)' % (cls.__select_sql__, cls.__primary_key__.name, ','.join(['?'] * len(keys)))
+            return lambda: db.select_rows(sql, *keys)
+
+        if cls.__shards__ is not None and cls._sharded_by_pk():
+            groups = {}
+            for pk in pks:
+                groups.setdefault(cls.__shards__.engine_for(pk), []).append(pk)
+            results = _fan_out([(e, _query(keys)) for e, keys in groups.iteritems()])
+        else:
+            results = cls._on_shards(_query(pks))
+        rows = {}
+        for L in results:
+            for row in L:
+                rows[row[pk_index]] = row
+        hydrate = cls.__hydrate__
+        L = [hydrate(rows[pk]) for pk in pks if pk in rows]
+        if 'prefetch' in kw:
+            cls.prefetch(L, *kw['prefetch'])
+        return L
+
+    @classmethod
+    def find_by(cls, where, *args, **kw):
+        """
+        Find models by where clause, pass shard_key=... to query a single shard
+        and prefetch=(...) to load relations, see prefetch().
+        """
+        if _check_indexes:
+            _check_where(cls, where)
+        sql = '%s %s' % (cls.__select_sql__, where)
+        hydrate = cls.__hydrate__
+        L = []
+        for rows in cls._on_shards(lambda: db.select_rows(sql, *args), kw.get('shard_key')):
+            L.extend([hydrate(row) for row in rows])
+        if 'prefetch' in kw:
+            cls.prefetch(L, *kw['prefetch'])
+        return L
+
+    @classmethod
+    def prefetch(cls, objs, *paths):
+        """
+        Load relations for objs with one batched IN query per relation level and attach them,
+        e.g. Blog.prefetch(blogs, 'user', 'comments', 'comments__user').
+        """
+        if not objs:
+            return objs
+        tree = {}
+        for path in paths:
+            node = tree
+            for part in path.split('__'):
+                node = node.setdefault(part, {})
+        _prefetch(cls, objs, tree)
+        return objs
+
+    @classmethod
+    def count_by(cls, where, *args, **kw):
+        """
+        Count rows by where clause, summed over shards unless shard_key=... is given.
+        """
+        if _check_indexes:
+            _check_where(cls, where)
+        sql = 'select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where)
+        return sum(cls._on_shards(lambda: db.select_int(sql, *args), kw.get('shard_key')))
+
+    def _shard_key_value(self):
+        if self.__shards__ is None:
+            return None
+        return getattr(self, self.__shard_key__)
+
+    def _write(self, event, sql, args):
+        def _run():
+            rowcount = 0
+            if sql:
+                rowcount = sum(self._on_shards(lambda: db.update(sql, *args), self._shard_key_value()))
+            _fire_write_hooks(event, self, rowcount)
+        if not _write_hooks:
+            if sql:
+                self._on_shards(lambda: db.update(sql, *args), self._shard_key_value())
+        elif db.in_transaction():
+            _run()
+        else:
+            # 钩子里的写操作(计数器等)和这一行在同一个事务里提交或回滚
+            with db.transaction():
+                _run()
+
+    def insert(self):
+        self.pre_insert and self.pre_insert()
+        self._write('insert', self.__insert_sql__, self.__dehydrate__())
+        return self
+
+    def update(self):
+        self.pre_update and self.pre_update()
+        args = [getattr(self, k) for k in self.__update_fields__]
+        args.append(getattr(self, self.__primary_key__.name))
+        self._write('update', self.__update_sql__, args)
+        return self
+
+    def delete(self):
+        self.pre_delete and self.pre_delete()
+        self._write('delete', self.__delete_sql__, (getattr(self, self.__primary_key__.name),))
+        return self
+
+    @classmethod
+    def count_all(cls):
+        return cls.count_by('')
+
+
+class Model(_ModelBase, dict):
     __metaclass__ = ModelMetaClass
 
     def __init__(self, **kwargs):
@@ -168,33 +729,64 @@ class Model(dict):
     def __setattr__(self, key, value):
         self[key] = value
 
-    @classmethod
-    def get(cls, pk):
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
 
-    def insert(self):
-        self.pre_insert and self.pre_insert()
-        params = {}
-        for k, v in self.__mappings__.iteritems():
-            if v.insertable:
-                if not hasattr(self, k):
-                    setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
-        db.insert('%s' % self.__table__, **params)
-        return self
+class SlotModel(_ModelBase):
 
-    def delete(self):
-        self.pre_delete and self.pre_delete()
+    """
+    Opt-in alternative to Model: fields are stored in __slots__ generated from __mappings__,
+    giving plain attribute access and much smaller instances. to_dict() gives a dict view for serialization.
+    """
 
-        pk = self.__primary_key__.name
-        args = (getattr(self, pk),)
-        db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
-        return self
+    __metaclass__ = ModelMetaClass
+    __slots__ = ()
+    __slotted__ = True
 
-    @classmethod
-    def count_all(cls):
-        return db.select('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+    def __init__(self, **kwargs):
+        for k, v in kwargs.iteritems():
+            setattr(self, k, v)
+
+    def __getattr__(self, key):
+        # 只有正常的属性查找失败时才会调用，用来访问prefetch加载的关联对象
+        try:
+            return object.__getattribute__(self, '_related')[key]
+        except (AttributeError, KeyError):
+            raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, key))
+
+    def to_dict(self):
+        d = {}
+        for k in self.__fields__:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        try:
+            d.update(self._related)
+        except AttributeError:
+            pass
+        return d
+
+    __json__ = to_dict
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % kv for kv in sorted(self.to_dict().iteritems())))
 
 
 if __name__ == '__main__':
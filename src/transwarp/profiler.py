@@ -0,0 +1,202 @@
+# encoding=utf-8
+"""
+Opt-in sampling profiler for production requests.
+
+只对被采样的请求做profiling，未采样的请求只多一次计数和一次dict查找。
+结果按Route聚合，输出为flamegraph.pl可以直接使用的collapsed stack格式。
+"""
+import os
+import re
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import itertools
+
+
+def _drain(body):
+    try:
+        return list(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+class _StackSampler(object):
+
+    """
+    后台线程定期读取sys._current_frames()，只记录正在被profile的线程。
+    """
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    t = threading.Thread(target=self._run, name='transwarp-profiler')
+                    t.daemon = True
+                    t.start()
+                    self._thread = t
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                active = self._active.items()
+                if not active:
+                    self._wakeup.clear()
+                    continue
+            frames = sys._current_frames()
+            samples = []
+            for tid, stacks in active:
+                f = frames.get(tid)
+                if f is None:
+                    continue
+                L = []
+                while f is not None:
+                    code = f.f_code
+                    L.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    f = f.f_back
+                L.reverse()
+                samples.append((tid, stacks, ';'.join(L)))
+            del frames
+            # 在锁里写入，并且只写仍在profile的请求：stop()之后stacks交给_record遍历，不能再改
+            with self._lock:
+                for tid, stacks, key in samples:
+                    if self._active.get(tid) is stacks:
+                        stacks[key] = stacks.get(key, 0) + 1
+
+    def start(self):
+        self._ensure_started()
+        stacks = {}
+        with self._lock:
+            self._active[threading.current_thread().ident] = stacks
+            self._wakeup.set()
+        return stacks
+
+    def stop(self):
+        with self._lock:
+            return self._active.pop(threading.current_thread().ident, {})
+
+
+_RE_UNSAFE = re.compile(r'[^\w\-]+')
+
+
+class Profiler(object):
+
+    """
+    Profile 1 in sample_rate requests, plus requests whose path matches one of paths (regex)
+    or that carry the given header (disabled by default). When header is set, secret is required
+    and the header value must equal it. mode is 'sampler' (collapsed stacks) or 'cprofile'.
+    """
+
+    def __init__(self, sample_rate=100, paths=(), header=None, secret=None, mode='sampler', output_dir=None, interval=0.001):
+        if mode not in ('sampler', 'cprofile'):
+            raise ValueError('Bad profiler mode: %s' % mode)
+        if header and not secret:
+            # 否则任何客户端都能让自己的请求被profile
+            raise ValueError('Profile header requires a secret.')
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.output_dir = output_dir
+        self._paths = [re.compile(p) for p in paths]
+        self._header = 'HTTP_%s' % header.upper().replace('-', '_') if header else None
+        self._secret = secret
+        self._counter = itertools.count(1)
+        self._sampler = _StackSampler(interval) if mode == 'sampler' else None
+        self._lock = threading.Lock()
+        # {(method, path): {stack: count}} 或 {(method, path): pstats.Stats}
+        self._results = {}
+
+    def should_profile(self, env):
+        if self.sample_rate and next(self._counter) % self.sample_rate == 0:
+            return True
+        if self._header and env.get(self._header) == self._secret:
+            return True
+        if self._paths:
+            path = env.get('PATH_INFO', '')
+            for p in self._paths:
+                if p.match(path):
+                    return True
+        return False
+
+    def _record(self, env, data):
+        route = env.get('transwarp.route')
+        key = (route.method, route.path) if route is not None else (env.get('REQUEST_METHOD'), '<unmatched>')
+        with self._lock:
+            if self.mode == 'sampler':
+                stacks = self._results.setdefault(key, {})
+                for k, n in data.iteritems():
+                    stacks[k] = stacks.get(k, 0) + n
+            else:
+                st = self._results.get(key)
+                if st is None:
+                    self._results[key] = pstats.Stats(data)
+                else:
+                    st.add(data)
+        if self.output_dir:
+            self.dump(self.output_dir, key)
+
+    def middleware(self, app):
+
+        def _wsgi(env, start_response):
+            if not self.should_profile(env):
+                return app(env, start_response)
+            if self.mode == 'sampler':
+                self._sampler.start()
+                try:
+                    # 把响应体读完，这样模板的流式渲染也算在内
+                    return _drain(app(env, start_response))
+                finally:
+                    self._record(env, self._sampler.stop())
+            prof = cProfile.Profile()
+            prof.enable()
+            try:
+                return _drain(app(env, start_response))
+            finally:
+                prof.disable()
+                self._record(env, prof)
+        return _wsgi
+
+    def collapsed(self):
+        """
+        Return all sampled stacks as collapsed text, each stack prefixed by its route.
+        """
+        if self.mode != 'sampler':
+            raise ValueError('Collapsed stacks are only available in sampler mode.')
+        L = []
+        with self._lock:
+            for (method, path), stacks in sorted(self._results.iteritems()):
+                for stack, n in sorted(stacks.iteritems()):
+                    L.append('%s %s;%s %d' % (method, path, stack, n))
+        L.append('')
+        return '\n'.join(L)
+
+    def dump(self, directory, key=None):
+        """
+        Write one file per route: <method>_<path>.collapsed, or .prof (pstats) in cprofile mode.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._lock:
+            items = [(key, self._results[key])] if key else self._results.items()
+            for (method, path), data in items:
+                name = os.path.join(directory, '%s_%s' % (method, _RE_UNSAFE.sub('_', path).strip('_') or 'root'))
+                if self.mode == 'sampler':
+                    with open(name + '.collapsed', 'w') as f:
+                        for stack, n in sorted(data.iteritems()):
+                            f.write('%s %d\n' % (stack, n))
+                else:
+                    data.dump_stats(name + '.prof')
+
+    def reset(self):
+        with self._lock:
+            self._results = {}
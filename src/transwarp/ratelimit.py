@@ -0,0 +1,222 @@
+# encoding=utf-8
+"""
+Admission control: token-bucket rate limits and load shedding, installed as an interceptor.
+
+    ac = ratelimit.AdmissionControl(max_concurrent=32, max_queue_time=2.0)
+    ac.limit('/api/search', rate=20, burst=40)
+    ac.limit('/api/', rate=5, burst=10, per_client=True)
+    ac.priority('/static/', 'critical')
+    ac.priority('/api/search', 'low')
+    app.add_interceptor(ac.interceptor())
+
+超过速率限制返回429，过载时返回503，两者都带Retry-After。
+过载的判断有两个信号：正在处理的请求数(多线程server)，以及前端代理在X-Request-Start里记录的排队时间
+(单线程的wsgiref server请求只能排队，只有这个信号有效)。优先级越低，越早被拒绝，
+这样过载时廉价的路由还能继续服务，昂贵的路由先被丢弃。
+"""
+import math
+import time
+import threading
+from collections import OrderedDict
+
+import db
+import metrics
+from web import ctx, interceptor, HttpError, _build_pattern_fn
+
+
+# 各优先级可以使用的容量比例
+PRIORITIES = dict(critical=1.0, high=0.9, normal=0.75, low=0.5)
+
+
+class TokenBucket(object):
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'last')
+
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.last = time.time() if now is None else now
+
+    def wait(self, now):
+        """
+        Refill the bucket, return 0 if a token is available, otherwise the seconds until one is.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1.0:
+            return 0
+        return (1.0 - self.tokens) / self.rate
+
+    def take(self, now):
+        """
+        Take one token. Return 0 if granted, otherwise the seconds until a token is available.
+
+        >>> b = TokenBucket(1, burst=2, now=100.0)
+        >>> b.take(100.0), b.take(100.0), b.take(100.0), b.take(101.0)
+        (0, 0, 1.0, 0)
+        """
+        w = self.wait(now)
+        if not w:
+            self.tokens -= 1.0
+        return w
+
+
+class _Rule(object):
+
+    def __init__(self, pattern, rate, burst, per_client, max_clients):
+        self.pattern = pattern
+        self.match = _build_pattern_fn(pattern)
+        self.rate = rate
+        self.burst = burst
+        self.per_client = per_client
+        self.max_clients = max_clients
+        self.bucket = None if per_client else TokenBucket(rate, burst)
+        # remote_addr -> TokenBucket，按最近访问排序，超过max_clients时丢掉最久没访问的
+        self.clients = OrderedDict()
+        self.limited = 0
+
+    def bucket_for(self, client, now):
+        if not self.per_client:
+            return self.bucket
+        b = self.clients.pop(client, None)
+        if b is None:
+            b = TokenBucket(self.rate, self.burst, now)
+            if len(self.clients) >= self.max_clients:
+                self.clients.popitem(last=False)
+        self.clients[client] = b
+        return b
+
+
+def _queue_time(env, now):
+    """
+    Seconds the request waited before reaching us, from X-Request-Start ('t=1400000000.123', s/ms/us).
+
+    >>> _queue_time({'HTTP_X_REQUEST_START': 't=1400000000500'}, 1400000001.0)
+    0.5
+    >>> _queue_time({}, 1400000001.0)
+    0.0
+    """
+    v = env.get('HTTP_X_REQUEST_START')
+    if not v:
+        return 0.0
+    try:
+        t = float(v[2:] if v.startswith('t=') else v)
+    except ValueError:
+        return 0.0
+    if t > 1e14:
+        t /= 1e6
+    elif t > 1e11:
+        t /= 1e3
+    return max(0.0, now - t)
+
+
+class AdmissionControl(object):
+
+    def __init__(self, max_concurrent=None, max_queue_time=None, retry_after=1, max_clients=10000):
+        self.max_concurrent = max_concurrent
+        self.max_queue_time = max_queue_time
+        self.retry_after = retry_after
+        self.max_clients = max_clients
+        self._rules = []
+        self._priorities = []
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.admitted = 0
+        self.shed = dict((level, 0) for level in PRIORITIES)
+
+    def limit(self, pattern, rate, burst=None, per_client=False):
+        """
+        Allow rate requests per second (bursts up to burst) for paths matching pattern,
+        counted per Request.remote_addr if per_client is True.
+        """
+        self._rules.append(_Rule(pattern, rate, burst, per_client, self.max_clients))
+        return self
+
+    def priority(self, pattern, level):
+        """
+        Set the priority class of paths matching pattern: critical, high, normal (default) or low.
+        The first matching pattern wins.
+        """
+        if level not in PRIORITIES:
+            raise ValueError('Invalid priority: %s' % level)
+        self._priorities.append((_build_pattern_fn(pattern), level))
+        return self
+
+    def _level(self, path):
+        for match, level in self._priorities:
+            if match(path):
+                return level
+        return 'normal'
+
+    def admit(self, path, client, env):
+        """
+        Count a request in, or raise 429/503. Call release() when it is done.
+        """
+        now = time.time()
+        level = self._level(path)
+        share = PRIORITIES[level]
+        with self._lock:
+            if self.max_queue_time and _queue_time(env, now) > self.max_queue_time * share:
+                self.shed[level] += 1
+                raise HttpError.serviceunavailable(self.retry_after)
+            if self.max_concurrent and self.in_flight >= self.max_concurrent * share:
+                self.shed[level] += 1
+                raise HttpError.serviceunavailable(self.retry_after)
+            # 先检查所有匹配的桶，全部允许才一起扣令牌：被某条规则拒绝的请求不消耗其他规则的配额
+            buckets = [(rule, rule.bucket_for(client, now)) for rule in self._rules if rule.match(path)]
+            wait = 0
+            for rule, b in buckets:
+                w = b.wait(now)
+                if w:
+                    rule.limited += 1
+                    wait = max(wait, w)
+            if wait:
+                raise HttpError.toomanyrequests(math.ceil(wait))
+            for rule, b in buckets:
+                b.tokens -= 1.0
+            self.in_flight += 1
+            self.admitted += 1
+            if self.in_flight > self.peak:
+                self.peak = self.in_flight
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return db.Dict(in_flight=self.in_flight, peak=self.peak, admitted=self.admitted, shed=dict(self.shed),
+                           limited=dict((r.pattern, r.limited) for r in self._rules))
+
+    def prometheus_lines(self):
+        st = self.stats()
+        L = ['# TYPE transwarp_admission_in_flight gauge',
+             'transwarp_admission_in_flight %d' % st.in_flight,
+             '# TYPE transwarp_admission_admitted_total counter',
+             'transwarp_admission_admitted_total %d' % st.admitted,
+             '# TYPE transwarp_admission_shed_total counter']
+        for level, n in sorted(st.shed.iteritems()):
+            L.append('transwarp_admission_shed_total{priority="%s"} %d' % (level, n))
+        L.append('# TYPE transwarp_admission_limited_total counter')
+        for pattern, n in sorted(st.limited.iteritems()):
+            L.append('transwarp_admission_limited_total{pattern="%s"} %d' % (pattern.replace('"', '\\"'), n))
+        return L
+
+    def interceptor(self, pattern='/'):
+        """
+        Return the admission interceptor; add it first so rejected requests do no other work.
+        The counters are also published by the metrics endpoint.
+        """
+        metrics.add_collector(self.prometheus_lines)
+
+        @interceptor(pattern)
+        def _admission_interceptor(next):
+            request = ctx.request
+            self.admit(request.path_info, request.remote_addr, request.environ)
+            try:
+                return next()
+            finally:
+                self.release()
+        return _admission_interceptor
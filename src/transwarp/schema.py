@@ -0,0 +1,136 @@
+# encoding=utf-8
+"""
+Schema inspection, diff and migration for ORM models.
+
+对比Model声明的表结构和information_schema里的实际结构，生成ALTER语句。
+同一张表的改动合并成一条ALTER，并尽量使用ALGORITHM=INPLACE, LOCK=NONE，避免锁表。
+"""
+import re
+import logging
+
+import db
+
+
+_ONLINE = 'algorithm=inplace, lock=none'
+
+_TYPE_ALIASES = {
+    'real': 'double',
+    'bool': 'tinyint(1)',
+    'boolean': 'tinyint(1)',
+    'integer': 'int',
+}
+_RE_INT_WIDTH = re.compile(r'^((?:tiny|small|medium|big)?int)\(\d+\)')
+
+
+def _normalize_type(t):
+    t = t.strip().lower()
+    t = _TYPE_ALIASES.get(t, t)
+    if t == 'tinyint(1)':
+        return t
+    # MySQL 8去掉了整数类型的显示宽度，比较时忽略
+    return _RE_INT_WIDTH.sub(r'\1', t)
+
+
+def inspect(table):
+    """
+    Read the live schema of table: Dict(exists, columns={name: (type, nullable)}, indexes={name: (unique, columns)}).
+    """
+    # 在事务里读，走primary：replica可能还没有执行最近的DDL，diff()会生成重复的语句
+    with db.transaction():
+        return _inspect(table)
+
+
+def _inspect(table):
+    rows = db.select('select column_name, column_type, is_nullable from information_schema.columns '
+                     'where table_schema=database() and table_name=? order by ordinal_position', table)
+    if not rows:
+        return db.Dict(exists=False, columns={}, indexes={})
+    columns = {}
+    for r in rows:
+        d = dict((k.lower(), v) for k, v in r.iteritems())
+        columns[d['column_name']] = (d['column_type'], d['is_nullable'] == 'YES')
+    indexes = {}
+    for r in db.select('select index_name, non_unique, column_name from information_schema.statistics '
+                       'where table_schema=database() and table_name=? order by index_name, seq_in_index', table):
+        d = dict((k.lower(), v) for k, v in r.iteritems())
+        if d['index_name'] == 'PRIMARY':
+            continue
+        unique, cols = indexes.get(d['index_name'], (not int(d['non_unique']), ()))
+        indexes[d['index_name']] = (unique, cols + (d['column_name'],))
+    return db.Dict(exists=True, columns=columns, indexes=indexes)
+
+
+def diff(model, live=None, drop=False, modify=False):
+    """
+    Return the DDL statements that bring the live table in line with model.
+    Columns and indexes missing from the model are only dropped with drop=True,
+    changed column types are only modified with modify=True (both rebuild or lock the table on MySQL).
+    """
+    table = model.__table__
+    if live is None:
+        live = inspect(table)
+    if not live.exists:
+        return [model.__sql__.split('\n', 1)[1]]
+    fields = sorted(model.__mappings__.values(), key=lambda f: f._order)
+    changes = []
+    online = True
+    for f in fields:
+        col = '`%s` %s%s' % (f.name, f.ddl, '' if f.nullable else ' not null')
+        if f.name not in live.columns:
+            changes.append('add column %s' % col)
+            continue
+        live_type, live_nullable = live.columns[f.name]
+        if _normalize_type(live_type) != _normalize_type(f.ddl) or live_nullable != f.nullable:
+            if modify:
+                changes.append('modify column %s' % col)
+                online = False
+            else:
+                logging.warning('[SCHEMA] %s.%s is %s%s in db but %s%s in model, pass modify=True to change it.', table, f.name,
+                                live_type, '' if live_nullable else ' not null', f.ddl, '' if f.nullable else ' not null')
+    if drop:
+        names = set(f.name for f in fields)
+        for c in live.columns:
+            if c not in names:
+                changes.append('drop column `%s`' % c)
+                online = False
+    live_by_columns = dict(((unique, cols), name) for name, (unique, cols) in live.indexes.iteritems())
+    wanted = set()
+    for idx in model.__index_list__:
+        wanted.add((idx.unique, idx.columns))
+        if (idx.unique, idx.columns) not in live_by_columns:
+            changes.append('add %s' % idx.ddl())
+    if drop:
+        for key, name in live_by_columns.iteritems():
+            if key not in wanted:
+                changes.append('drop index `%s`' % name)
+    if not changes:
+        return []
+    sql = 'alter table `%s` %s' % (table, ', '.join(changes))
+    if online:
+        sql = '%s, %s' % (sql, _ONLINE)
+    return [sql]
+
+
+def migrate(*models, **kw):
+    """
+    Apply diff() for each model. kw: drop, modify, dry_run. Returns the statements.
+    """
+    dry_run = kw.pop('dry_run', False)
+    L = []
+    for m in models:
+        for sql in diff(m, **kw):
+            L.append(sql)
+            if dry_run:
+                logging.info('[SCHEMA] (dry run) %s', sql)
+            else:
+                logging.info('[SCHEMA] %s', sql)
+                db.update(sql)
+    return L
+
+
+def missing_indexes(model, columns):
+    """
+    Return the columns in columns that no index of model starts with.
+    """
+    indexed = set([model.__primary_key__.name] + [idx.columns[0] for idx in model.__index_list__])
+    return [c for c in columns if c not in indexed]
@@ -0,0 +1,290 @@
+# encoding=utf-8
+"""
+Full-text search over model fields with an in-process inverted index.
+
+    search.index(Blog, name=3, summary=2, content=1)
+    Blog.__search__.rebuild()                 # 启动时从表里建索引
+    blogs = Blog.search(u'python orm', limit=20)
+
+倒排表按文档编号增量编码成varint存在bytearray里，插入只需要在末尾追加。
+ORM的insert/update/delete通过write hook在事务提交后更新索引；删除只做标记，
+标记过多时整体压缩。结果按BM25排序，字段权重作为词频的倍数。
+
+索引在进程内，只包含本进程的写操作和rebuild()读到的数据；多进程部署时需要定期rebuild()。
+"""
+import re
+import math
+import heapq
+import logging
+import threading
+from array import array
+
+import db
+import orm
+
+
+_RE_TOKEN = re.compile(ur'[a-z0-9]+|[\u4e00-\u9fff]+', re.UNICODE)
+
+
+def tokenize(text):
+    """
+    Lowercase words; runs of CJK characters are split into bigrams.
+
+    >>> tokenize(u'Hello, ORM-2 world')
+    [u'hello', u'orm', u'2', u'world']
+    >>> tokenize(u'\\u5168\\u6587\\u641c\\u7d22')
+    [u'\\u5168\\u6587', u'\\u6587\\u641c', u'\\u641c\\u7d22']
+    """
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    L = []
+    for w in _RE_TOKEN.findall(text.lower()):
+        if u'\u4e00' <= w[0] <= u'\u9fff' and len(w) > 1:
+            L.extend(w[i:i + 2] for i in xrange(len(w) - 1))
+        else:
+            L.append(w)
+    return L
+
+
+def _encode(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _decode(buf):
+    """
+    Decode a posting list into ([doc], [tf]).
+
+    >>> buf = bytearray()
+    >>> for delta, tf in ((3, 1), (200, 2), (70000, 5)):
+    ...     _encode(buf, delta); _encode(buf, tf)
+    >>> _decode(buf)
+    ([3, 203, 70203], [1, 2, 5])
+    """
+    docs = []
+    tfs = []
+    doc = 0
+    n = 0
+    shift = 0
+    is_doc = True
+    for b in buf:
+        if b & 0x80:
+            n |= (b & 0x7f) << shift
+            shift += 7
+            continue
+        n |= b << shift
+        if is_doc:
+            doc += n
+            docs.append(doc)
+        else:
+            tfs.append(n)
+        is_doc = not is_doc
+        n = 0
+        shift = 0
+    return docs, tfs
+
+
+class SearchIndex(object):
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, model, weights):
+        self.model = model
+        self.weights = sorted(weights.iteritems())
+        self._pk = model.__primary_key__.name
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        # term -> bytearray of (doc delta, tf) varints
+        self._postings = {}
+        # term -> last doc number in its posting list
+        self._last = {}
+        # term -> posting count，包括已删除的文档，压缩时重新计算
+        self._df = {}
+        # 文档编号 -> 主键，删除的文档为None
+        self._keys = []
+        self._docs = {}
+        self._lengths = array('I')
+        self._total = 0
+        self._dead = 0
+
+    def _terms(self, obj):
+        tf = {}
+        for attr, w in self.weights:
+            for t in tokenize(getattr(obj, attr, None)):
+                tf[t] = tf.get(t, 0) + w
+        return tf
+
+    def add(self, obj):
+        """
+        Index obj, replacing its previous version.
+        """
+        self._add(getattr(obj, self._pk), self._terms(obj))
+
+    def _add(self, pk, tf):
+        with self._lock:
+            self._remove(pk)
+            doc = len(self._keys)
+            self._keys.append(pk)
+            self._docs[pk] = doc
+            length = sum(tf.itervalues())
+            self._lengths.append(length)
+            self._total += length
+            postings = self._postings
+            last = self._last
+            df = self._df
+            for term, n in tf.iteritems():
+                buf = postings.get(term)
+                if buf is None:
+                    buf = postings[term] = bytearray()
+                _encode(buf, doc - last.get(term, 0))
+                _encode(buf, n)
+                last[term] = doc
+                df[term] = df.get(term, 0) + 1
+
+    def remove(self, pk):
+        with self._lock:
+            self._remove(pk)
+
+    def _remove(self, pk):
+        doc = self._docs.pop(pk, None)
+        if doc is not None:
+            self._keys[doc] = None
+            self._total -= self._lengths[doc]
+            self._dead += 1
+            # 更新也会留下旧版本，所以在这里检查：删除的文档超过1/4时压缩，去掉倒排表里的无效项
+            if self._dead > 1000 and self._dead * 4 > len(self._keys):
+                self._compact()
+
+    def _compact(self):
+        renumber = {}
+        keys = []
+        lengths = array('I')
+        for doc, pk in enumerate(self._keys):
+            if pk is not None:
+                renumber[doc] = len(keys)
+                keys.append(pk)
+                lengths.append(self._lengths[doc])
+        postings = {}
+        last = {}
+        df = {}
+        for term, buf in self._postings.iteritems():
+            out = bytearray()
+            prev = 0
+            count = 0
+            for doc, n in zip(*_decode(buf)):
+                new = renumber.get(doc)
+                if new is not None:
+                    _encode(out, new - prev)
+                    _encode(out, n)
+                    prev = new
+                    count += 1
+            if out:
+                postings[term] = out
+                last[term] = prev
+                df[term] = count
+        self._postings, self._last, self._df, self._keys, self._lengths = postings, last, df, keys, lengths
+        self._docs = dict((pk, doc) for doc, pk in enumerate(keys))
+        self._dead = 0
+
+    def query(self, q, limit=10):
+        """
+        Return up to limit [(pk, score)] for the words in q, best first.
+        """
+        terms = set(tokenize(q))
+        if not terms:
+            return []
+        with self._lock:
+            n_docs = len(self._docs)
+            if not n_docs:
+                return []
+            avg = float(self._total) / n_docs or 1.0
+            k1 = self.k1
+            # BM25: idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len / avg))
+            c1 = k1 * (1.0 - self.b)
+            c2 = k1 * self.b / avg
+            keys = self._keys
+            lengths = self._lengths
+            terms = [t for t in terms if t in self._postings]
+            # 出现在一半以上文档里的词idf接近0，和其他词一起查询时跳过，省掉解码最长的倒排表
+            rare = [t for t in terms if self._df[t] * 2 <= n_docs]
+            if rare:
+                terms = rare
+            scores = {}
+            for term in terms:
+                docs, tfs = _decode(self._postings[term])
+                # 倒排表里还有未压缩的旧版本，df不能超过现有文档数，否则idf为负
+                df = min(len(docs), n_docs)
+                idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+                for doc, tf in zip(docs, tfs):
+                    if keys[doc] is None:
+                        continue
+                    s = idf * tf * (k1 + 1.0) / (tf + c1 + c2 * lengths[doc])
+                    scores[doc] = scores.get(doc, 0.0) + s
+            best = heapq.nlargest(limit, scores.iteritems(), key=lambda kv: kv[1])
+            return [(keys[doc], s) for doc, s in best]
+
+    def rebuild(self, chunk=5000):
+        """
+        Rebuild the index from the table, reading chunk rows at a time in primary key order.
+        """
+        with self._lock:
+            self._reset()
+        model = self.model
+        sql = 'where `%s`>? order by `%s` limit ?' % (self._pk, self._pk)
+
+        def _load():
+            last = ''
+            n = 0
+            while True:
+                rows = model.find_by(sql, last, chunk)
+                for obj in rows:
+                    self.add(obj)
+                n += len(rows)
+                if len(rows) < chunk:
+                    return n
+                last = getattr(rows[-1], self._pk)
+        n = sum(model._on_shards(_load))
+        logging.info('search index of %s: %d documents.', model.__name__, n)
+        return n
+
+    def stats(self):
+        with self._lock:
+            return dict(docs=len(self._docs), terms=len(self._postings),
+                        posting_bytes=sum(len(buf) for buf in self._postings.itervalues()))
+
+    def _on_write(self, event, obj, rowcount):
+        if type(obj) is not self.model:
+            return
+        pk = getattr(obj, self._pk)
+        if event == 'delete':
+            db.after_commit(lambda: self.remove(pk))
+        else:
+            # 在hook里先分词，提交后对象可能已经被修改
+            tf = self._terms(obj)
+            db.after_commit(lambda: self._add(pk, tf))
+
+
+def index(model, **weights):
+    """
+    Index the fields of model given as field=weight and add model.search(query, limit=10),
+    which returns ranked model objects.
+    """
+    for attr in weights:
+        if attr not in model.__mappings__:
+            raise ValueError('%s has no field %s' % (model.__name__, attr))
+    idx = SearchIndex(model, weights)
+    orm.add_write_hook(idx._on_write)
+
+    def search(cls, query, limit=10):
+        return cls.get_many([pk for pk, score in idx.query(query, limit)])
+    model.__search__ = idx
+    model.search = classmethod(search)
+    return idx
+
@@ -0,0 +1,520 @@
+# encoding=utf-8
+"""
+HTTP/1.1 WSGI server with persistent connections.
+
+    server = HttpServer(app.get_wsgi_application(), '0.0.0.0', 9000, workers=16, idle_timeout=15)
+    server.serve_forever()
+
+一个事件循环线程用epoll(没有epoll时用poll)监听端口和所有空闲的keep-alive连接，连接上有数据到达时
+才交给工作线程处理一个请求；处理完后连接回到事件循环，所以大量空闲连接不占用工作线程。
+空闲超过idle_timeout秒的连接被关闭，每个连接最多处理max_requests个请求。
+
+响应的分帧：应用给出Content-Length时照用；应用返回list时计算长度；其余(generator)对HTTP/1.1客户端
+用chunked编码，对HTTP/1.0客户端在响应结束后关闭连接。
+"""
+import os
+import sys
+import time
+import errno
+import Queue
+import select
+import socket
+import urllib
+import logging
+import threading
+from collections import deque
+from StringIO import StringIO
+from email.utils import formatdate
+
+import metrics
+
+
+_MAX_HEADER = 65536
+_MAX_CHUNKED_BODY = 10 * 1024 * 1024
+# 响应之后还没读完的请求体在这个长度以内就读掉继续复用连接，否则关闭
+_MAX_DISCARD = 65536
+_NO_BODY_STATUS = ('1', '204', '304')
+
+if hasattr(select, 'epoll'):
+    _READ, _ERROR = select.EPOLLIN, select.EPOLLERR | select.EPOLLHUP
+else:
+    _READ, _ERROR = select.POLLIN, select.POLLERR | select.POLLHUP
+
+
+class _BadRequest(Exception):
+    pass
+
+
+class _Poller(object):
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._p = select.epoll()
+            self._scale = 1.0
+        else:
+            self._p = select.poll()
+            self._scale = 1000.0
+
+    def register(self, fd):
+        self._p.register(fd, _READ | _ERROR)
+
+    def unregister(self, fd):
+        self._p.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            return self._p.poll(timeout * self._scale)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self._p, 'close'):
+            self._p.close()
+
+
+class _Connection(object):
+
+    __slots__ = ('sock', 'addr', 'buf', 'requests', 'idle_since')
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        # 已经读到但还没有处理的数据(pipelining时可能包含下一个请求)
+        self.buf = ''
+        self.requests = 0
+        self.idle_since = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError()
+        return data
+
+    def read_head(self):
+        while True:
+            i = self.buf.find('\r\n\r\n')
+            if i >= 0:
+                head, self.buf = self.buf[:i], self.buf[i + 4:]
+                return head
+            if len(self.buf) > _MAX_HEADER:
+                raise _BadRequest('header too large')
+            self.buf += self.recv()
+
+    def read_line(self):
+        while True:
+            i = self.buf.find('\r\n')
+            if i >= 0:
+                line, self.buf = self.buf[:i], self.buf[i + 2:]
+                return line
+            if len(self.buf) > _MAX_HEADER:
+                raise _BadRequest('line too long')
+            self.buf += self.recv()
+
+    def read_exactly(self, n):
+        while len(self.buf) < n:
+            self.buf += self.recv()
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class _Input(object):
+
+    """
+    wsgi.input for a Content-Length body; never reads past the end of the request.
+    """
+
+    def __init__(self, conn, length, on_first_read=None):
+        self._conn = conn
+        self.remaining = length
+        self._on_first_read = on_first_read
+
+    def _take(self, n):
+        if self._on_first_read:
+            self._on_first_read()
+            self._on_first_read = None
+        conn = self._conn
+        n = self.remaining if n is None or n < 0 else min(n, self.remaining)
+        if n and not conn.buf:
+            conn.buf = conn.recv()
+        data, conn.buf = conn.buf[:n], conn.buf[n:]
+        self.remaining -= len(data)
+        return data
+
+    def read(self, size=-1):
+        L = []
+        want = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        while want > 0:
+            data = self._take(want)
+            L.append(data)
+            want -= len(data)
+        return ''.join(L)
+
+    def readline(self, size=-1):
+        L = []
+        while self.remaining and (size < 0 or sum(map(len, L)) < size):
+            conn = self._conn
+            if not conn.buf:
+                conn.buf = conn.recv()
+            i = conn.buf.find('\n', 0, self.remaining)
+            n = i + 1 if i >= 0 else len(conn.buf)
+            if size >= 0:
+                n = min(n, size - sum(map(len, L)))
+            L.append(self._take(n))
+            if L[-1].endswith('\n'):
+                break
+        return ''.join(L)
+
+    def readlines(self, hint=None):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+def _read_chunked(conn):
+    L = []
+    total = 0
+    while True:
+        line = conn.read_line()
+        try:
+            n = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            raise _BadRequest('bad chunk size')
+        if n == 0:
+            # 忽略trailer
+            while conn.read_line():
+                pass
+            return ''.join(L)
+        total += n
+        if total > _MAX_CHUNKED_BODY:
+            raise _BadRequest('chunked body too large')
+        L.append(conn.read_exactly(n))
+        conn.read_exactly(2)
+
+
+class HttpServer(object):
+
+    def __init__(self, app, host='127.0.0.1', port=9000, workers=16, idle_timeout=15, max_requests=100,
+                 request_timeout=30, backlog=128):
+        self.app = app
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.request_timeout = request_timeout
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(backlog)
+        self._sock.setblocking(0)
+        self.server_address = self._sock.getsockname()
+        self._environ = {
+            'SERVER_NAME': socket.getfqdn(host) if host not in ('', '0.0.0.0') else socket.gethostname(),
+            'SERVER_PORT': str(self.server_address[1]),
+            'SCRIPT_NAME': '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        # fd -> _Connection，等待下一个请求的连接
+        self._idle = {}
+        # 工作线程处理完、要放回事件循环的连接
+        self._returned = deque()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._ready = None
+        self._threads = []
+        self._running = False
+        self._date = (0, '')
+        self.stats = dict(accepted=0, requests=0, reused=0, timed_out=0)
+        metrics.add_collector(self.prometheus_lines)
+
+    def serve_forever(self):
+        """
+        Run the event loop in the calling thread until shutdown().
+        """
+        self._ready = Queue.Queue()
+        self._threads = [threading.Thread(target=self._work, name='http-worker-%d' % i) for i in xrange(self.workers)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+        poller = _Poller()
+        listen_fd = self._sock.fileno()
+        poller.register(listen_fd)
+        poller.register(self._wakeup_r)
+        self._running = True
+        next_sweep = time.time() + 1.0
+        try:
+            while self._running:
+                for fd, event in poller.poll(1.0):
+                    if fd == listen_fd:
+                        self._accept(poller)
+                    elif fd == self._wakeup_r:
+                        os.read(self._wakeup_r, 4096)
+                    else:
+                        conn = self._idle.pop(fd, None)
+                        if conn is None:
+                            continue
+                        poller.unregister(fd)
+                        if event & _READ:
+                            self._ready.put(conn)
+                        else:
+                            conn.close()
+                while self._returned:
+                    conn = self._returned.popleft()
+                    conn.idle_since = time.time()
+                    self._idle[conn.fileno()] = conn
+                    poller.register(conn.fileno())
+                now = time.time()
+                if now >= next_sweep:
+                    next_sweep = now + 1.0
+                    self._sweep(poller, now)
+        finally:
+            for fd, conn in self._idle.items():
+                poller.unregister(fd)
+                conn.close()
+            self._idle.clear()
+            poller.close()
+            self._sock.close()
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            for t in self._threads:
+                self._ready.put(None)
+            for t in self._threads:
+                t.join(self.request_timeout)
+
+    def shutdown(self):
+        """
+        Stop accepting connections; requests in progress finish, then serve_forever() returns.
+        """
+        self._running = False
+        os.write(self._wakeup_w, 'x')
+
+    def _accept(self, poller):
+        while True:
+            try:
+                sock, addr = self._sock.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                raise
+            sock.setblocking(1)
+            sock.settimeout(self.request_timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sock, addr)
+            self.stats['accepted'] += 1
+            # 新连接也先在事件循环里等数据，慢客户端不占用工作线程
+            self._idle[conn.fileno()] = conn
+            poller.register(conn.fileno())
+
+    def _sweep(self, poller, now):
+        for fd, conn in self._idle.items():
+            if now - conn.idle_since > self.idle_timeout:
+                del self._idle[fd]
+                poller.unregister(fd)
+                conn.close()
+                self.stats['timed_out'] += 1
+
+    def _work(self):
+        while True:
+            conn = self._ready.get()
+            if conn is None:
+                return
+            while True:
+                try:
+                    keep = self._handle(conn)
+                except (EOFError, socket.error):
+                    keep = False
+                except Exception:
+                    logging.exception('http: error handling request from %s.', conn.addr[0])
+                    keep = False
+                if not keep or not self._running:
+                    conn.close()
+                    break
+                if not conn.buf:
+                    # 没有已读到的下一个请求，交回事件循环等待
+                    self._returned.append(conn)
+                    os.write(self._wakeup_w, 'x')
+                    break
+
+    def _http_date(self):
+        now = int(time.time())
+        if self._date[0] != now:
+            self._date = (now, formatdate(now, usegmt=True))
+        return self._date[1]
+
+    def _send_error(self, conn, status):
+        body = status
+        conn.sock.sendall('HTTP/1.1 %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s'
+                          % (status, len(body), body))
+
+    def _handle(self, conn):
+        """
+        Serve one request on conn. Return True if the connection can be reused.
+        """
+        try:
+            head = conn.read_head()
+        except _BadRequest:
+            self._send_error(conn, '431 Request Header Fields Too Large')
+            return False
+        lines = head.split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            self._send_error(conn, '400 Bad Request')
+            return False
+        if version not in ('HTTP/1.1', 'HTTP/1.0'):
+            self._send_error(conn, '505 HTTP Version Not Supported')
+            return False
+        conn.requests += 1
+        self.stats['requests'] += 1
+        if conn.requests > 1:
+            self.stats['reused'] += 1
+        env = dict(self._environ)
+        path, _, query = target.partition('?')
+        env['REQUEST_METHOD'] = method
+        env['PATH_INFO'] = urllib.unquote(path)
+        env['QUERY_STRING'] = query
+        env['SERVER_PROTOCOL'] = version
+        env['REMOTE_ADDR'] = conn.addr[0]
+        env['REMOTE_PORT'] = str(conn.addr[1])
+        for line in lines[1:]:
+            k, sep, v = line.partition(':')
+            if not sep:
+                continue
+            k = k.strip().upper().replace('-', '_')
+            v = v.strip()
+            if k not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                k = 'HTTP_' + k
+            if k in env:
+                env[k] = '%s,%s' % (env[k], v)
+            else:
+                env[k] = v
+        connection = env.get('HTTP_CONNECTION', '').lower()
+        if version == 'HTTP/1.1':
+            keep = 'close' not in connection
+        else:
+            keep = 'keep-alive' in connection
+        if conn.requests >= self.max_requests or not self._running:
+            keep = False
+
+        expect = env.get('HTTP_EXPECT', '').lower() == '100-continue'
+        send_continue = (lambda: conn.sock.sendall('HTTP/1.1 100 Continue\r\n\r\n')) if expect else None
+        try:
+            if 'chunked' in env.get('HTTP_TRANSFER_ENCODING', '').lower():
+                if send_continue:
+                    send_continue()
+                body = _read_chunked(conn)
+                env['CONTENT_LENGTH'] = str(len(body))
+                env['wsgi.input'] = stdin = StringIO(body)
+                stdin.remaining = 0
+            else:
+                length = int(env.get('CONTENT_LENGTH') or 0)
+                if length < 0:
+                    raise ValueError()
+                env['wsgi.input'] = stdin = _Input(conn, length, send_continue)
+        except ValueError:
+            self._send_error(conn, '400 Bad Request')
+            return False
+        except _BadRequest:
+            self._send_error(conn, '413 Request Entity Too Large')
+            return False
+
+        keep = self._respond(conn, env, method, version, keep)
+        # 应用没有读完的请求体要读掉，否则下一个请求的解析会错位
+        if keep and stdin.remaining:
+            if stdin.remaining > _MAX_DISCARD or (expect and stdin._on_first_read):
+                return False
+            stdin.read()
+        return keep
+
+    def _respond(self, conn, env, method, version, keep):
+        state = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if state.get('sent'):
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            state['status'] = status
+            state['headers'] = headers
+            return written.append
+
+        result = self.app(env, start_response)
+        try:
+            if 'status' not in state:
+                # 应用出错时没有调用start_response
+                self._send_error(conn, '500 Internal Server Error')
+                return False
+            status = state['status']
+            headers = [(k, v) for k, v in state['headers'] if k.lower() not in ('connection', 'transfer-encoding', 'keep-alive')]
+            names = set(k.lower() for k, v in headers)
+            no_body = method == 'HEAD' or status.startswith(_NO_BODY_STATUS)
+            chunked = False
+            body = None
+            if no_body or 'content-length' in names:
+                pass
+            elif isinstance(result, (list, tuple)):
+                body = ''.join(written) + ''.join(result)
+                headers.append(('Content-Length', str(len(body))))
+            elif version == 'HTTP/1.1':
+                chunked = True
+                headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                keep = False
+            if 'date' not in names:
+                headers.append(('Date', self._http_date()))
+            headers.append(('Connection', 'keep-alive' if keep else 'close'))
+            head = 'HTTP/1.1 %s\r\n%s\r\n\r\n' % (status, '\r\n'.join('%s: %s' % kv for kv in headers))
+            sock = conn.sock
+            state['sent'] = True
+            if no_body:
+                sock.sendall(head)
+            elif body is not None:
+                sock.sendall(head + body)
+            else:
+                pending = head
+                for data in written:
+                    pending = self._frame(sock, pending, data, chunked)
+                for data in result:
+                    pending = self._frame(sock, pending, data, chunked)
+                sock.sendall(pending + ('0\r\n\r\n' if chunked else ''))
+            return keep
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def _frame(self, sock, pending, data, chunked):
+        # 头部和第一块数据一起发送，省一次系统调用
+        if not data:
+            return pending
+        if chunked:
+            data = '%x\r\n%s\r\n' % (len(data), data)
+        sock.sendall(pending + data)
+        return ''
+
+    def prometheus_lines(self):
+        st = self.stats
+        return ['# TYPE transwarp_http_connections_idle gauge',
+                'transwarp_http_connections_idle %d' % len(self._idle),
+                '# TYPE transwarp_http_connections_accepted_total counter',
+                'transwarp_http_connections_accepted_total %d' % st['accepted'],
+                '# TYPE transwarp_http_connections_timed_out_total counter',
+                'transwarp_http_connections_timed_out_total %d' % st['timed_out'],
+                '# TYPE transwarp_http_requests_reused_total counter',
+                'transwarp_http_requests_reused_total %d' % st['reused']]
@@ -0,0 +1,444 @@
+# encoding=utf-8
+"""
+Server-side sessions, installed as an interceptor:
+
+    store = session.SessionStore('my-secret', backend=session.MemoryBackend(), user_fields=('name', 'admin'))
+    app.add_interceptor(store.interceptor())
+
+    @get('/me')
+    @api
+    def me():
+        user = ctx.session.user(User)
+        ...
+
+Cookie里只有session id和它的HMAC签名，签名不对的cookie直接当作没有session，不会访问后端存储。
+session在第一次被访问时才从后端加载，只有修改过才写回；延长有效期的写操作也放到请求处理完之后。
+session数据用JSON序列化，值只能是JSON支持的类型(str会变成unicode，tuple会变成list)。
+配置了user_fields时，登录用户的这些字段缓存在session里，user_ttl秒内不再重复查询User表；
+不要把密码之类的字段放进user_fields。
+"""
+import os
+import time
+import hmac
+import json
+import hashlib
+import logging
+import binascii
+import threading
+from collections import OrderedDict
+
+import db
+from orm import Model, StringField, TextField, FloatField
+from web import ctx, interceptor
+
+
+def _dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+def _loads(blob):
+    # 无法解析的数据(比如旧的pickle格式)当作没有session
+    try:
+        return json.loads(blob)
+    except ValueError:
+        return None
+
+
+if hasattr(hmac, 'compare_digest'):
+    _equals = hmac.compare_digest
+else:
+    def _equals(a, b):
+        if len(a) != len(b):
+            return False
+        r = 0
+        for x, y in zip(a, b):
+            r |= ord(x) ^ ord(y)
+        return r == 0
+
+
+class SessionBackend(object):
+
+    """
+    Base class of session storage. Data is stored with a sliding expiry of ttl seconds.
+    """
+
+    sweep_interval = 60
+
+    _next_sweep = 0
+
+    def load(self, sid, ttl):
+        ' Return the session dict of sid, or None if it does not exist or has expired. '
+        raise NotImplementedError
+
+    def save(self, sid, data, ttl):
+        raise NotImplementedError
+
+    def delete(self, sid):
+        raise NotImplementedError
+
+    def touch(self, sid, ttl):
+        ' Extend the expiry of a session that was loaded but not modified, called after the request. '
+        pass
+
+    def sweep(self, ttl):
+        ' Remove expired sessions. '
+        pass
+
+    def _maybe_sweep(self, ttl):
+        now = time.time()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.sweep(ttl)
+
+
+class MemoryBackend(SessionBackend):
+
+    """
+    In-process LRU store holding at most capacity sessions.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        # sid -> (expires, JSON data)，按最近访问排序。ttl相同，所以最早过期的总在最前面
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sid, ttl):
+        now = time.time()
+        with self._lock:
+            item = self._data.pop(sid, None)
+            if item is None or item[0] < now:
+                return None
+            self._data[sid] = (now + ttl, item[1])
+        return _loads(item[1])
+
+    def save(self, sid, data, ttl):
+        blob = _dumps(data)
+        with self._lock:
+            self._data.pop(sid, None)
+            self._data[sid] = (time.time() + ttl, blob)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+        self._maybe_sweep(ttl)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def sweep(self, ttl):
+        now = time.time()
+        with self._lock:
+            while self._data:
+                sid, (expires, blob) = next(self._data.iteritems())
+                if expires >= now:
+                    break
+                del self._data[sid]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class StoredSession(Model):
+
+    """
+    Row of DbBackend, create the table with schema.migrate(StoredSession).
+    """
+
+    __table__ = 'sessions'
+    __indexes__ = (('expires',),)
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    data = TextField()
+    expires = FloatField()
+
+
+class DbBackend(SessionBackend):
+
+    """
+    Sessions in the sessions table, shared by all processes.
+    """
+
+    def __init__(self):
+        self._table = StoredSession.__table__
+        # 本线程加载的、需要延长有效期的sid
+        self._local = threading.local()
+
+    def load(self, sid, ttl):
+        # 在事务里读，走primary：登录请求刚写入的session可能还没有复制到replica
+        with db.transaction():
+            r = StoredSession.get(sid)
+        now = time.time()
+        if r is None or r.expires < now:
+            return None
+        # 剩余时间不到一半时才延长有效期，避免每次读session都写一次数据库；
+        # 写操作等到touch()才做，否则请求里之后的读都会被固定到主库
+        self._local.touch = sid if r.expires - now < ttl / 2.0 else None
+        return _loads(r.data)
+
+    def touch(self, sid, ttl):
+        if getattr(self._local, 'touch', None) == sid:
+            self._local.touch = None
+            db.update('update `%s` set `expires`=? where `id`=?' % self._table, time.time() + ttl, sid)
+
+    def save(self, sid, data, ttl):
+        blob = _dumps(data)
+        expires = time.time() + ttl
+        if not db.update('update `%s` set `data`=?, `expires`=? where `id`=?' % self._table, blob, expires, sid):
+            StoredSession(id=sid, data=blob, expires=expires).insert()
+        self._maybe_sweep(ttl)
+
+    def delete(self, sid):
+        db.update('delete from `%s` where `id`=?' % self._table, sid)
+
+    def sweep(self, ttl):
+        db.update('delete from `%s` where `expires`<?' % self._table, time.time())
+
+
+class FileBackend(SessionBackend):
+
+    """
+    One file per session under directory; the file mtime is the last access time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, sid):
+        return os.path.join(self.directory, 'sess_%s' % sid)
+
+    def load(self, sid, ttl):
+        path = self._path(sid)
+        try:
+            mtime = os.path.getmtime(path)
+            now = time.time()
+            if mtime + ttl < now:
+                os.remove(path)
+                return None
+            if now - mtime > ttl / 2.0:
+                os.utime(path, None)
+            with open(path, 'rb') as f:
+                return _loads(f.read())
+        except (IOError, OSError):
+            return None
+
+    def save(self, sid, data, ttl):
+        path = self._path(sid)
+        tmp = '%s.%d.%d' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(_dumps(data))
+        os.rename(tmp, path)
+        self._maybe_sweep(ttl)
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except OSError:
+            pass
+
+    def sweep(self, ttl):
+        expired = time.time() - ttl
+        for name in os.listdir(self.directory):
+            if not name.startswith('sess_'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class Session(object):
+
+    """
+    The session of the current request, available as ctx.session. Data is loaded on first access.
+    Assigning a key marks it modified; after changing a mutable value in place set modified = True.
+    """
+
+    def __init__(self, store, sid):
+        self._store = store
+        self.sid = sid
+        self.modified = False
+        self._data = None
+        # 需要从后端删除的旧id(登录时换id、注销)
+        self._discarded = []
+
+    def _load(self):
+        if self._data is None:
+            data = self._store.backend.load(self.sid, self._store.ttl) if self.sid else None
+            if data is None:
+                self.sid = None
+                data = {}
+            self._data = data
+        return self._data
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def get(self, key, default=None):
+        return self._load().get(key, default)
+
+    def pop(self, key, *default):
+        data = self._load()
+        if key in data:
+            self.modified = True
+        return data.pop(key, *default)
+
+    def keys(self):
+        return self._load().keys()
+
+    def regenerate(self):
+        """
+        Keep the data under a new session id, e.g. after login to prevent session fixation.
+        """
+        self._load()
+        if self.sid:
+            self._discarded.append(self.sid)
+        self.sid = None
+        self.modified = True
+
+    def invalidate(self):
+        """
+        Drop the session and its cookie.
+        """
+        if self.sid:
+            self._discarded.append(self.sid)
+        self.sid = None
+        self._data = {}
+        self.modified = False
+
+    def _cache_user(self, user):
+        fields = self._store.user_fields
+        if fields:
+            pk = user.__primary_key__.name
+            self['_user'] = [time.time() + self._store.user_ttl, dict((k, getattr(user, k)) for k in (pk,) + tuple(fields))]
+
+    def login(self, user):
+        self.regenerate()
+        self['user_id'] = getattr(user, user.__primary_key__.name)
+        self._cache_user(user)
+
+    def logout(self):
+        self.invalidate()
+
+    def user(self, model):
+        """
+        Return the logged in user. With user_fields set on the store, the user is built from the
+        fields cached in the session for user_ttl seconds and only has those fields.
+        """
+        uid = self.get('user_id')
+        if uid is None:
+            return None
+        cached = self.get('_user')
+        if cached is not None and cached[0] > time.time():
+            return model(**cached[1])
+        user = model.get(uid)
+        if user is None:
+            self.invalidate()
+            return None
+        self._cache_user(user)
+        return user
+
+
+class SessionStore(object):
+
+    """
+    user_fields: names of the user fields cached in the session by login() and user(), besides the
+    primary key. Empty (the default) caches nothing and user() queries the model on every call.
+    """
+
+    def __init__(self, secret, backend=None, cookie_name='twsid', ttl=86400, user_ttl=300, secure=False, user_fields=()):
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        self._secret = secret
+        self.backend = backend or MemoryBackend()
+        self.cookie_name = cookie_name
+        self.ttl = ttl
+        self.user_ttl = user_ttl
+        self.user_fields = tuple(user_fields)
+        self.secure = secure
+
+    def _signature(self, sid):
+        return hmac.new(self._secret, sid, hashlib.sha1).hexdigest()
+
+    def sign(self, sid):
+        return '%s-%s' % (sid, self._signature(sid))
+
+    def unsign(self, value):
+        """
+        Return the session id of a cookie value, or None if the signature does not match.
+
+        >>> store = SessionStore('secret')
+        >>> store.unsign(store.sign('abc'))
+        'abc'
+        >>> store.unsign('abc-0000') is None
+        True
+        """
+        if not value or '-' not in value:
+            return None
+        sid, sig = value.rsplit('-', 1)
+        if isinstance(sid, unicode):
+            sid, sig = sid.encode('utf-8'), sig.encode('utf-8')
+        if _equals(sig, self._signature(sid)):
+            return sid
+        return None
+
+    def new_id(self):
+        return binascii.hexlify(os.urandom(16))
+
+    def open(self, cookie_value):
+        return Session(self, self.unsign(cookie_value))
+
+    def commit(self, s):
+        """
+        Write s back if it was modified and set or clear the cookie on ctx.response.
+        """
+        for sid in s._discarded:
+            self.backend.delete(sid)
+        if s.modified:
+            if s.sid is None:
+                s.sid = self.new_id()
+            self.backend.save(s.sid, s._data, self.ttl)
+            ctx.response.set_cookie(self.cookie_name, self.sign(s.sid), max_age=self.ttl, secure=self.secure)
+        elif s._discarded and s.sid is None:
+            ctx.response.delete_cookie(self.cookie_name)
+        elif s.loaded and s.sid:
+            self.backend.touch(s.sid, self.ttl)
+
+    def sweep(self):
+        ' Remove expired sessions, for a periodic job; save() also sweeps every sweep_interval seconds. '
+        self.backend.sweep(self.ttl)
+
+    def interceptor(self, pattern='/'):
+        """
+        Return an interceptor setting ctx.session for requests matching pattern.
+        """
+        @interceptor(pattern)
+        def _session_interceptor(next):
+            s = ctx.session = self.open(ctx.request.cookie(self.cookie_name))
+            try:
+                return next()
+            finally:
+                del ctx.session
+                try:
+                    self.commit(s)
+                except Exception:
+                    logging.exception('failed to save session %s.', s.sid)
+        return _session_interceptor
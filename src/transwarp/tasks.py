@@ -0,0 +1,361 @@
+# encoding=utf-8
+"""
+Deferred work off the request path.
+
+    @tasks.task(retries=3)
+    def send_welcome_mail(user_id):
+        ...
+
+    @tasks.task(batch=100)
+    def write_audit(rows):
+        # batch tasks get a list of the items passed to enqueue()
+        db.update(...)
+
+    tasks.start(workers=4)
+    send_welcome_mail.delay(user.id)           # or tasks.enqueue(send_welcome_mail, user.id)
+
+durable=True时任务写入tasks表(和调用者的事务一起提交)，任何调用了start(durable=True)的进程都会
+从表里领取任务执行，可以用单独的worker进程处理；否则任务只保存在内存队列里。
+在事务中enqueue的任务在事务提交后才会执行，事务回滚则丢弃。每个任务在自己的with_connection里运行。
+"""
+import time
+import heapq
+import Queue
+import base64
+import socket
+import logging
+import threading
+import cPickle as pickle
+
+import db
+from orm import Model, StringField, TextField, IntegerField, FloatField
+
+
+_tasks = {}
+
+
+class QueuedTask(Model):
+
+    """
+    Row of the durable queue, create the table with schema.migrate(QueuedTask).
+    Finished tasks are deleted; tasks out of retries stay with status 'failed'.
+    """
+
+    __table__ = 'tasks'
+    __indexes__ = (('status', 'run_at'),)
+
+    id = StringField(primary_key=True, default=db.next_id, ddl='varchar(50)')
+    name = StringField(updatable=False, ddl='varchar(200)')
+    args = TextField(updatable=False)
+    status = StringField(default='pending', ddl='varchar(10)')
+    attempts = IntegerField()
+    owner = StringField(ddl='varchar(100)')
+    error = TextField()
+    run_at = FloatField(default=time.time)
+    locked_at = FloatField()
+    created_at = FloatField(updatable=False, default=time.time)
+
+
+class Task(object):
+
+    def __init__(self, func, retries=0, backoff=1.0, batch=None, batch_wait=0.1):
+        self.func = func
+        self.name = '%s.%s' % (func.__module__, func.__name__)
+        self.retries = retries
+        self.backoff = backoff
+        self.batch = batch
+        self.batch_wait = batch_wait
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __call__(self, *args, **kw):
+        return self.func(*args, **kw)
+
+    def delay(self, *args, **kw):
+        return enqueue(self, *args, **kw)
+
+    def __repr__(self):
+        return 'Task(%s)' % self.name
+
+
+def task(func=None, retries=0, backoff=1.0, batch=None, batch_wait=0.1):
+    """
+    Register func as a task. Failed runs are retried up to retries times after backoff * 2^n seconds.
+    With batch=n, up to n items enqueued within batch_wait seconds are passed to func as one list.
+    """
+    if func is None:
+        return lambda f: task(f, retries, backoff, batch, batch_wait)
+    t = Task(func, retries, backoff, batch, batch_wait)
+    _tasks[t.name] = t
+    return t
+
+
+class _Job(object):
+
+    __slots__ = ('task', 'args', 'kw', 'attempts', 'ids')
+
+    def __init__(self, task, args, kw, attempts=0, ids=None):
+        self.task = task
+        self.args = args
+        self.kw = kw
+        self.attempts = attempts
+        # durable模式下对应的tasks表的行，批量任务可能有多行
+        self.ids = ids or []
+
+
+def _dumps(args, kw):
+    return base64.b64encode(pickle.dumps((args, kw), pickle.HIGHEST_PROTOCOL))
+
+
+def _loads(s):
+    return pickle.loads(base64.b64decode(s))
+
+
+class TaskQueue(object):
+
+    def __init__(self):
+        self.durable = False
+        self.poll_interval = 1.0
+        self.lease = 300
+        self._owner = '%s:%d' % (socket.gethostname(), id(self))
+        self._ready = Queue.Queue()
+        # (run_at, seq, job)，等待重试的任务
+        self._delayed = []
+        self._seq = 0
+        # task name -> (first enqueue time, [(item, row id)])
+        self._batches = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._running = False
+        self.stats = dict(enqueued=0, done=0, failed=0, retried=0)
+
+    def start(self, workers=4, durable=False, poll_interval=1.0, lease=300):
+        """
+        Start the dispatcher and workers threads. lease is how long a claimed durable task may run
+        before other processes assume its worker died and run it again.
+        """
+        if self._running:
+            raise RuntimeError('Task queue already started.')
+        self.durable = durable
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._running = True
+        if workers <= 0:
+            return
+        L = [threading.Thread(target=self._dispatch, name='tasks-dispatcher')]
+        L.extend(threading.Thread(target=self._work, name='tasks-worker-%d' % i) for i in xrange(workers))
+        for t in L:
+            t.daemon = True
+            t.start()
+        self._threads = L
+
+    def enqueue(self, t, *args, **kw):
+        if not isinstance(t, Task):
+            t = _tasks[t] if isinstance(t, basestring) else _tasks['%s.%s' % (t.__module__, t.__name__)]
+        if t.batch and (len(args) != 1 or kw):
+            raise ValueError('Batch task %s takes exactly one item.' % t.name)
+        self.stats['enqueued'] += 1
+        if self.durable:
+            QueuedTask(name=t.name, args=_dumps(args, kw)).insert()
+            db.after_commit(self._wakeup.set)
+        else:
+            job = _Job(t, args, kw)
+            db.after_commit(lambda: self._submit(job))
+
+    def _submit(self, job, row_id=None):
+        t = job.task
+        if not t.batch:
+            self._ready.put(job)
+            return
+        with self._lock:
+            first, items = self._batches.get(t.name, (time.time(), []))
+            items.append((job.args[0], row_id))
+            self._batches[t.name] = (first, items)
+            full = len(items) >= t.batch
+        if full:
+            self._flush(t)
+
+    def _flush(self, t):
+        with self._lock:
+            first, items = self._batches.pop(t.name, (None, None))
+        if items:
+            ids = [i for item, i in items if i is not None]
+            self._ready.put(_Job(t, ([item for item, i in items],), {}, ids=ids))
+
+    def _dispatch(self):
+        next_poll = 0
+        while self._running:
+            now = time.time()
+            for name, (first, items) in self._batches.items():
+                if now - first >= _tasks[name].batch_wait:
+                    self._flush(_tasks[name])
+            while self._delayed and self._delayed[0][0] <= now:
+                self._ready.put(heapq.heappop(self._delayed)[2])
+            if self.durable and (now >= next_poll or self._wakeup.is_set()):
+                self._wakeup.clear()
+                next_poll = now + self.poll_interval
+                try:
+                    self._poll(now)
+                except Exception:
+                    logging.exception('tasks: poll failed.')
+            self._wakeup.wait(0.05)
+
+    @db.with_connection
+    def _poll(self, now):
+        # 租期已过还在running的任务，认为执行它的进程已经退出
+        db.update('update `%s` set `status`=? where `status`=? and `locked_at`<?' % QueuedTask.__table__,
+                  'pending', 'running', now - self.lease)
+        # 只领取处理得过来的数量，剩下的留给其他进程
+        limit = max(0, 2 * len(self._threads) - self._ready.qsize())
+        if not limit:
+            return
+        rows = QueuedTask.find_by('where `status`=? and `run_at`<=? order by `run_at` limit ?', 'pending', now, limit)
+        for row in rows:
+            claimed = db.update('update `%s` set `status`=?, `owner`=?, `locked_at`=? where `id`=? and `status`=?' % QueuedTask.__table__,
+                                'running', self._owner, now, row.id, 'pending')
+            if not claimed:
+                continue
+            t = _tasks.get(row.name)
+            if t is None:
+                self._finish_rows([row.id], 'failed', 'unknown task %s' % row.name)
+                continue
+            args, kw = _loads(row.args)
+            self._submit(_Job(t, args, kw, row.attempts, [row.id]), row.id)
+
+    def _finish_rows(self, ids, status, error=None):
+        if status == 'done':
+            sql = 'delete from `%s` where `id` in (%s)' % (QueuedTask.__table__, ','.join('?' * len(ids)))
+            db.update(sql, *ids)
+        else:
+            sql = 'update `%s` set `status`=?, `error`=? where `id` in (%s)' % (QueuedTask.__table__, ','.join('?' * len(ids)))
+            db.update(sql, *([status, error] + ids))
+
+    def _work(self):
+        """
+        Worker loop. Errors outside the task itself (e.g. marking rows done) are logged and the worker goes on.
+
+        >>> q = TaskQueue()
+        >>> done = []
+        >>> t = Task(lambda: done.append(1))
+        >>> def broken(ids, status, error=None):
+        ...     raise IOError('db down')
+        >>> q._finish_rows = broken
+        >>> q.start(workers=1)
+        >>> q._ready.put(_Job(t, (), {}, ids=['x'])); q._ready.join()
+        >>> q._ready.put(_Job(t, (), {})); q._ready.join()
+        >>> len(done), [th.is_alive() for th in q._threads]
+        (2, [True, True])
+        >>> q.drain()
+        True
+        """
+        while True:
+            job = self._ready.get()
+            try:
+                if job is None:
+                    return
+                self._run(job)
+            except Exception:
+                logging.exception('tasks: error while running %s.', job.task.name)
+            finally:
+                self._ready.task_done()
+
+    def _run(self, job):
+        t = job.task
+        with db.connection():
+            try:
+                t.func(*job.args, **job.kw)
+            except Exception as e:
+                self._failed(job, e)
+                return
+            self.stats['done'] += 1
+            if job.ids:
+                self._finish_rows(job.ids, 'done')
+
+    def _failed(self, job, e):
+        t = job.task
+        job.attempts += 1
+        if job.attempts > t.retries:
+            self.stats['failed'] += 1
+            logging.exception('tasks: %s failed after %d attempts.', t.name, job.attempts)
+            if job.ids:
+                self._finish_rows(job.ids, 'failed', '%s: %s' % (e.__class__.__name__, e))
+            return
+        self.stats['retried'] += 1
+        run_at = time.time() + t.backoff * (2 ** (job.attempts - 1))
+        logging.warning('tasks: %s failed (%s), retry %d/%d.', t.name, e, job.attempts, t.retries)
+        if job.ids:
+            sql = 'update `%s` set `status`=?, `attempts`=?, `run_at`=?, `error`=? where `id` in (%s)' % (QueuedTask.__table__, ','.join('?' * len(job.ids)))
+            db.update(sql, *(['pending', job.attempts, run_at, str(e)] + job.ids))
+        else:
+            with self._lock:
+                self._seq += 1
+                heapq.heappush(self._delayed, (run_at, self._seq, job))
+
+    def _release_unstarted(self):
+        # 没来得及执行的durable任务放回表里，其他进程可以马上领取，不用等租期过去
+        n = 0
+        while True:
+            try:
+                job = self._ready.get_nowait()
+            except Queue.Empty:
+                break
+            self._ready.task_done()
+            n += 1
+            if job is not None and job.ids:
+                with db.connection():
+                    self._finish_rows(job.ids, 'pending')
+        logging.warning('tasks: %d jobs not started before drain timeout.', n)
+
+    def drain(self, timeout=30):
+        """
+        Stop taking new durable tasks, flush pending batches and wait up to timeout seconds
+        for queued work to finish, then stop the threads. Returns True if everything finished.
+        """
+        if not self._running:
+            return True
+        self._running = False
+        self._wakeup.set()
+        for t in self._threads[:1]:
+            t.join()
+        for name in self._batches.keys():
+            self._flush(_tasks[name])
+        deadline = time.time() + timeout
+        while self._ready.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+        done = not self._ready.unfinished_tasks
+        if not done:
+            self._release_unstarted()
+        if self._delayed and not self.durable:
+            logging.warning('tasks: %d retries dropped on shutdown.', len(self._delayed))
+        for t in self._threads[1:]:
+            self._ready.put(None)
+        for t in self._threads[1:]:
+            t.join(max(0.0, deadline - time.time()))
+        self._threads = []
+        return done
+
+
+_queue = TaskQueue()
+
+
+def start(workers=4, durable=False, **kw):
+    """
+    Start the global task queue, see TaskQueue.start().
+    """
+    _queue.start(workers, durable, **kw)
+
+
+def enqueue(t, *args, **kw):
+    """
+    Run task t (a Task, its function or its name) with args in the background.
+    """
+    _queue.enqueue(t, *args, **kw)
+
+
+def drain(timeout=30):
+    return _queue.drain(timeout)
+
+
+def stats():
+    return db.Dict(queued=_queue._ready.qsize(), delayed=len(_queue._delayed), **_queue.stats)
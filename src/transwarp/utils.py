@@ -17,7 +17,7 @@ def _to_str(s):
     return str(s)
 
 
-def _quota(s, encoding='utf-8'):
+def _quote(s, encoding='utf-8'):
     if isinstance(s, unicode):
-        s = s.encoding(encoding)
+        s = s.encode(encoding)
     return urllib.quote(s)
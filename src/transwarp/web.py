@@ -1,14 +1,33 @@
 # encoding=utf-8
+import os
 import re
+import imp
+import json
+import time
 import types
+import string
+import functools
 import urllib
 import cgi
 import datetime
 import logging
 import threading
-from wsgiref.simple_server import make_server
+
+try:
+    import simplejson as _json_lib
+except ImportError:
+    _json_lib = json
+try:
+    import ujson as _ujson
+except ImportError:
+    _ujson = None
 
 import utils
+import db
+import log
+import server
+import metrics
+import profiler
 from db import Dict
 
 
@@ -62,6 +81,7 @@ _RESPONSE_STATUSES = {
     423: 'Locked',
     424: 'Failed Dependency',
     426: 'Upgrade Required',
+    429: 'Too Many Requests',
 
     # Server Error
     500: 'Internal Server Error',
@@ -265,6 +285,44 @@ class HttpError(object):
         """
         return _HttpError(500)
 
+    @staticmethod
+    def toomanyrequests(retry_after=None):
+        """
+        Send a too many requests response, retry_after is in seconds.
+        >>> e = HttpError.toomanyrequests(2)
+        >>> e.status, e.headers[-1]
+        ('429 Too Many Requests', ('Retry-After', '2'))
+        """
+        e = _HttpError(429)
+        if retry_after is not None:
+            e.header('Retry-After', str(int(retry_after)))
+        return e
+
+    @staticmethod
+    def serviceunavailable(retry_after=None):
+        """
+        Send a service unavailable response, retry_after is in seconds.
+        >>> raise HttpError.serviceunavailable()
+        Traceback (most recent call last):
+          ...
+        _HttpError: 503 Service Unavailable
+        """
+        e = _HttpError(503)
+        if retry_after is not None:
+            e.header('Retry-After', str(int(retry_after)))
+        return e
+
+    @staticmethod
+    def gatewaytimeout():
+        """
+        Send a gateway timeout response.
+        >>> raise HttpError.gatewaytimeout()
+        Traceback (most recent call last):
+          ...
+        _HttpError: 504 Gateway Timeout
+        """
+        return _HttpError(504)
+
     @staticmethod
     def redirect(location):
         """
@@ -347,7 +405,7 @@ UTC_0 = UTC('+00:00')
 class MultipartFile(object):
 
     def __init__(self, storage):
-        self.filename = utils.to_unicode(storage.filename)
+        self.filename = utils._to_unicode(storage.filename)
         self.file = storage.file
 
 
@@ -360,13 +418,12 @@ class Request(object):
 
         def _convert(item):
             if isinstance(item, list):
-                return [utils.to_unicode(i.value) for i in item]
+                return [utils._to_unicode(i.value) for i in item]
             if item.filename:
                 return MultipartFile(item)
-            # return utils.to_unicode(item.value)
+            # return utils._to_unicode(item.value)
             return item.value
 
-        print('environ', self._environ)
         fs = cgi.FieldStorage(fp=self._environ['wsgi.input'], environ=self._environ, keep_blank_values=True)
         inputs = dict()
         for key in fs:
@@ -386,7 +443,6 @@ class Request(object):
         return r
 
     def get(self, key):
-        print('after parse', self._get_raw_input())
         r = self._get_raw_input()[key]
         if isinstance(r, list):
             return r[0]
@@ -433,14 +489,13 @@ class Request(object):
     def host(self):
         return self._environ.get('HTTP_HOST', '')
 
-    @property
     def _get_headers(self):
         if not hasattr(self, '_headers'):
             headers = {}
             for k, v in self._environ.iteritems():
                 if k.startswith('HTTP_'):
                     # this is important
-                    headers[k[5:].repace('_', '-').upper()] = v.decode('utf-8')
+                    headers[k[5:].replace('_', '-').upper()] = v.decode('utf-8')
             self._headers = headers
         return self._headers
 
@@ -448,11 +503,9 @@ class Request(object):
     def headers(self):
         return dict(**self._get_headers())
 
-    @property
     def header(self, header, default=None):
         return self._get_headers().get(header.upper(), default)
 
-    @property
     def _get_cookies(self):
         if not hasattr(self, '_cookies'):
             cookies = {}
@@ -461,7 +514,7 @@ class Request(object):
                 for c in cookie_str.split(';'):
                     pos = c.find('=')
                     if pos > 0:
-                        cookies[c[:pos].strip()] = utils.unquote(c[pos+1:])
+                        cookies[c[:pos].strip()] = utils._unquote(c[pos+1:])
             self._cookies = cookies
         return self._cookies
 
@@ -469,7 +522,6 @@ class Request(object):
     def cookies(self):
         return Dict(**self._get_cookies())
 
-    @property
     def cookie(self, name, default=None):
         return self._get_cookies().get(name, default)
 
@@ -504,7 +556,7 @@ class Response(object):
         L = [(_RESPONSE_HEADER_DICT.get(k, k), v) for k, v in self._headers.iteritems()]
         if hasattr(self, '_cookies'):
             for v in self._cookies.itervalues():
-                L.append(('Set-Cookie'), v)
+                L.append(('Set-Cookie', v))
         L.append(_HEADER_X_POWERED_BY)
         return L
 
@@ -533,7 +585,7 @@ class Response(object):
     def set_cookie(self, name, value, max_age=None, expires=None, path='/', domain=None, secure=False, http_only=True):
         if not hasattr(self, '_cookies'):
             self._cookies = {}
-        L = ['%s=%s' % (utils.quote(name), utils._quote(value))]
+        L = ['%s=%s' % (utils._quote(name), utils._quote(value))]
         if expires is not None:
             if isinstance(expires, (float, int, long)):
                 L.append('Expires=%s' % datetime.datetime.fromtimestamp(expires, UTC_0).strftime('%a, %d-%b-%Y %H:%M:%S GMT'))
@@ -606,6 +658,293 @@ def post(path):
     return _decorator
 
 
+def timeout(seconds):
+    """
+    Give a route its own time budget, overriding WSGIApplication(timeout=...).
+
+    >>> @timeout(2.5)
+    ... def search():
+    ...     pass
+    >>> search.__web_timeout__
+    2.5
+    """
+    def _decorator(func):
+        func.__web_timeout__ = seconds
+        return func
+    return _decorator
+
+
+def check_deadline():
+    """
+    Raise 504 if the current request is over its time budget, for long loops that issue no queries.
+    """
+    deadline = getattr(ctx, 'deadline', None)
+    if deadline is not None and time.time() > deadline:
+        raise HttpError.gatewaytimeout()
+
+
+def _json_default(obj):
+    # 不是dict的行对象可以通过__json__暴露一个dict视图，避免先复制成中间dict
+    if hasattr(obj, '__json__'):
+        return obj.__json__()
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset, types.GeneratorType)):
+        return list(obj)
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def _stdlib_dumps(obj):
+    return _json_lib.dumps(obj, default=_json_default, separators=(',', ':'))
+
+
+def _fast_dumps(obj):
+    # ujson不支持default参数，遇到不认识的类型时退回到标准库
+    try:
+        return _ujson.dumps(obj, ensure_ascii=True)
+    except (TypeError, OverflowError):
+        return _stdlib_dumps(obj)
+
+_json_dumps = _fast_dumps if _ujson else _stdlib_dumps
+
+# 超过这个长度的list会以generator的形式分块输出
+_JSON_STREAM_THRESHOLD = 1000
+_JSON_STREAM_CHUNK = 200
+
+
+def set_json_encoder(dumps):
+    """
+    Replace the function used by @api to serialize results.
+    Pass None to restore the default encoder.
+    """
+    global _json_dumps
+    if dumps is None:
+        dumps = _fast_dumps if _ujson else _stdlib_dumps
+    _json_dumps = dumps
+
+
+class _ClosingIterator(object):
+
+    """
+    Response body that calls cleanup() when the server closes it.
+    """
+
+    def __init__(self, body, cleanup):
+        self._body = body
+        self._cleanup = cleanup
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._cleanup()
+
+
+def _json_stream(L):
+    dumps = _json_dumps
+    yield '['
+    for i in xrange(0, len(L), _JSON_STREAM_CHUNK):
+        chunk = ','.join([dumps(x) for x in L[i:i + _JSON_STREAM_CHUNK]])
+        yield chunk if i == 0 else ',' + chunk
+    yield ']'
+
+
+def api(func):
+    """
+    A decorator that makes a function to json api, makes the return value as json.
+    >>> ctx.response = Response()
+    >>> @api
+    ... def hello(name):
+    ...     return dict(name=name)
+    >>> hello('Bob')
+    '{"name":"Bob"}'
+    >>> ctx.response.content_type
+    'application/json; charset=utf-8'
+    >>> @api
+    ... def missing():
+    ...     raise HttpError.notfound()
+    >>> json.loads(missing())['error']
+    404
+    >>> ctx.response.status
+    '404 Not Found'
+    """
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        response = ctx.response
+        try:
+            r = func(*args, **kw)
+        except _RedirectError:
+            raise
+        except (_HttpError, db.DeadlineExceeded) as e:
+            if isinstance(e, db.DeadlineExceeded):
+                e = HttpError.gatewaytimeout()
+            code = int(e.status[:3])
+            response.status = code
+            for k, v in e.headers or []:
+                if (k, v) != _HEADER_X_POWERED_BY:
+                    response.set_header(k, v)
+            r = dict(error=code, message=e.status[4:])
+        response.content_type = 'application/json; charset=utf-8'
+        if isinstance(r, (list, tuple)) and len(r) > _JSON_STREAM_THRESHOLD:
+            response.unset_header('Content-Length')
+            return _json_stream(r)
+        body = _json_dumps(r)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        response.content_length = len(body)
+        return body
+    return _wrapper
+
+
+class Template(object):
+
+    def __init__(self, template_name, **kw):
+        """
+        Init a template object with template name, model as dict, and additional kw that will append to model.
+        >>> t = Template('hello.html', title='Hello', copyright='@2012')
+        >>> t.model['title']
+        'Hello'
+        >>> t.model['copyright']
+        '@2012'
+        """
+        self.template_name = template_name
+        self.model = dict(**kw)
+
+
+class TemplateEngine(object):
+
+    """
+    Base template engine. 模板只编译一次并缓存在内存里，debug模式下根据文件mtime重新加载。
+    子类实现_compile()和_generate()，_generate()返回一个可迭代的str片段序列。
+    """
+
+    def __init__(self, templ_dir, debug=False):
+        self._templ_dir = templ_dir
+        self._debug = debug
+        self._cache = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _compile(self, source, template_name):
+        raise NotImplementedError()
+
+    def _generate(self, template, model):
+        raise NotImplementedError()
+
+    def get_template(self, template_name):
+        cached = self._cache.get(template_name)
+        if cached is not None and not self._debug:
+            return cached[1]
+        path = os.path.join(self._templ_dir, template_name)
+        mtime = os.path.getmtime(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as f:
+            template = self._compile(f.read().decode('utf-8'), template_name)
+        self._cache[template_name] = (mtime, template)
+        return template
+
+    def _record(self, template_name, t):
+        with self._lock:
+            st = self._stats.get(template_name)
+            if st is None:
+                st = self._stats[template_name] = [0, 0.0, 0.0]
+            st[0] += 1
+            st[1] += t
+            if t > st[2]:
+                st[2] = t
+
+    def render_stats(self):
+        """
+        Return render time per template: {name: Dict(count, total, max, avg)}.
+        """
+        with self._lock:
+            return dict((k, Dict(count=v[0], total=v[1], max=v[2], avg=v[1] / v[0])) for k, v in self._stats.iteritems())
+
+    def __call__(self, template_name, model):
+        # 在返回generator之前查找和编译模板，模板不存在或有语法错误时在start_response之前就抛出，返回500
+        start = time.time()
+        template = self.get_template(template_name)
+        return self._render(template_name, template, model, start)
+
+    def _render(self, template_name, template, model, start):
+        try:
+            for chunk in self._generate(template, model):
+                yield chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk
+        finally:
+            self._record(template_name, time.time() - start)
+
+
+class SimpleTemplateEngine(TemplateEngine):
+
+    """
+    Template engine based on string.Template, uses $name placeholders.
+    """
+
+    def _compile(self, source, template_name):
+        return string.Template(source)
+
+    def _generate(self, template, model):
+        return [template.safe_substitute(model)]
+
+
+class Jinja2TemplateEngine(TemplateEngine):
+
+    """
+    Template engine based on jinja2, renders as a stream of chunks.
+    """
+
+    def __init__(self, templ_dir, debug=False, **kw):
+        super(Jinja2TemplateEngine, self).__init__(templ_dir, debug)
+        from jinja2 import Environment, FileSystemLoader
+        if 'autoescape' not in kw:
+            kw['autoescape'] = True
+        self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)
+
+    def add_filter(self, name, fn_filter):
+        self._env.filters[name] = fn_filter
+
+    def _compile(self, source, template_name):
+        return self._env.from_string(source)
+
+    def _generate(self, template, model):
+        return template.generate(**model)
+
+
+def view(path):
+    """
+    A view decorator that render a view by dict.
+    >>> @view('test/view.html')
+    ... def hello():
+    ...     return dict(name='Bob')
+    >>> t = hello()
+    >>> isinstance(t, Template)
+    True
+    >>> t.template_name
+    'test/view.html'
+    >>> @view('test/view.html')
+    ... def hello2():
+    ...     return ['a list']
+    >>> t = hello2()
+    Traceback (most recent call last):
+      ...
+    ValueError: Expect return a dict when using @view() decorator.
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            r = func(*args, **kw)
+            if isinstance(r, dict):
+                return Template(path, **r)
+            raise ValueError('Expect return a dict when using @view() decorator.')
+        return _wrapper
+    return _decorator
+
+
 def _build_regex(path):
     # 用于将路径转换成正则表达式，并捕获其中的参数
     re_list = ['^']
@@ -638,14 +977,21 @@ class Route(object):
     def __init__(self, func):
         self.path = func.__web_route__
         self.method = func.__web_method__
+        self.timeout = getattr(func, '__web_timeout__', None)
         self.is_static = _re_route.search(self.path) is None
-        if not self.is_static:
-            self.route = re.compile(_build_regex(self.path))
+        # 动态路由的正则在第一次匹配时才编译，启动时几百个路由不必全部编译；
+        # 第一个参数之前的固定前缀不匹配的url直接跳过，不会触发编译
+        self.prefix = _re_route.split(self.path)[0]
+        self.route = None
         self.func = func
 
     def match(self, url):
-
-        m = self.route.match(url)
+        if not url.startswith(self.prefix):
+            return None
+        route = self.route
+        if route is None:
+            route = self.route = re.compile(_build_regex(self.path))
+        m = route.match(url)
         if m:
             return m.groups()
         return None
@@ -661,6 +1007,36 @@ class Route(object):
     __repr__ = __str__
 
 
+_RE_INTERCEPTOR_STARTS_WITH = re.compile(r'^([^\*\?]+)\*?$')
+_RE_INTERCEPTOR_ENDS_WITH = re.compile(r'^\*([^\*\?]+)$')
+
+
+def _build_pattern_fn(pattern):
+    m = _RE_INTERCEPTOR_STARTS_WITH.match(pattern)
+    if m:
+        return lambda p: p.startswith(m.group(1))
+    m = _RE_INTERCEPTOR_ENDS_WITH.match(pattern)
+    if m:
+        return lambda p: p.endswith(m.group(1))
+    raise ValueError('Invalid pattern definition in interceptor.')
+
+
+def interceptor(pattern='/'):
+    """
+    An @interceptor decorator. pattern is a path prefix ('/api/' or '/api/*') or suffix ('*.html').
+
+    >>> @interceptor('/admin/')
+    ... def check_admin(next):
+    ...     return next()
+    >>> check_admin.__interceptor__('/admin/users'), check_admin.__interceptor__('/blog/')
+    (True, False)
+    """
+    def _decorator(func):
+        func.__interceptor__ = _build_pattern_fn(pattern)
+        return func
+    return _decorator
+
+
 def _build_interceptor_fn(func, next):
     """
     拦截器接受一个next函数，这样，一个拦截器可以决定调用next()继续处理请求还是直接返回
@@ -724,6 +1100,109 @@ def _build_interceptor_chain(last_fn, *interceptors):
     return fn
 
 
+def _call_route(route, *args):
+    # 记录命中的Route，metrics等中间件据此按路由统计
+    ctx.request.environ['transwarp.route'] = route
+    if route.timeout is not None:
+        ctx.deadline = ctx.request.environ['transwarp.start'] + route.timeout
+        db.set_deadline(ctx.deadline)
+    return route(*args)
+
+
+class _LazyHandler(object):
+
+    """
+    A handler from the route manifest; its module is imported on the first call.
+    """
+
+    def __init__(self, module_name, name, path, method, timeout=None):
+        self.module_name = module_name
+        self.name = name
+        self.__web_route__ = path
+        self.__web_method__ = method
+        if timeout is not None:
+            self.__web_timeout__ = timeout
+        self._func = None
+
+    def __call__(self, *args):
+        func = self._func
+        if func is None:
+            func = self._func = getattr(_load_module(self.module_name), self.name)
+        return func(*args)
+
+    def __str__(self):
+        return '%s.%s' % (self.module_name, self.name)
+
+
+def _module_file(module_name):
+    """
+    Find the source file of module_name without importing it (parent packages are not imported either).
+    """
+    path = None
+    pathname = None
+    for part in module_name.split('.'):
+        f, pathname, desc = imp.find_module(part, path)
+        if f:
+            f.close()
+        path = [pathname]
+    if os.path.isdir(pathname):
+        return os.path.join(pathname, '__init__.py')
+    return pathname
+
+
+class _RouteManifest(object):
+
+    """
+    Routes found by add_module(), cached in a json file: {module: {file, mtime, routes: [[name, path, method, timeout]]}}.
+    An entry is used only while the module resolves to the same source file and it keeps the same mtime.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.dirty = False
+        try:
+            with open(filename) as f:
+                self._modules = json.load(f)
+        except (IOError, ValueError):
+            self._modules = {}
+
+    def routes(self, module_name, filename):
+        entry = self._modules.get(module_name)
+        if entry is None:
+            return None
+        # sys.path变化或者模块被移动后，同名模块可能是另一个文件
+        if os.path.abspath(filename) != entry['file']:
+            return None
+        try:
+            if os.path.getmtime(entry['file']) != entry['mtime']:
+                return None
+        except OSError:
+            return None
+        return entry['routes']
+
+    def update(self, m, funcs):
+        filename = getattr(m, '__file__', None)
+        if not filename:
+            return
+        if filename.endswith(('.pyc', '.pyo')) and os.path.exists(filename[:-1]):
+            filename = filename[:-1]
+        routes = [[name, f.__web_route__, f.__web_method__, getattr(f, '__web_timeout__', None)] for name, f in funcs]
+        self._modules[m.__name__] = dict(file=os.path.abspath(filename), mtime=os.path.getmtime(filename), routes=routes)
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._modules, f)
+            os.rename(tmp, self.filename)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            logging.warning('cannot write route manifest %s: %s', self.filename, e)
+
+
 def _load_module(module_name):
     last_dot = module_name.rfind('.')
     # not found
@@ -742,6 +1221,14 @@ class WSGIApplication(object):
         self._document_root = document_root
 
         self._interceptors = []
+        # 默认的请求时间预算(秒)，单个路由可以用@timeout()覆盖
+        self._timeout = kwargs.get('timeout', None)
+        # route_manifest='routes.json': add_module()按文件mtime缓存路由，模块在路由第一次被访问时才导入
+        manifest = kwargs.get('route_manifest', None)
+        self._manifest = _RouteManifest(manifest) if manifest else None
+        self._template_engine = None
+        self._metrics = False
+        self._profiler = None
 
         self._get_static = {}
         self._post_static = {}
@@ -753,14 +1240,75 @@ class WSGIApplication(object):
         if self._running:
             raise RuntimeError('Cannot modify WSGIApplication when running.')
 
+    @property
+    def template_engine(self):
+        return self._template_engine
+
+    @template_engine.setter
+    def template_engine(self, engine):
+        self._check_not_running()
+        self._template_engine = engine
+
+    def enable_metrics(self, path='/__metrics'):
+        """
+        Collect per-route metrics and expose them at path in Prometheus text format.
+        """
+        self._check_not_running()
+        self._metrics = True
+
+        def _metrics_handler():
+            ctx.response.content_type = 'text/plain; version=0.0.4'
+            return metrics.prometheus_text()
+        _metrics_handler.__web_route__ = path
+        _metrics_handler.__web_method__ = 'GET'
+        self.add_url(_metrics_handler)
+
+    def enable_profiler(self, path=None, **kw):
+        """
+        Enable the sampling profiler, kw is passed to profiler.Profiler.
+        In sampler mode the collapsed stacks are served at path if one is given. With header and
+        secret set, the endpoint requires the same header; otherwise it has no access control and
+        should only be reachable internally.
+        """
+        self._check_not_running()
+        self._profiler = profiler.Profiler(**kw)
+        if path and self._profiler.mode == 'sampler':
+            header, secret = kw.get('header'), kw.get('secret')
+
+            def _profile_handler():
+                # 结果里有文件名和函数名，不能让任何客户端读取
+                if secret and ctx.request.header(header) != secret:
+                    raise HttpError.notfound()
+                ctx.response.content_type = 'text/plain; charset=utf-8'
+                return self._profiler.collapsed()
+            _profile_handler.__web_route__ = path
+            _profile_handler.__web_method__ = 'GET'
+            self.add_url(_profile_handler)
+        return self._profiler
+
     def add_module(self, module):
         self._check_not_running()
+        if self._manifest is not None and isinstance(module, basestring):
+            try:
+                filename = _module_file(module)
+            except ImportError:
+                filename = None
+            routes = self._manifest.routes(module, filename) if filename else None
+            if routes is not None:
+                logging.info('Add module: %s (from route manifest)', module)
+                for name, path, method, timeout in routes:
+                    self.add_url(_LazyHandler(module, name, path, method, timeout))
+                return
         m = module if isinstance(module, types.ModuleType) else _load_module(module)
-        logging.info('Add module: %s' % m.__name__)
+        logging.info('Add module: %s', m.__name__)
+        funcs = []
         for name in dir(m):
             fn = getattr(m, name)
             if callable(fn) and hasattr(fn, '__web_route__') and hasattr(fn, '__web_method__'):
+                funcs.append((name, fn))
                 self.add_url(fn)
+        if self._manifest is not None:
+            self._manifest.update(m, funcs)
 
     def add_url(self, func):
         self._check_not_running()
@@ -775,18 +1323,25 @@ class WSGIApplication(object):
                 self._get_dynamic.append(route)
             elif route.method == 'POST':
                 self._post_dynamic.append(route)
-        logging.info('Add route: %s' % str(route))
+        logging.info('Add route: %s', route)
+
+    def add_interceptor(self, func):
+        self._check_not_running()
+        self._interceptors.append(func)
+        logging.info('Add interceptor: %s', func)
 
-    def run(self, port=9000, host='127.0.0.1'):
+    def run(self, port=9000, host='127.0.0.1', **kw):
         """
-        启动python自带的WSGI Server
+        启动内置的HTTP/1.1 server，kw是server.HttpServer的参数(workers, idle_timeout, max_requests...)
         """
-        logging.info('application (%s) will start at %s:%s...' % (self._document_root, host, port))
-        server = make_server(host, port, self.get_wsgi_application(debug=True))
-        server.serve_forever()
+        logging.info('application (%s) will start at %s:%s...', self._document_root, host, port)
+        httpd = server.HttpServer(self.get_wsgi_application(debug=True), host, port, **kw)
+        httpd.serve_forever()
 
     def get_wsgi_application(self, debug=False):
         self._check_not_running()
+        if self._manifest is not None:
+            self._manifest.save()
         # if debug:
         #     self._get_dynamic.append(StaticFileRoute())
         self._running = True
@@ -800,36 +1355,68 @@ class WSGIApplication(object):
             if request_method == 'GET':
                 fn = self._get_static.get(path_info)
                 if fn:
-                    return fn()
+                    return _call_route(fn)
                 for fn in self._get_dynamic:
                     args = fn.match(path_info)
                     if args:
-                        return fn(*args)
+                        return _call_route(fn, *args)
                 raise _URLNotFoundError
             if request_method == 'POST':
                 fn = self._post_static.get(path_info)
                 if fn:
-                    return fn()
+                    return _call_route(fn)
                 for fn in self._post_dynamic:
                     args = fn.match(path_info)
                     if args:
-                        return fn(*args)
+                        return _call_route(fn, *args)
                 raise _URLNotFoundError
 
         fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
 
+        def _teardown():
+            db.end_request()
+            log.set_request_id(None)
+            del ctx.request_id
+            del ctx.deadline
+            del ctx.application
+            del ctx.request
+            del ctx.response
+
         def wsgi(env, start_response):
             # WSGI 处理函数
             ctx.application = _application
             ctx.request = Request(env)
             response = ctx.response = Response()
+            start = env['transwarp.start'] = time.time()
+            ctx.deadline = start + self._timeout if self._timeout else None
+            # 沿用前端代理传来的X-Request-Id，日志和响应头里都用它串起一个请求
+            request_id = env.get('HTTP_X_REQUEST_ID')
+            if not request_id or len(request_id) > 64:
+                request_id = log.new_request_id()
+            ctx.request_id = request_id
+            log.set_request_id(request_id)
+            response.set_header('X-Request-Id', request_id)
+            db.begin_request(ctx.deadline)
+            streaming = False
             try:
                 r = fn_exec()
+                if isinstance(r, Template):
+                    # 模板以generator的形式渲染，直接作为WSGI的响应体输出
+                    r = self._template_engine(r.template_name, r.model)
                 if isinstance(r, unicode):
                     r = r.encode('utf-8')
+                if isinstance(r, str):
+                    if response.content_length is None:
+                        response.content_length = len(r)
+                    r = [r]
                 if r is None:
+                    response.content_length = 0
                     r = []
                 start_response(response.status, response.headers)
+                if not isinstance(r, list):
+                    # generator在server迭代时才执行，ctx要保留到响应体关闭
+                    streaming = True
+                    return _ClosingIterator(r, _teardown)
                 return r
             except _RedirectError, e:
                 response.set_header('Location', e.location)
@@ -838,11 +1425,27 @@ class WSGIApplication(object):
             except _URLNotFoundError as e:
                 start_response(e.status, response.headers)
                 return []
+            except _HttpError as e:
+                for k, v in e.headers or []:
+                    if (k, v) != _HEADER_X_POWERED_BY:
+                        response.set_header(k, v)
+                start_response(e.status, response.headers)
+                return []
+            except db.DeadlineExceeded as e:
+                # 异常经过transaction()/connection()时事务已经回滚，连接也已放回连接池
+                logging.warning('%s %s: %s', ctx.request.request_method, ctx.request.path_info, e)
+                start_response(HttpError.gatewaytimeout().status, response.headers)
+                return []
             except Exception as e:
+                logging.exception('%s %s: unhandled error', ctx.request.request_method, ctx.request.path_info)
+                start_response(HttpError.internalerror().status, response.headers)
                 return []
             finally:
-                del ctx.application
-                del ctx.request
-                del ctx.response
+                if not streaming:
+                    _teardown()
 
+        if self._profiler:
+            wsgi = self._profiler.middleware(wsgi)
+        if self._metrics:
+            wsgi = metrics.middleware(wsgi)
         return wsgi